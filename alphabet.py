@@ -1,3 +1,27 @@
+import os
+import mmap
+import zlib
+import tempfile
+import struct
+from bisect import bisect_left
+from itertools import imap, repeat
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import scipy.sparse as sp
+except ImportError:
+    sp = None
+
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+
+
 class Alphabet(object):
     """
     Bijective mapping from strings to integers.
@@ -22,15 +46,24 @@ class Alphabet(object):
     b
     c
     d
+
+    >>> a.map_array(['d', 'a', 'b'])
+    array([3, 0, 1], dtype=int32)
     """
 
     def __init__(self):
         self._mapping = {}   # str -> int
-        self._flip = {}      # int -> str; timv: consider using array or list
-        self._i = 0
+        self._flip = []      # int -> str
         self._frozen = False
         self._growing = True
 
+    def __setstate__(self, state):
+        flip = state.get('_flip')
+        if isinstance(flip, dict):
+            # pickled before _flip became a list
+            state['_flip'] = [flip[i] for i in xrange(len(flip))]
+        self.__dict__.update(state)
+
     def freeze(self):
         self._frozen = True
 
@@ -65,6 +98,25 @@ class Alphabet(object):
     def map(self, seq, *args, **kwargs):
         return list(self.imap(seq, *args, **kwargs))
 
+    def map_array(self, seq, emit_none=False):
+        """
+        Like `map`, but returns an int32 NumPy array. Keys which are not in
+        the alphabet (and can not be added) are dropped, or become -1 with
+        `emit_none`.
+        """
+        seq = list(seq)
+        n = len(seq)
+        # known keys in one C-level pass; only the misses go through __getitem__
+        out = np.fromiter(imap(self._mapping.get, seq, repeat(-1, n)), dtype=np.int32, count=n)
+        missing = np.flatnonzero(out < 0)
+        if len(missing):
+            for j in missing:
+                x = self[seq[j]]
+                out[j] = -1 if x is None else x
+            if not emit_none:
+                out = out[out >= 0]
+        return out
+
     def add_many(self, x):
         for k in x:
             self.add(k)
@@ -93,20 +145,17 @@ class Alphabet(object):
                 raise ValueError('Alphabet is frozen. Key "%s" not found.' % (k,))
             if not self._growing:
                 return None
-            x = self._mapping[k] = self._i
-            self._flip[x] = k
-            self._i += 1
+            x = self._mapping[k] = len(self._flip)
+            self._flip.append(k)
             return x
 
     add = __getitem__
 
     def __iter__(self):
-        for i in xrange(len(self)):
-            yield self._flip[i]
+        return iter(self._flip)
 
     def enum(self):
-        for i in xrange(len(self)):
-            yield (i, self._flip[i])
+        return enumerate(self._flip)
 
     def __len__(self):
         return len(self._mapping)
@@ -123,7 +172,403 @@ class Alphabet(object):
         with file(filename, 'wb') as f:
             f.write(self.plaintext())
 
+    def save_frozen(self, filename):
+        """ Write the alphabet in the format `FrozenAlphabet.open` maps. """
+        keys = list(self)
+        kinds = ''.join(KIND_UNICODE if isinstance(k, unicode) else KIND_BYTES for k in keys)
+        keys = [k.encode('utf-8') if isinstance(k, unicode) else k for k in keys]
+        offsets = [0]
+        for k in keys:
+            offsets.append(offsets[-1] + len(k))
+        order = sorted(xrange(len(keys)), key=lambda i: (keys[i], kinds[i]))
+        with file(filename, 'wb') as f:
+            f.write(FILE_HEADER.pack(FrozenAlphabet.FILE_MAGIC, len(keys), offsets[-1], 0))
+            f.write(struct.pack('<%dQ' % len(offsets), *offsets))
+            f.write(struct.pack('<%dI' % len(order), *order))
+            f.write(kinds)
+            f.write(''.join(keys))
+
+
+# On-disk format of a FrozenAlphabet: this header, then the offsets of the
+# keys in the blob (n + 1 uint64s, in id order), the ids sorted by key (n
+# uint32s), the type of each key (n bytes, in id order) and the blob of keys,
+# unicode ones in utf-8.
+# magic, n, blob size, flags
+FILE_HEADER = struct.Struct('<8sQQI4x')
+KIND_BYTES, KIND_UNICODE = '\x00', '\x01'
+# Version 1 files have no key types; this flag marks all keys as unicode.
+FILE_MAGIC_V1 = 'ALPHAB01'
+FLAG_UNICODE = 1
+
+
+class FrozenAlphabet(Alphabet):
+    """
+    Read-only Alphabet memory-mapped from a file written by `save_frozen`.
+
+    Nothing is loaded up front: `lookup` slices the key out of the map, and
+    `__getitem__` binary-searches the ids sorted by key, so opening is O(1),
+    lookups are O(log n), and processes opening the same file share it in
+    the page cache instead of each unpickling its own dicts.
+
+    >>> import os, tempfile
+    >>> filename = tempfile.mktemp()
+    >>> Alphabet.from_iterable(['b', 'c', 'a']).save_frozen(filename)
+    >>> f = FrozenAlphabet.open(filename)
+    >>> f['a'], f.lookup(1), list(f)
+    (2, 'c', ['b', 'c', 'a'])
+    >>> f.close(); os.remove(filename)
+    """
+
+    FILE_MAGIC = 'ALPHAB02'
+
+    def __init__(self, mm):
+        magic, n, size, flags = FILE_HEADER.unpack_from(mm, 0)
+        if magic not in (self.FILE_MAGIC, FILE_MAGIC_V1):
+            raise ValueError('not a %s file.' % self.__class__.__name__)
+        Alphabet.__init__(self)     # the dicts stay empty; keys live in mm
+        self._mm = mm
+        self._n = n
+        self._offsets = FILE_HEADER.size
+        self._order = self._offsets + 8 * (n + 1)
+        if magic == FILE_MAGIC_V1:
+            self._kinds = None
+            self._unicode = bool(flags & FLAG_UNICODE)
+            self._blob = self._order + 4 * n
+        else:
+            self._kinds = self._order + 4 * n
+            self._blob = self._kinds + n
+        if len(mm) < self._blob + size:
+            raise ValueError('truncated %s file.' % self.__class__.__name__)
+        self._frozen = True
+        self._growing = False
+
+    @classmethod
+    def open(cls, filename):
+        with file(filename, 'rb') as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    @classmethod
+    def _from_alphabet(cls, alphabet):
+        """ Map a copy of `alphabet` from a file that is deleted straight away. """
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            alphabet.save_frozen(filename)
+            return cls.open(filename)
+        finally:
+            os.remove(filename)     # the map keeps the data alive
+
+    @classmethod
+    def from_iterable(cls, s):
+        return cls._from_alphabet(Alphabet.from_iterable(s))
+
+    @classmethod
+    def load(cls, filename):
+        return cls._from_alphabet(Alphabet.load(filename))
+
+    def close(self):
+        self._mm.close()
+
+    def _key(self, i):
+        start, stop = struct.unpack_from('<QQ', self._mm, self._offsets + 8 * i)
+        return self._mm[self._blob + start:self._blob + stop]
+
+    def _id(self, rank):
+        return struct.unpack_from('<I', self._mm, self._order + 4 * rank)[0]
+
+    def _is_unicode(self, i):
+        if self._kinds is None:
+            return self._unicode
+        return self._mm[self._kinds + i] == KIND_UNICODE
+
+    def _find(self, k):
+        """ Id of key k, or -1. """
+        is_unicode = isinstance(k, unicode)
+        if is_unicode:
+            k = k.encode('utf-8')
+        rank = bisect_left(_SortedKeys(self), k)
+        while rank < self._n:
+            i = self._id(rank)
+            if self._key(i) != k:
+                break
+            # a byte string and a unicode key with the same bytes are the
+            # same key only if it is ascii
+            if self._is_unicode(i) == is_unicode or _is_ascii(k):
+                return i
+            rank += 1
+        return -1
+
+    def __getitem__(self, k):
+        if not isinstance(k, basestring):
+            raise ValueError("Invalid key (%s): only strings allowed." % (k,))
+        i = self._find(k)
+        if i < 0:
+            raise ValueError('Alphabet is frozen. Key "%s" not found.' % (k,))
+        return i
+
+    add = __getitem__
+
+    def __contains__(self, k):
+        assert isinstance(k, basestring)
+        return self._find(k) >= 0
+
+    def lookup(self, i):
+        if i is None:
+            return None
+        if not 0 <= i < self._n:
+            raise IndexError(i)
+        k = self._key(i)
+        return k.decode('utf-8') if self._is_unicode(i) else k
+
+    def keys(self):
+        return iter(self)
+
+    def __iter__(self):
+        return imap(self.lookup, xrange(self._n))
+
+    def enum(self):
+        return enumerate(self)
+
+    def __len__(self):
+        return self._n
+
+    def map_array(self, seq, emit_none=False):
+        out = np.fromiter(imap(self._find, seq), dtype=np.int32)
+        if not emit_none:
+            out = out[out >= 0]
+        return out
+
+    def imap(self, seq, emit_none=False):
+        for s in seq:
+            i = self._find(s)
+            if i >= 0:
+                yield i
+            elif emit_none:
+                yield None
+
+    def freeze(self):
+        pass
+
+    def stop_growth(self):
+        pass
+
+
+def _is_ascii(k):
+    try:
+        k.decode('ascii')
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+class _SortedKeys(object):
+    """ The keys of a FrozenAlphabet in sorted order, as a sequence for bisect. """
+    def __init__(self, alphabet):
+        self.alphabet = alphabet
+    def __getitem__(self, rank):
+        a = self.alphabet
+        return a._key(a._id(rank))
+    def __len__(self):
+        return self.alphabet._n
+
+
+# name -> function from a byte string to a 32-bit hash (signed or not; only
+# the low 32 bits are used).
+HASHES = {'crc32': zlib.crc32}
+if mmh3 is not None:
+    HASHES['mmh3'] = mmh3.hash
+DEFAULT_HASH = 'mmh3' if mmh3 is not None else 'crc32'
+
+
+class HashedAlphabet(object):
+    """
+    Map strings to integers with the hashing trick: a feature's index is the
+    low `nbits` bits of its hash, so nothing has to be stored, any string
+    gets an index, and the index space is fixed at 2**nbits.
+
+    With `signed`, bit 31 of the hash gives each feature a sign of +1 or -1;
+    colliding features then cancel out in expectation instead of adding up
+    (Weinberger et al., "Feature Hashing for Large Scale Multitask
+    Learning", 2009). Use `sign(k)` for a feature's sign.
+
+    Supports the mapping calls of `Alphabet` (`[]`, `add`, `map`, `imap`,
+    `map_array`) except for the reverse `lookup`; `transform` turns
+    `(label, features)` records into a SciPy CSR matrix.
+
+    >>> h = HashedAlphabet(nbits=10)
+    >>> h['feature'] == h.add('feature') and 0 <= h['feature'] < len(h) == 1024
+    True
+    """
+
+    def __init__(self, nbits=20, signed=True, hash=DEFAULT_HASH):
+        assert 0 < nbits <= 31
+        self.nbits = nbits
+        self.signed = signed
+        self.hash = hash
+        self._hash = HASHES[hash]
+        self._mask = (1 << nbits) - 1
+        self.labels = Alphabet()
+
+    def _h(self, k):
+        if isinstance(k, unicode):
+            k = k.encode('utf-8')
+        return self._hash(k) & 0xffffffff
+
+    def __getitem__(self, k):
+        if not isinstance(k, basestring):
+            raise ValueError("Invalid key (%s): only strings allowed." % (k,))
+        return self._h(k) & self._mask
+
+    add = __getitem__
+
+    def sign(self, k):
+        if not self.signed:
+            return 1
+        return -1 if self._h(k) >> 31 else 1
+
+    def __contains__(self, k):
+        return True
+
+    def __len__(self):
+        return 1 << self.nbits
+
+    def imap(self, seq, emit_none=False):
+        return imap(self.__getitem__, seq)
+
+    def map(self, seq, *args, **kwargs):
+        return list(self.imap(seq))
+
+    def add_many(self, x):
+        pass
+
+    def _hashes(self, seq):
+        return np.fromiter(imap(self._h, seq), dtype=np.int64)
+
+    def map_array(self, seq, emit_none=False):
+        return (self._hashes(seq) & self._mask).astype(np.int32)
+
+    def transform(self, records, dtype=float):
+        """
+        Hash a batch of `(label, features)` records, e.g. from
+        `featureselection.read_tab_file`, into `(y, X)`: an int32 array of
+        label ids (from `self.labels`) and a CSR matrix with one row per
+        record and 2**nbits columns. Repeated features add up.
+        """
+        labels = []
+        indptr = [0]
+        features = []
+        for label, fs in records:
+            labels.append(label)
+            features.extend(fs)
+            indptr.append(len(features))
+        h = self._hashes(features)
+        indices = (h & self._mask).astype(np.int32)
+        if self.signed:
+            data = np.where(h >> 31, -1, 1).astype(dtype)
+        else:
+            data = np.ones(len(h), dtype=dtype)
+        X = sp.csr_matrix((data, indices, np.array(indptr, dtype=np.int32)),
+                          shape=(len(labels), len(self)))
+        X.sum_duplicates()
+        return self.labels.map_array(labels), X
+
+
+def test():
+    print 'testing alphabet...'
+    import os, tempfile, random
+    rnd = random.Random(0)
+    words = list(set(''.join(rnd.choice('abcdefg') for _ in xrange(rnd.randint(1, 6)))
+                     for _ in xrange(3000)))
+    a = Alphabet()
+    ids = a.map_array(words + words[:10])
+    assert ids.dtype == np.int32 and list(ids) == range(len(words)) + range(10)
+    assert list(a) == words and [a.lookup(i) for i in ids[:5]] == words[:5]
+    a.add(u'caf\xe9')
+    a.stop_growth()
+    assert list(a.map_array(['zzz', words[3]])) == [3]
+    assert list(a.map_array(['zzz', words[3]], emit_none=True)) == [-1, 3]
+
+    filename = tempfile.mktemp()
+    try:
+        a.save_frozen(filename)
+        f = FrozenAlphabet.open(filename)
+        assert len(f) == len(a) and list(f) == list(a)
+        assert [f[w] for w in words] == [a[w] for w in words]
+        assert f[u'caf\xe9'] == a[u'caf\xe9'] and f.lookup(len(a) - 1) == u'caf\xe9'
+        probes = words[::7] + ['zzz', 'h', '']
+        assert list(f.map_array(probes, emit_none=True)) == list(a.map_array(probes, emit_none=True))
+        assert f.map(probes) == a.map(probes)
+        assert 'zzz' not in f and words[0] in f
+        try:
+            f['zzz']
+        except ValueError:
+            pass
+        else:
+            assert False, 'expected ValueError'
+        g = FrozenAlphabet.from_iterable(words)
+        assert list(g) == words and g[words[9]] == 9 and g._frozen
+        g.close()
+        Alphabet.from_iterable(words).save(filename + '2')
+        g = FrozenAlphabet.load(filename + '2')
+        assert list(g) == words and isinstance(g, FrozenAlphabet)
+        g.close()
+        f.save_frozen(filename + '2')
+        g = FrozenAlphabet.open(filename + '2')
+        assert list(g) == list(f)
+        g.close()
+        os.remove(filename + '2')
+        f.close()
+    finally:
+        os.remove(filename)
+
+    # key types are kept per key: bytes which are not utf-8 stay bytes, and
+    # a byte string is a different key from unicode with the same bytes
+    mixed = ['\xff\xfe', u'caf\xe9', 'caf\xc3\xa9', u'\xe9', 'plain', u'wide']
+    g = FrozenAlphabet.from_iterable(mixed)
+    assert list(g) == mixed and map(type, g) == map(type, mixed)
+    assert [g[k] for k in mixed] == range(6) and g[u'plain'] == 4 and g['wide'] == 5
+    assert 'caf\xe9' not in g and '\xe9' not in g
+    g.close()
+
+    # version 1 files record one type for all the keys
+    keys = [u'b', u'\xe9', u'a']
+    blob = ''.join(k.encode('utf-8') for k in keys)
+    with file(filename, 'wb') as out:
+        out.write(FILE_HEADER.pack(FILE_MAGIC_V1, 3, len(blob), FLAG_UNICODE))
+        out.write(struct.pack('<4Q', 0, 1, 3, 4) + struct.pack('<3I', 2, 0, 1))
+        out.write(blob)
+    g = FrozenAlphabet.open(filename)
+    assert list(g) == keys and g[u'\xe9'] == 1 and g['a'] == 2
+    g.close()
+    os.remove(filename)
+
+    # pickles, including ones from before _flip was a list
+    import cPickle
+    b = cPickle.loads(cPickle.dumps(a, 2))
+    assert list(b) == list(a) and b[words[5]] == 5
+    old = Alphabet.__new__(Alphabet)
+    old.__setstate__({'_mapping': {'x': 0, 'y': 1}, '_flip': {0: 'x', 1: 'y'},
+                      '_frozen': False, '_growing': True})
+    assert old['z'] == 2 and list(old) == ['x', 'y', 'z'] and old.lookup(1) == 'y'
+
+    for hash in HASHES:
+        h = HashedAlphabet(nbits=8, hash=hash)
+        assert list(h.map_array(words[:50])) == h.map(words[:50]) == [h[w] for w in words[:50]]
+        assert all(0 <= i < 256 for i in h.map(words))
+        assert h[u'caf\xe9'] == h[u'caf\xe9'.encode('utf-8')]
+        assert set(h.sign(w) for w in words) == set([-1, 1])
+        records = [('pos', ['a', 'b', 'a']), ('neg', []), ('pos', [u'caf\xe9', 'zzz'])]
+        y, X = h.transform(records)
+        assert list(y) == [0, 1, 0] and X.shape == (3, 256)
+        if h['a'] != h['b']:
+            assert X[0, h['a']] == 2 * h.sign('a') and X[0, h['b']] == h.sign('b')
+        assert X[1].nnz == 0 and abs(X[2]).sum() == 2
+        y, X = HashedAlphabet(nbits=8, signed=False, hash=hash).transform(records)
+        assert X.sum() == 5
+    print 'pass.'
+
 
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
+    test()
@@ -1,61 +1,143 @@
-from collections import deque
+from sys import getsizeof
+from threading import Lock
 
-def lru_cache(maxsize):
+from memoize import CacheInfo
+from registry import register, qualname, approx_size
+
+PREV, NEXT, KEY, RESULT, SIZE = 0, 1, 2, 3, 4    # names for the link fields
+
+def lru_cache(maxsize=100, maxbytes=None, sizeof=getsizeof):
     '''Decorator applying a least-recently-used cache with the given maximum size.
 
     Arguments to the cached function must be hashable.
     Cache performance statistics stored in f.hits and f.misses.
+
+    Entries are kept in a circular doubly-linked list threaded through the
+    cache dict, so both hits and evictions are O(1) -- there is no access
+    queue to compact.
+
+    `maxsize=None` removes the bound on the number of entries. `maxbytes`
+    additionally bounds the approximate memory held by keys and results, as
+    measured by `sizeof` (shallow `sys.getsizeof` by default; pass something
+    deeper for nested results).
     '''
     def decorating_function(f):
-        cache = {}              # mapping of args to results
-        queue = deque()         # order that keys have been accessed
-        refcount = {}           # number of times each key is in the access queue
+        cache = {}              # mapping of args to links
+        root = []               # sentinel; root[NEXT] is the least recently used
+        root[:] = [root, root, None, None, 0]
+        lock = Lock()
+
         def wrapper(*args):
-            
+
             # localize variable access (ugly but fast)
-            _cache=cache; _len=len; _refcount=refcount; _maxsize=maxsize
-            queue_append=queue.append; queue_popleft = queue.popleft
-
-            # get cache entry or compute if not found
-            try:
-                result = _cache[args]
-                wrapper.hits += 1
-            except KeyError:
-                result = _cache[args] = f(*args)
+            _root = root
+
+            with lock:
+                link = cache.get(args)
+                if link is not None:
+                    # move the link to the most recently used position
+                    link_prev, link_next = link[PREV], link[NEXT]
+                    link_prev[NEXT] = link_next
+                    link_next[PREV] = link_prev
+                    last = _root[PREV]
+                    last[NEXT] = _root[PREV] = link
+                    link[PREV] = last
+                    link[NEXT] = _root
+                    wrapper.hits += 1
+                    return link[RESULT]
+
+            result = f(*args)
+
+            with lock:
                 wrapper.misses += 1
+                if args in cache:
+                    # another thread computed it while we were not holding the lock
+                    return result
+                size = sizeof(args) + sizeof(result) if maxbytes is not None else 0
+                last = _root[PREV]
+                link = [last, _root, args, result, size]
+                last[NEXT] = _root[PREV] = cache[args] = link
+                wrapper.currbytes += size
 
-            # record that this key was recently accessed
-            queue_append(args)
-            _refcount[args] = _refcount.get(args, 0) + 1
-
-            # Purge least recently accessed cache contents
-            while _len(_cache) > _maxsize:
-                k = queue_popleft()
-                _refcount[k] -= 1
-                if not _refcount[k]:
-                    del _cache[k]
-                    del _refcount[k]
-    
-            # Periodically compact the queue by duplicate keys
-            if _len(queue) > _maxsize * 4:
-                for i in [None] * _len(queue):
-                    k = queue_popleft()
-                    if _refcount[k] == 1:
-                        queue_append(k)
-                    else:
-                        _refcount[k] -= 1
-                assert len(queue) == len(cache) == len(refcount) == sum(refcount.itervalues())
+                # Purge least recently accessed cache contents
+                purge()
 
             return result
+
+        def purge():
+            _maxsize = wrapper.maxsize
+            while cache and ((_maxsize is not None and len(cache) > _maxsize)
+                             or (maxbytes is not None and wrapper.currbytes > maxbytes)):
+                oldest = root[NEXT]
+                oldest_next = oldest[NEXT]
+                root[NEXT] = oldest_next
+                oldest_next[PREV] = root
+                del cache[oldest[KEY]]
+                wrapper.currbytes -= oldest[SIZE]
+                wrapper.evictions += 1
+
+        def resize(maxsize):
+            with lock:
+                wrapper.maxsize = maxsize
+                purge()
+
+        def cache_info():
+            return CacheInfo(wrapper.hits, wrapper.misses, wrapper.evictions, wrapper.maxsize, len(cache))
+
+        def cache_bytes():
+            if maxbytes is not None:
+                return wrapper.currbytes
+            return approx_size(cache, value=lambda link: link[RESULT])
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+                root[:] = [root, root, None, None, 0]
+                wrapper.hits = wrapper.misses = wrapper.evictions = wrapper.currbytes = 0
+
         wrapper.__doc__ = f.__doc__
         wrapper.__name__ = f.__name__
-        wrapper.hits = wrapper.misses = 0
-        return wrapper
+        wrapper.hits = wrapper.misses = wrapper.evictions = wrapper.currbytes = 0
+        wrapper.cache_info = cache_info
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_bytes = cache_bytes
+        wrapper.resize = resize
+        wrapper.maxsize = maxsize
+        return register(wrapper, qualname(f), 'lru_cache')
     return decorating_function
 
 
+def test():
+    print 'testing lru_cache...'
+
+    @lru_cache(maxsize=2)
+    def g(x):
+        return x * 2
+    g(1); g(2); g(1); g(3)      # 2 is the least recently used when 3 arrives
+    assert (g.hits, g.misses, g.evictions) == (1, 3, 1)
+    g(1)
+    assert g.hits == 2
+    g(2)
+    assert g.misses == 4
+    g.resize(1)
+    assert g.cache_info().currsize == 1
+
+    @lru_cache(maxsize=None, maxbytes=1000, sizeof=lambda x: 100)
+    def h(x):
+        return x
+    for i in xrange(20):
+        h(i)
+    assert h.cache_info().currsize == 5 and h.currbytes == 1000
+    h.cache_clear()
+    assert h.cache_info() == CacheInfo(0, 0, 0, None, 0)
+
+    print 'pass.'
+
+
 if __name__ == '__main__':
-         
+
+    test()
+
     @lru_cache(maxsize=20)
     def f(x, y):
         return 3*x+y
@@ -0,0 +1,165 @@
+"""
+Caching decorators for coroutine functions.
+
+`memoize` and friends would cache the coroutine object a coroutine function
+returns, which can only be awaited once. The decorators here cache the
+awaited *result* instead:
+
+  - concurrent callers of the same missing key share one in-flight task
+    (single-flight), so a burst of identical requests fires one fetch;
+  - a caller which is cancelled does not cancel the shared task;
+  - results which raise, or tasks which get cancelled, are dropped from the
+    cache instead of being served to later callers;
+  - entries optionally expire after `ttl` seconds, and at most `maxsize`
+    entries are kept (least recently used go first).
+
+The event loop is `trollius`, the Python 2 port of asyncio. The module
+imports without it, but the decorators raise ImportError when used.
+
+    >>> @async_memoize(maxsize=1000, ttl=60)
+    ... def fetch(url):
+    ...     return http_get(url)          # any coroutine function
+"""
+
+from collections import OrderedDict
+from datetime import timedelta
+from functools import wraps
+from time import time
+
+try:
+    import trollius as asyncio
+except ImportError:
+    asyncio = None
+
+from registry import CacheInfo, register, qualname, approx_size, _make_key
+
+
+def async_memoize(maxsize=None, ttl=None):
+    """ Cache the awaited results of a coroutine function. """
+
+    if asyncio is None:
+        raise ImportError('async_memoize needs trollius.')
+
+    def decorate(f):
+
+        cache = OrderedDict()     # key -> (expiry time, future); oldest first
+
+        def done(key, fut):
+            entry = cache.get(key)
+            if entry is None or entry[1] is not fut:
+                return            # evicted or replaced while in flight
+            if fut.cancelled() or fut.exception() is not None:
+                del cache[key]
+                return
+            cache[key] = (time() + ttl if ttl is not None else None, fut)
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            entry = cache.pop(key, None)
+            if entry is not None:
+                expiry, fut = entry
+                if expiry is None or time() < expiry:
+                    cache[key] = entry            # most recently used
+                    wrapper.hits += 1
+                    return asyncio.shield(fut)
+            wrapper.misses += 1
+            fut = asyncio.ensure_future(f(*args, **kwargs))
+            # in-flight entries never expire; `done` stamps the expiry.
+            cache[key] = (None, fut)
+            fut.add_done_callback(lambda fut: done(key, fut))
+            while maxsize is not None and len(cache) > maxsize:
+                cache.popitem(last=False)
+            return asyncio.shield(fut)
+
+        def cache_clear():
+            cache.clear()
+            wrapper.hits = wrapper.misses = 0
+
+        def cache_info():
+            return CacheInfo(wrapper.hits, wrapper.misses, None, maxsize, len(cache))
+
+        def cache_bytes():
+            return approx_size(cache, value=lambda entry: entry[1].result()
+                               if entry[1].done() and not entry[1].cancelled()
+                               and entry[1].exception() is None else None)
+
+        wrapper.hits = wrapper.misses = 0
+        wrapper.cache = cache
+        wrapper.cache_clear = cache_clear
+        wrapper.cache_info = cache_info
+        wrapper.cache_bytes = cache_bytes
+        return register(wrapper, qualname(f), 'async_memoize')
+
+    return decorate
+
+
+def async_timed_cache(seconds=0, minutes=0, hours=0, days=0, maxsize=None):
+    """ Like `timed_cache`, for coroutine functions. """
+    ttl = timedelta(seconds=seconds, minutes=minutes, hours=hours, days=days).total_seconds()
+    return async_memoize(maxsize=maxsize, ttl=ttl)
+
+
+def test():
+    print 'testing async_memoize...'
+    if asyncio is None:
+        print 'trollius is not installed; skipping.'
+        return
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    run = loop.run_until_complete
+
+    calls = []
+    @async_timed_cache(seconds=0.2, maxsize=2)
+    def fetch(x):
+        calls.append(x)
+        return asyncio.sleep(0.05, result=x * 2)
+
+    # concurrent awaiters share one task
+    assert run(asyncio.gather(fetch(1), fetch(1), fetch(2))) == [2, 2, 4]
+    assert calls == [1, 2]
+    assert run(fetch(1)) == 2 and calls == [1, 2]
+
+    run(fetch(3))                           # evicts 2, the least recently used
+    assert run(fetch(2)) == 4 and calls == [1, 2, 3, 2]
+
+    run(asyncio.sleep(0.25))                # expired
+    assert run(fetch(2)) == 4 and calls == [1, 2, 3, 2, 2]
+
+    # exceptions are not cached
+    failures = []
+    @async_memoize()
+    def flaky(x):
+        failures.append(x)
+        fut = asyncio.Future()
+        if len(failures) == 1:
+            fut.set_exception(ValueError())
+        else:
+            fut.set_result(None)
+        return fut
+    try:
+        run(flaky(1))
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+    assert run(flaky(1)) is None and failures == [1, 1]
+
+    # a cancelled awaiter does not cancel the shared task
+    calls[:] = []
+    waiter = loop.create_task(asyncio.wait_for(fetch(5), 0.01))
+    other = fetch(5)
+    try:
+        run(waiter)
+    except asyncio.TimeoutError:
+        pass
+    assert run(other) == 10 and calls == [5]
+
+    loop.close()
+    asyncio.set_event_loop(None)
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,267 @@
+"""
+Eviction policies for bounded caches.
+
+A policy only does bookkeeping on keys -- the cache which owns it stores the
+values. The protocol is tiny:
+
+  - `hit(key)`     tell the policy that a cached key was used.
+  - `miss(key)`    admit a new key; returns the list of keys which the cache
+                   must now drop to stay within `maxsize`. With `maxsize`
+                   0 (or less) that is always the new key itself: nothing
+                   is kept.
+  - `resize(n)`    change the bound; returns the keys to drop.
+  - `clear()`      forget everything.
+
+All operations are O(1) (amortized), so hits never pay for a scan.
+
+  LRU  -- least-recently used.
+  LFU  -- least-frequently used, ties broken by recency.
+  ARC  -- adaptive replacement cache (Megiddo & Modha, 2003). Balances recency
+          and frequency and is scan-resistant: a one-off pass over many keys
+          can not flush out the frequently used ones.
+"""
+
+from collections import OrderedDict
+
+
+class LRU(object):
+    """ Least-recently used eviction. """
+
+    def __init__(self, maxsize):
+        self.maxsize = max(maxsize, 0)
+        self.order = OrderedDict()      # oldest first
+
+    def __len__(self):
+        return len(self.order)
+
+    def hit(self, key):
+        order = self.order
+        del order[key]
+        order[key] = None
+
+    def miss(self, key):
+        if not self.maxsize:
+            return [key]
+        self.order[key] = None
+        return self._shrink()
+
+    def resize(self, maxsize):
+        self.maxsize = max(maxsize, 0)
+        return self._shrink()
+
+    def _shrink(self):
+        evicted = []
+        while len(self.order) > self.maxsize:
+            evicted.append(self.order.popitem(last=False)[0])
+        return evicted
+
+    def clear(self):
+        self.order.clear()
+
+
+class LFU(object):
+    """
+    Least-frequently used eviction. Keys are bucketed by use count, so finding
+    the victim never scans the cache; within a bucket the least recently used
+    key goes first.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = max(maxsize, 0)
+        self.freq = {}          # key -> count
+        self.buckets = {}       # count -> OrderedDict of keys, oldest first
+        self.minfreq = None
+
+    def __len__(self):
+        return len(self.freq)
+
+    def hit(self, key):
+        f = self.freq[key]
+        bucket = self.buckets[f]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[f]
+            if self.minfreq == f:
+                self.minfreq = f + 1
+        self.freq[key] = f + 1
+        self.buckets.setdefault(f + 1, OrderedDict())[key] = None
+
+    def miss(self, key):
+        if not self.maxsize:
+            return [key]
+        # make room before admitting, otherwise the newcomer (count 1) would
+        # always be its own victim.
+        evicted = self._shrink(self.maxsize - 1)
+        self.freq[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.minfreq = 1
+        return evicted
+
+    def resize(self, maxsize):
+        self.maxsize = max(maxsize, 0)
+        return self._shrink(self.maxsize)
+
+    def _shrink(self, n):
+        evicted = []
+        while len(self.freq) > n:
+            if self.minfreq not in self.buckets:
+                self.minfreq = min(self.buckets)
+            bucket = self.buckets[self.minfreq]
+            key = bucket.popitem(last=False)[0]
+            if not bucket:
+                del self.buckets[self.minfreq]
+            del self.freq[key]
+            evicted.append(key)
+        return evicted
+
+    def clear(self):
+        self.freq.clear()
+        self.buckets.clear()
+        self.minfreq = None
+
+
+class ARC(object):
+    """
+    Adaptive replacement cache.
+
+    Cached keys live in T1 (seen once recently) or T2 (seen at least twice).
+    B1 and B2 are "ghost" lists remembering keys recently evicted from T1 and
+    T2. A miss which hits a ghost list shifts the target size `p` of T1 toward
+    whichever list would have saved it.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = max(maxsize, 0)
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+    def __len__(self):
+        return len(self.t1) + len(self.t2)
+
+    def hit(self, key):
+        try:
+            del self.t1[key]
+        except KeyError:
+            del self.t2[key]
+        self.t2[key] = None
+
+    def miss(self, key):
+        c = self.maxsize
+        if not c:
+            return [key]
+        t1, t2, b1, b2 = self.t1, self.t2, self.b1, self.b2
+        evicted = []
+        if key in b1:
+            self.p = min(c, self.p + max(len(b2) // len(b1), 1))
+            evicted.extend(self._replace(False))
+            del b1[key]
+            t2[key] = None
+            return evicted
+        if key in b2:
+            self.p = max(0, self.p - max(len(b1) // len(b2), 1))
+            evicted.extend(self._replace(True))
+            del b2[key]
+            t2[key] = None
+            return evicted
+        l1 = len(t1) + len(b1)
+        total = l1 + len(t2) + len(b2)
+        if l1 >= c:
+            if len(t1) < c:
+                b1.popitem(last=False)
+                evicted.extend(self._replace(False))
+            else:
+                evicted.append(t1.popitem(last=False)[0])
+        elif total >= c:
+            if total >= 2 * c:
+                b2.popitem(last=False)
+            evicted.extend(self._replace(False))
+        t1[key] = None
+        return evicted
+
+    def _replace(self, in_b2):
+        if len(self) < self.maxsize:
+            return []
+        t1 = self.t1
+        if t1 and (len(t1) > self.p or (in_b2 and len(t1) == self.p)):
+            key = t1.popitem(last=False)[0]
+            self.b1[key] = None
+        else:
+            key = self.t2.popitem(last=False)[0]
+            self.b2[key] = None
+        return [key]
+
+    def resize(self, maxsize):
+        maxsize = self.maxsize = max(maxsize, 0)
+        self.p = min(self.p, maxsize)
+        evicted = []
+        while len(self) > maxsize:
+            evicted.extend(self._replace(False))
+        for ghost in (self.b1, self.b2):
+            while len(ghost) > maxsize:
+                ghost.popitem(last=False)
+        return evicted
+
+    def clear(self):
+        self.p = 0
+        for x in (self.t1, self.t2, self.b1, self.b2):
+            x.clear()
+
+
+POLICIES = {'lru': LRU, 'lfu': LFU, 'arc': ARC}
+
+
+def test():
+    print 'testing eviction policies...'
+
+    p = LRU(2)
+    assert p.miss('a') == [] and p.miss('b') == []
+    p.hit('a')
+    assert p.miss('c') == ['b']
+    assert p.resize(1) == ['a']
+
+    p = LFU(2)
+    p.miss('a'); p.miss('b')
+    p.hit('a'); p.hit('a'); p.hit('b')
+    assert p.miss('c') == ['b']
+    assert p.miss('d') == ['c']
+    assert p.resize(1) == ['d']
+    assert len(p) == 1
+
+    # a scan of one-off keys must not flush out the hot keys
+    p = ARC(4)
+    cached = set()
+    def access(k):
+        if k in cached:
+            p.hit(k)
+        else:
+            cached.difference_update(p.miss(k))
+            cached.add(k)
+        assert len(cached) == len(p) <= 4
+    for _ in xrange(3):
+        for k in 'ab':
+            access(k)
+    for k in xrange(100):
+        access(k)
+    assert set('ab') <= cached, cached
+    assert len(p.resize(1)) == 3
+
+    # a zero-size cache keeps nothing, from the start or after a resize
+    for policy in POLICIES.itervalues():
+        for size in (0, -1):
+            p = policy(size)
+            assert p.miss('a') == ['a'] and p.miss('a') == ['a'] and len(p) == 0
+        p = policy(2)
+        p.miss('a'); p.miss('b'); p.hit('a')
+        assert sorted(p.resize(0)) == ['a', 'b'] and len(p) == 0
+        for k in 'abcab':
+            assert p.miss(k) == [k] and len(p) == 0
+        assert p.resize(1) == [] and p.miss('a') == [] and len(p) == 1
+
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
@@ -2,6 +2,15 @@
 #  - consider allowing lazy things to depend on one another
 
 from types import GeneratorType
+from threading import RLock
+
+from registry import CacheInfo, register, qualname
+
+def _store(value):
+    if isinstance(value, GeneratorType):   # store generators as lists
+        value = list(value)
+    return value
+
 
 class lazy(object):
     """
@@ -10,7 +19,7 @@ class lazy(object):
     is a generator, the value is stored as a list.
 
     Note: instances must have a `__dict__` attribute in order for this property
-    to work, i.e. no '__slots__' class attribute.
+    to work, i.e. no '__slots__' class attribute. See `lazyslot`.
 
     Implementation detail: this is not implemented as a data descriptor so that
     we can completely avoid the function call overhead. If one choses to invoke
@@ -23,21 +32,227 @@ class lazy(object):
         self.__module__ = func.__module__
         self.__doc__ = func.__doc__
         self.func = func
+        self.batch_loader = None
+        self.hits = self.computed = 0
+        register(self, qualname(func), 'lazy')
 
     def __get__(self, obj, type_=None):
         if obj is None:
             return self
         try:
             value = obj.__dict__[self.__name__]
+            self.hits += 1
         except KeyError:
-            value = self.func(obj)
-            if isinstance(value, GeneratorType):   # store generators as lists
-                value = list(value)
-            obj.__dict__[self.__name__] = value
+            self.computed += 1
+            value = obj.__dict__[self.__name__] = _store(self.func(obj))
         return value
 
+    def batch(self, loader):
+        """
+        Register `loader(objects) -> values`, which computes this property for
+        many objects at once; used by `prefetch`.
+        """
+        self.batch_loader = loader
+        return self
+
+    def loaded(self, obj):
+        return self.__name__ in obj.__dict__
+
+    def prefetch(self, objects):
+        missing = _unique(o for o in objects if not self.loaded(o))
+        for obj, value in zip(missing, _load_many(self, missing)):
+            obj.__dict__.setdefault(self.__name__, value)
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.computed, None, None, None)
+
+    def __set__(self, obj, value):
+        raise NotImplementedError
+
+    def __delete__(self, obj):
+        raise NotImplementedError
+
+
+class LazySlot(object):
+    """
+    Lazy property for classes with `__slots__`. The value is stored under a
+    different attribute name, `slot` (by default the method name with a
+    leading underscore), which the class must list in its `__slots__`:
+
+        >>> class Token(object):
+        ...     __slots__ = ('word', '_shape')
+        ...     def __init__(self, word):
+        ...         self.word = word
+        ...     @lazyslot
+        ...     def shape(self):
+        ...         return ''.join('X' if c.isupper() else 'x' for c in self.word)
+        >>> Token('Hello').shape
+        'Xxxxx'
+
+    Works just as well for ordinary classes, where the slot is an instance
+    attribute.
+
+    With `lock=True` the property is computed at most once even when several
+    threads ask for it at the same time (locks are striped by object, so
+    computations on different objects rarely wait on each other).
+    """
+
+    NLOCKS = 64
+
+    def __init__(self, func, slot=None, lock=False):
+        self.__name__ = func.__name__
+        self.__module__ = func.__module__
+        self.__doc__ = func.__doc__
+        self.func = func
+        self.slot = slot or '_' + func.__name__
+        self.locks = [RLock() for _ in xrange(self.NLOCKS)] if lock else None
+        self.batch_loader = None
+        self.computed = 0
+        register(self, qualname(func), 'lazyslot')
+
+    def __get__(self, obj, type_=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            pass
+        if self.locks is None:
+            value = _store(self.func(obj))
+            self.computed += 1
+            setattr(obj, self.slot, value)
+            return value
+        with self.locks[id(obj) % self.NLOCKS]:
+            try:
+                return getattr(obj, self.slot)     # another thread beat us to it
+            except AttributeError:
+                value = _store(self.func(obj))
+                self.computed += 1
+                setattr(obj, self.slot, value)
+                return value
+
+    def batch(self, loader):
+        """ Register `loader(objects) -> values`; see `lazy.batch`. """
+        self.batch_loader = loader
+        return self
+
+    def loaded(self, obj):
+        try:
+            getattr(obj, self.slot)
+        except AttributeError:
+            return False
+        return True
+
+    def prefetch(self, objects):
+        missing = _unique(o for o in objects if not self.loaded(o))
+        for obj, value in zip(missing, _load_many(self, missing)):
+            if not self.loaded(obj):
+                setattr(obj, self.slot, value)
+
+    def cache_info(self):
+        # hits are not counted to keep slot access cheap
+        return CacheInfo(None, self.computed, None, None, None)
+
     def __set__(self, obj, value):
         raise NotImplementedError
 
     def __delete__(self, obj):
         raise NotImplementedError
+
+
+def lazyslot(func=None, slot=None, lock=False):
+    """ `LazySlot` decorator; use as `@lazyslot` or `@lazyslot(lock=True)`. """
+    if func is None:
+        return lambda func: LazySlot(func, slot=slot, lock=lock)
+    return LazySlot(func, slot=slot, lock=lock)
+
+
+def _unique(objects):
+    seen = set()
+    return [o for o in objects if id(o) not in seen and not seen.add(id(o))]
+
+def _load_many(prop, objects):
+    if not objects:
+        return []
+    prop.computed += len(objects)
+    if prop.batch_loader is None:
+        return [_store(prop.func(o)) for o in objects]
+    values = map(_store, prop.batch_loader(objects))
+    assert len(values) == len(objects), \
+        'batch loader for %s returned %s values for %s objects' % (prop.__name__, len(values), len(objects))
+    return values
+
+
+def prefetch(objects, name):
+    """
+    Compute the lazy property `name` for all `objects` which do not have it
+    yet, with a single call to its batch loader when one is registered (see
+    `lazy.batch`), e.g. one vectorized computation or one database query
+    instead of one per object.
+    """
+    groups = {}
+    for obj in objects:
+        prop = getattr(type(obj), name)
+        groups.setdefault(prop, []).append(obj)
+    for prop, objs in groups.iteritems():
+        prop.prefetch(objs)
+
+
+def test():
+    print 'testing lazy...'
+    import doctest
+    doctest.run_docstring_examples(LazySlot, {'lazyslot': lazyslot}, name='LazySlot')
+
+    calls = []
+    class Word(object):
+        __slots__ = ('text', '_length')
+        def __init__(self, text):
+            self.text = text
+        @lazyslot(lock=True)
+        def length(self):
+            calls.append(self.text)
+            return len(self.text)
+        @length.batch
+        def length(words):
+            calls.append(tuple(w.text for w in words))
+            return [len(w.text) for w in words]
+
+    class Doc(object):
+        def __init__(self, text):
+            self.text = text
+        @lazy
+        def words(self):
+            return self.text.split()
+
+    ws = [Word('a'), Word('bb'), Word('ccc')]
+    assert ws[0].length == 1 and calls == ['a']
+    prefetch(ws + ws, 'length')
+    assert calls == ['a', ('bb', 'ccc')]
+    assert [w.length for w in ws] == [1, 2, 3] and len(calls) == 2
+
+    docs = [Doc('x y'), Doc('z')]
+    prefetch(docs, 'words')
+    assert docs[0].__dict__['words'] == ['x', 'y'] and docs[1].words == ['z']
+
+    # concurrent first access computes once
+    from threading import Thread
+    import time
+    class Slow(object):
+        __slots__ = ('_value',)
+        @lazyslot(lock=True)
+        def value(self):
+            calls.append('slow')
+            time.sleep(0.05)
+            return object()
+    s = Slow()
+    del calls[:]
+    results = []
+    threads = [Thread(target=lambda: results.append(s.value)) for _ in xrange(5)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert calls == ['slow'] and len(set(map(id, results))) == 1
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
@@ -1,56 +1,166 @@
+import os
 import atexit
 import shelve
+import sqlite3
+import weakref
 import cPickle as pickle
+from hashlib import sha1
+from types import CodeType
 from functools import wraps
 
 
-from datetime import datetime, timedelta
+from time import time
+from datetime import timedelta
 from copy import deepcopy
-from threading import RLock
+from heapq import heappush, heappop
+from threading import Lock, Event, Thread, Timer
 
+from eviction import POLICIES
+from registry import CacheInfo, register, qualname, approx_size, _make_key
 
-def timed_cache(seconds=0, minutes=0, hours=0, days=0):
+try:
+    from numpy import ndarray, ascontiguousarray
+except ImportError:
+    ndarray = None
+
+
+class _Flight(object):
+    """ A computation in progress; other callers wanting the same key wait on it. """
+    __slots__ = 'done', 'value', 'error'
+    def __init__(self):
+        self.done = Event()
+        self.value = self.error = None
+
+
+def timed_cache(seconds=0, minutes=0, hours=0, days=0, copy_results=True, stale=0):
+    """
+    cache a function's return value for a limited amount of time.
+
+    Single-flight: concurrent calls which miss on the same key wait for one
+    computation instead of each running the function. Calls for other keys
+    are never blocked by a slow computation.
+
+    `copy_results=False` skips the defensive `deepcopy` on store and on every
+    hit -- use it when callers do not mutate results.
+
+    `stale` (seconds) enables stale-while-revalidate: for that long after an
+    entry expires it is still returned immediately, while a background thread
+    recomputes it.
+
+    Expired entries are freed by a sweep driven by a heap of expiry times. It
+    runs on every miss and can be triggered by hand with `f.sweep()`.
+    """
 
     time_delta = timedelta( seconds=seconds,
                             minutes=minutes,
                             hours=hours,
                             days=days )
+    ttl = time_delta.total_seconds()
+
+    copy = deepcopy if copy_results else (lambda x: x)
 
     def decorate(f):
 
-        f._lock = RLock()
-        f._updates = {}
-        f._results = {}
+        lock = Lock()       # guards the dicts below; never held while computing
+        results = {}        # key -> (value, expiry time)
+        flights = {}        # key -> _Flight
+        expiry = []         # heap of (expiry time, key)
 
-        def do_cache(*args, **kwargs):
+        def store(key, value):
+            t = time() + ttl
+            results[key] = (copy(value), t)
+            heappush(expiry, (t, key))
 
-            lock = f._lock
-            lock.acquire()
+        def sweep():
+            now = time()
+            with lock:
+                while expiry and expiry[0][0] + stale <= now:
+                    t, key = heappop(expiry)
+                    entry = results.get(key)
+                    if entry is not None and entry[1] == t:   # not refreshed since
+                        del results[key]
+                        do_cache.expired += 1
 
+        def compute(key, flight, args, kwargs):
             try:
-                key = (args, tuple(sorted(kwargs.items(), key=lambda i:i[0])))
+                value = f(*args, **kwargs)
+            except BaseException as e:
+                flight.error = e
+                raise
+            else:
+                flight.value = value
+                with lock:
+                    store(key, value)
+                return value
+            finally:
+                with lock:
+                    del flights[key]
+                flight.done.set()
 
-                updates = f._updates
-                results = f._results
+        def refresh(key, flight, args, kwargs):
+            try:
+                compute(key, flight, args, kwargs)
+            except Exception:
+                pass      # keep serving the stale value; the next call retries
 
-                t = datetime.now()
-                updated = updates.get(key, t)
+        @wraps(f)
+        def do_cache(*args, **kwargs):
 
-                if key not in results or t-updated > time_delta:
-                    # Calculate
-                    updates[key] = t
-                    result = f(*args, **kwargs)
-                    results[key] = deepcopy(result)
-                    return result
+            key = _make_key(args, kwargs)
+            now = time()
+            owner = False
 
-                else:
-                    # Cache
-                    return deepcopy(results[key])
+            with lock:
+                entry = results.get(key)
+                if entry is not None and now < entry[1]:
+                    do_cache.hits += 1
+                    return copy(entry[0])
 
-            finally:
-                lock.release()
+                flight = flights.get(key)
+
+                if entry is not None and now < entry[1] + stale:
+                    # serve stale, revalidate in the background
+                    do_cache.hits += 1
+                    if flight is None:
+                        flight = flights[key] = _Flight()
+                        t = Thread(target=refresh, args=(key, flight, args, kwargs))
+                        t.daemon = True
+                        t.start()
+                    return copy(entry[0])
+
+                do_cache.misses += 1
+                if flight is None:
+                    flight = flights[key] = _Flight()
+                    owner = True
 
-        return do_cache
+            if owner:
+                sweep()
+                return compute(key, flight, args, kwargs)
+
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy(flight.value)
+
+        def cache_clear():
+            with lock:
+                results.clear()
+                del expiry[:]
+                do_cache.hits = do_cache.misses = do_cache.expired = 0
+
+        def cache_info():
+            return CacheInfo(do_cache.hits, do_cache.misses, do_cache.expired, None, len(results))
+
+        def cache_bytes():
+            return approx_size(results, value=lambda entry: entry[0])
+
+        do_cache.hits = do_cache.misses = do_cache.expired = 0
+        do_cache.sweep = sweep
+        do_cache.cache_clear = cache_clear
+        do_cache.cache_info = cache_info
+        do_cache.cache_bytes = cache_bytes
+        do_cache._results = results
+        return register(do_cache, qualname(f), 'timed_cache')
 
     return decorate
 
@@ -73,53 +183,214 @@ if __name__ == "__main__":
 """
 
 class ShelfBasedCache(object):
-    """ cache a function's return value to avoid recalulation and save cache in a shelve. """
-    def __init__(self, func, key, None_is_bad=False):
+    """
+    cache a function's return value to avoid recalulation and save cache in a shelve.
+
+    Write-behind: new entries are buffered and written out (followed by a
+    single `sync`) once `flush_every` entries are pending or `flush_interval`
+    seconds have passed since the first of them was stored, whichever comes
+    first; a daemon timer does the time-based flush, so it happens even if no
+    further calls arrive. Pending entries are always flushed at exit. The
+    default, `flush_every=1`, writes through on every miss.
+
+    `shared=True` stores the cache in sqlite instead of a shelf, so several
+    processes can read and write the same cache file safely. The connection
+    is opened on first use in each process, so a cache created before a
+    `multiprocessing.Pool` forks works in all the workers.
+    """
+    def __init__(self, func, key, None_is_bad=False, flush_every=1, flush_interval=None, shared=False):
         self.func = func
-        self.filename = '{self.func.__name__}.shelf~'.format(self=self)
-        self.cache = shelve.open(self.filename) #, writeback=True)
+        self.shared = shared
+        self._pid = None
+        if shared:
+            self.filename = '{self.func.__name__}.sqlite~'.format(self=self)
+            self._store = None          # this process's _SqliteStore
+        else:
+            self.filename = '{self.func.__name__}.shelf~'.format(self=self)
+            self._store = shelve.open(self.filename) #, writeback=True)
         self.key = key
         self.None_is_bad = None_is_bad
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.last_flush = time()
+        self.timer = None
+        self.lock = Lock()
+        self.hits = self.misses = 0
         self.__name__ = 'ShelfBasedCache(%s)' % func.__name__
+        atexit.register(self.flush)
+        register(self, qualname(func))
     def __call__(self, *args):
         p_args = self.key(args)
         value = None
         recompute = True
-        if self.cache.has_key(p_args):
+        try:
+            value = self.lookup(p_args)
+        except KeyError:
+            pass
+        else:
             recompute = False
-            value = self.cache[p_args]
-            if value is None and self.None_is_bad:
-                recompute = True
+        if value is None and self.None_is_bad:
+            recompute = True
         if recompute:
-            self.cache[p_args] = value = self.func(*args)
-            self.cache.sync()
+            self.misses += 1
+            value = self.func(*args)
+            self.store(p_args, value)
+        else:
+            self.hits += 1
         return value
+    @property
+    def cache(self):
+        """ The shelf, or this process's connection to the sqlite store. """
+        if self.shared and self._pid != os.getpid():
+            # connections can not be carried across a fork; open our own
+            self._pid = os.getpid()
+            self._store = _SqliteStore(self.filename, '')
+        return self._store
+    def lookup(self, p_args):
+        """ Stored value for an already-keyed argument tuple; raises KeyError. """
+        with self.lock:
+            try:
+                return self.pending[p_args]
+            except KeyError:
+                return self.cache[p_args]
+    def store(self, p_args, value):
+        with self.lock:
+            self.pending[p_args] = value
+            if (len(self.pending) >= self.flush_every
+                or (self.flush_interval is not None
+                    and time() - self.last_flush >= self.flush_interval)):
+                self._flush()
+            elif self.flush_interval is not None and self.timer is None:
+                self.timer = Timer(self.flush_interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+    def flush(self):
+        """ Write all pending entries to disk. """
+        with self.lock:
+            self._flush()
+    def close(self):
+        with self.lock:
+            self._flush()
+            if not self.shared:
+                self._store.close()
+            elif self._pid == os.getpid():
+                self._store.close()
+                self._pid = self._store = None
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, 0, None, None)
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.pending:
+            self.cache.update(self.pending)
+            self.cache.sync()
+            self.pending.clear()
+        self.last_flush = time()
 
-def persistent_cache(key, None_is_bad=False):
+def persistent_cache(key, None_is_bad=False, **kwargs):
     def wrap(f):
-        return ShelfBasedCache(f, key, None_is_bad=None_is_bad)
+        return ShelfBasedCache(f, key, None_is_bad=None_is_bad, **kwargs)
     return wrap
 
 
+_fingerprints = {}    # id(read-only array) -> (weakref, fingerprint)
+
+def _forget(i):
+    return lambda ref: _fingerprints.pop(i, None)
+
+def _fingerprint(x):
+    try:
+        hash(x)
+        return x
+    except TypeError:
+        pass
+    if isinstance(x, tuple):
+        return tuple(map(_fingerprint, x))
+    if isinstance(x, list):
+        return (list, tuple(map(_fingerprint, x)))
+    if isinstance(x, dict):
+        return (dict, tuple(sorted((k, _fingerprint(v)) for k, v in x.iteritems())))
+    if isinstance(x, (set, frozenset)):
+        return (set, frozenset(map(_fingerprint, x)))
+    if ndarray is not None and isinstance(x, ndarray):
+        return _array_fingerprint(x)
+    raise TypeError('unhashable type: %r' % type(x).__name__)
+
+def _array_fingerprint(x):
+    # read-only arrays which own their data can not change under us, so the
+    # fingerprint is remembered by identity.
+    frozen = x.flags.owndata and not x.flags.writeable
+    if frozen:
+        try:
+            ref, fp = _fingerprints[id(x)]
+            if ref() is x:
+                return fp
+        except KeyError:
+            pass
+    if x.dtype.hasobject:
+        fp = (ndarray, x.shape, tuple(map(_fingerprint, x.flat)))
+    else:
+        # hash the raw buffer in place; only non-contiguous arrays get copied.
+        data = x if x.flags.c_contiguous else ascontiguousarray(x)
+        fp = (ndarray, x.dtype.str, x.shape, sha1(data.data).digest())
+    if frozen:
+        _fingerprints[id(x)] = (weakref.ref(x, _forget(id(x))), fp)
+    return fp
+
+def content_key(args, kwargs=None):
+    """
+    Cache key which also works for unhashable arguments: lists, dicts, sets
+    and NumPy arrays are replaced by a fingerprint of their contents (arrays
+    by a SHA-1 of their raw buffer). Hashable arguments are used as-is, so
+    calls with only hashable arguments pay for a single `hash`.
+
+    Note: the key reflects the contents at call time. Mutating an argument
+    afterwards does not affect the cached result.
+    """
+    key = _make_key(args, kwargs) if kwargs else args
+    try:
+        hash(key)
+        return key
+    except TypeError:
+        return _fingerprint(key)
+
+
 # TODO:
 #  * add option to pass a reference to another cache (maybe memcached client)
 class memoize(object):
-    """ cache a function's return value to avoid recalulation """
-    def __init__(self, func):
+    """
+    cache a function's return value to avoid recalulation
+
+    By default arguments must be hashable; pass `key=content_key` (or use
+    `content_memoize`) to cache calls with list, dict or array arguments.
+    """
+    def __init__(self, func, key=None):
         self.func = func
+        self.keyfunc = key
         self.cache = {}
+        self.hits = self.misses = 0
         try:
             self.__name__ = func.__name__
             self.__doc__ = func.__doc__
         except AttributeError:
             pass
-    def __call__(self, *args):
+        register(self, qualname(func))
+    def __call__(self, *args, **kwargs):
+        if self.keyfunc is None:
+            key = _make_key(args, kwargs) if kwargs else args
+        else:
+            key = self.keyfunc(args, kwargs)
         try:
-            return self.cache[args]
+            value = self.cache[key]
+            self.hits += 1
+            return value
         except KeyError:
-            value = self.func(*args)
+            self.misses += 1
+            value = self.func(*args, **kwargs)
             try:
-                self.cache[args] = value
+                self.cache[key] = value
             except TypeError:
                 # uncachable -- for instance, passing a list as an argument.
                 raise TypeError('uncachable arguments %r passed to memoized function.' % (args,))
@@ -127,9 +398,218 @@ class memoize(object):
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
             raise TypeError('uncachable arguments %r passed to memoized function.' % (args,))
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, 0, None, len(self.cache))
+    def cache_clear(self):
+        self.cache.clear()
+        self.hits = self.misses = 0
+    def cache_bytes(self):
+        return approx_size(self.cache)
     def __repr__(self):
         return '<memoize(%r)>' % self.func
 
+def content_memoize(func):
+    return memoize(func, key=content_key)
+
+
+class BoundedCache(object):
+    """
+    cache a function's return value, holding at most `maxsize` results. When
+    full, entries are evicted according to `policy`, one of 'lru', 'lfu' or
+    'arc' (see cache/eviction.py).
+
+    Thread-safe: bookkeeping happens under a lock, but the wrapped function is
+    called outside of it, so a slow computation does not block hits. Two
+    threads missing on the same key may both compute it.
+
+    `key` is an optional `key(args, kwargs)` function, e.g. `content_key`.
+    """
+    def __init__(self, func, maxsize=1024, policy='lru', key=None):
+        self.func = func
+        self.keyfunc = key
+        self.maxsize = maxsize
+        self.policy = POLICIES[policy](maxsize)
+        self.cache = {}
+        self.lock = Lock()
+        self.hits = self.misses = self.evictions = 0
+        try:
+            self.__name__ = func.__name__
+            self.__doc__ = func.__doc__
+        except AttributeError:
+            pass
+        register(self, qualname(func))
+
+    def __call__(self, *args, **kwargs):
+        if self.keyfunc is None:
+            key = _make_key(args, kwargs) if kwargs else args
+        else:
+            key = self.keyfunc(args, kwargs)
+        cache = self.cache
+        with self.lock:
+            try:
+                value = cache[key]
+            except KeyError:
+                pass
+            except TypeError:
+                raise TypeError('uncachable arguments %r passed to memoized function.' % (args,))
+            else:
+                self.policy.hit(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = self.func(*args, **kwargs)
+
+        with self.lock:
+            if key not in cache:          # another thread may have beaten us
+                cache[key] = value
+                for k in self.policy.miss(key):
+                    del cache[k]
+                    self.evictions += 1
+        return value
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            for k in self.policy.resize(maxsize):
+                del self.cache[k]
+                self.evictions += 1
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.maxsize, len(self.cache))
+
+    def cache_bytes(self):
+        return approx_size(self.cache)
+
+    def cache_clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.policy.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def __repr__(self):
+        return '<BoundedCache(%r, maxsize=%r)>' % (self.func, self.maxsize)
+
+def bounded_memoize(maxsize=1024, policy='lru', key=None):
+    def wrap(f):
+        return BoundedCache(f, maxsize=maxsize, policy=policy, key=key)
+    return wrap
+
+
+def code_hash(func):
+    """
+    Fingerprint of a function's code (bytecode, constants and referenced
+    names, recursing into nested functions). Changes whenever the function
+    body is edited, so it can be used to invalidate persisted results.
+    """
+    code = getattr(func, '__code__', None)
+    if code is None:
+        return ''
+    h = sha1()
+    def visit(code):
+        h.update(code.co_code)
+        h.update(repr(code.co_names))
+        for c in code.co_consts:
+            if isinstance(c, CodeType):
+                visit(c)
+            else:
+                h.update(repr(c))
+    visit(code)
+    return h.hexdigest()
+
+
+def _canonical(x):
+    """
+    Equal arguments pickle differently when their types differ (1, 1L, 1.0
+    and True; 'a' and u'a'). Map numbers with integral values to int and
+    ASCII unicode to str, inside tuples too, so that equal arguments share a
+    stored key the way they share a dict key. Other types must pickle alike
+    when equal.
+    """
+    if isinstance(x, tuple):
+        return tuple(_canonical(y) for y in x)
+    if isinstance(x, (bool, int, long)):
+        return int(x)
+    if isinstance(x, float) and x.is_integer():
+        return int(x)
+    if isinstance(x, unicode):
+        try:
+            return x.encode('ascii')
+        except UnicodeEncodeError:
+            return x
+    return x
+
+
+def _store_key(args):
+    return sqlite3.Binary(pickle.dumps(_canonical(args), 2))
+
+
+class _SqliteStore(object):
+    """
+    Append-as-you-go storage for `memoize_persistent`. Each result is written
+    in its own (WAL-journaled) transaction as soon as it is computed, so a
+    crash loses at most the call in progress, and lookups only read the rows
+    they need.
+    """
+
+    def __init__(self, filename, version):
+        self.filename = os.path.abspath(filename)
+        self.version = version
+        self.lock = Lock()
+        self.con = self._connect()
+        self.con.execute('create table if not exists cache '
+                         '(version text, key blob, value blob, primary key (version, key))')
+        self.con.commit()
+        self.compactor = Thread(target=self.compact)
+        self.compactor.daemon = True
+        self.compactor.start()
+
+    def _connect(self):
+        con = sqlite3.connect(self.filename, timeout=60, check_same_thread=False)
+        con.execute('pragma journal_mode=wal')
+        con.execute('pragma synchronous=normal')
+        return con
+
+    def __getitem__(self, args):
+        with self.lock:
+            rows = self.con.execute('select value from cache where version=? and key=?',
+                                    (self.version, _store_key(args))).fetchall()
+        if not rows:
+            raise KeyError(args)
+        return pickle.loads(str(rows[0][0]))
+
+    def __setitem__(self, args, value):
+        with self.lock:
+            self.con.execute('insert or replace into cache (version, key, value) values (?,?,?)',
+                             (self.version, _store_key(args),
+                              sqlite3.Binary(pickle.dumps(value, 2))))
+            self.con.commit()
+
+    def update(self, items):
+        """ Write many entries in one transaction. """
+        with self.lock:
+            self.con.executemany('insert or replace into cache (version, key, value) values (?,?,?)',
+                                 [(self.version, _store_key(k),
+                                   sqlite3.Binary(pickle.dumps(v, 2)))
+                                  for k, v in items.iteritems()])
+            self.con.commit()
+
+    def sync(self):
+        pass     # every write is committed immediately
+
+    def close(self):
+        self.con.close()
+
+    def compact(self):
+        """ Drop entries written by other versions of the function and shrink the log. """
+        con = self._connect()
+        try:
+            con.execute('delete from cache where version != ?', (self.version,))
+            con.commit()
+            con.execute('pragma wal_checkpoint(passive)')
+        finally:
+            con.close()
+
 
 ## TODO: automatically make a back-up of the pickle
 class memoize_persistent(object):
@@ -137,17 +617,30 @@ class memoize_persistent(object):
     cache a function's return value to avoid recalulation and save the
     cache (via pickle) at system exit so that it persists.
 
-    WARNING: retrieves cache for functions which might not be equivalent
-             if a revision is made to the code which is used to compute it.
+    Cached results are tagged with a hash of the function's code, so editing
+    the function invalidates them (functions it calls are not covered).
+
+    With `storage='sqlite'` results are written to disk as they are computed
+    and read back lazily, one key at a time, instead of being pickled as a
+    whole at exit. Stale entries are compacted away in a background thread.
+    See also `incremental_memoize`.
     """
-    def __init__(self, func, filename=None):
+    def __init__(self, func, filename=None, storage='pickle'):
+        assert storage in ('pickle', 'sqlite'), storage
         self.func = func
-        self.filename = filename or '{self.func.__name__}.cache.pkl~'.format(self=self)
+        self.storage = storage
+        if storage == 'sqlite':
+            self.filename = filename or '{self.func.__name__}.cache.sqlite~'.format(self=self)
+        else:
+            self.filename = filename or '{self.func.__name__}.cache.pkl~'.format(self=self)
+            atexit.register(self.save)
         self.dirty = False
-        self.key = 0
+        self.key = code_hash(func)
         self.cache = {}
+        self.store = None
         self.loaded = False
-        atexit.register(self.save)
+        self.hits = self.misses = 0
+        register(self, qualname(func))
 
     def save(self):
         if self.cache and self.dirty:
@@ -158,6 +651,9 @@ class memoize_persistent(object):
 
     def load(self):
         self.loaded = True
+        if self.storage == 'sqlite':
+            self.store = _SqliteStore(self.filename, self.key)
+            return
         loaded_key = None
         try:
             (cache, loaded_key) = pickle.load(file(self.filename,'r'))
@@ -176,8 +672,18 @@ class memoize_persistent(object):
         if not self.loaded:
             self.load()
         try:
-            return self.cache[args]
+            value = self.cache[args]
+            self.hits += 1
+            return value
         except KeyError:
+            if self.store is not None:
+                try:
+                    value = self.cache[args] = self.store[args]
+                    self.hits += 1
+                    return value
+                except KeyError:
+                    pass
+            self.misses += 1
             value = self.func(*args)
             try:
                 self.cache[args] = value
@@ -186,6 +692,8 @@ class memoize_persistent(object):
                 raise TypeError('uncachable arguments %r passed to memoized function.' % (args,))
             else:
                 self.dirty = True
+                if self.store is not None:
+                    self.store[args] = value
             return value
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
@@ -198,5 +706,235 @@ class memoize_persistent(object):
             self.load()
         if args in self.cache:
             return self.cache[args]
+        elif self.store is not None:
+            try:
+                return self.store[args]
+            except KeyError:
+                pass
+        return None
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, 0, None, len(self.cache))
+
+    def cache_bytes(self):
+        return approx_size(self.cache)
+
+def incremental_memoize(filename=None):
+    def wrap(f):
+        return memoize_persistent(f, filename, storage='sqlite')
+    return wrap
+
+
+def test_memoize():
+    print 'testing memoize...'
+    calls = []
+    @memoize
+    def f(x, y=1):
+        calls.append((x, y))
+        return x + y
+    assert f(1) == f(1) == 2
+    assert f(1, y=2) == f(1, y=2) == 3
+    assert calls == [(1, 1), (1, 2)]
+    assert f.cache_info() == CacheInfo(2, 2, 0, None, 2)
+    try:
+        f([1])
+    except TypeError:
+        pass
+    else:
+        assert False, 'expected TypeError'
+    print 'pass.'
+
+def test_bounded_memoize():
+    print 'testing bounded_memoize...'
+    for policy in POLICIES:
+        calls = []
+        @bounded_memoize(maxsize=2, policy=policy)
+        def g(x, k=0):
+            calls.append(x)
+            return x * 2 + k
+        assert [g(1), g(2), g(1), g(3, k=1)] == [2, 4, 2, 7]
+        info = g.cache_info()
+        assert info.hits == 1 and info.misses == 3 and info.currsize == 2, (policy, info)
+        assert info.evictions == 1
+        g.resize(1)
+        assert g.cache_info().currsize == 1
+        g.cache_clear()
+        assert g.cache_info() == CacheInfo(0, 0, 0, 1, 0)
+        g.resize(0)
+        assert [g(1), g(1)] == [2, 2] and g.cache_info().currsize == 0
+
+        @bounded_memoize(maxsize=0, policy=policy)
+        def h(x):
+            calls.append(x)
+            return x
+        del calls[:]
+        assert [h(1), h(1), h(2)] == [1, 1, 2] and calls == [1, 1, 2]
+        assert h.cache_info().currsize == 0 and h.cache_info().hits == 0
+    print 'pass.'
+
+def test_timed_cache():
+    print 'testing timed_cache...'
+    import time as _time
+
+    calls = []
+    @timed_cache(seconds=0.2)
+    def slow(x):
+        calls.append(x)
+        _time.sleep(0.1)
+        return [x]
+
+    # concurrent misses on one key share a single computation
+    threads = [Thread(target=slow, args=(1,)) for _ in xrange(5)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert calls == [1], calls
+    assert slow(1) == [1] and slow(1) is not slow(1)     # copies by default
+
+    _time.sleep(0.25)
+    slow.sweep()
+    assert not slow._results and slow.expired == 1
+
+    @timed_cache(seconds=0.1, stale=10, copy_results=False)
+    def counter(_n=[0]):
+        _n[0] += 1
+        return _n[0]
+    assert counter() == 1
+    _time.sleep(0.15)
+    assert counter() == 1        # stale value served, refresh kicked off
+    _time.sleep(0.05)
+    assert counter() == 2
+
+    @timed_cache(seconds=10)
+    def boom():
+        raise ValueError
+    for _ in xrange(2):
+        try:
+            boom()
+        except ValueError:
+            pass
         else:
-            return None
+            assert False, 'expected ValueError'
+    assert boom.misses == 2
+
+    print 'pass.'
+
+def test_content_key():
+    print 'testing content_key...'
+    calls = []
+    @content_memoize
+    def total(xs, weights=None):
+        calls.append(1)
+        return sum(xs)
+    assert total([1, 2, 3]) == total([1, 2, 3]) == 6
+    assert total([1, 2, 3], weights={'a': [1]}) == total([1, 2, 3], weights={'a': [1]})
+    assert total((1, 2)) == 3
+    assert len(calls) == 3
+    assert content_key(([1],)) != content_key(((1,),))
+
+    if ndarray is not None:
+        import numpy as np
+        a = np.arange(10.0)
+        assert total(a) == total(a.copy()) == 45 and len(calls) == 4
+        assert total(a[::2]) == 20 and len(calls) == 5
+        assert content_key((a,)) != content_key((a.astype(int),))
+        a.flags.writeable = False
+        assert _array_fingerprint(a) is _array_fingerprint(a)    # identity fast path
+    print 'pass.'
+
+def test_memoize_persistent():
+    print 'testing memoize_persistent (sqlite)...'
+    import os, tempfile
+    filename = tempfile.mktemp()
+    try:
+        calls = []
+        def f(x):
+            calls.append(x)
+            return [x] * 2
+        m = memoize_persistent(f, filename, storage='sqlite')
+        assert m(1) == m(1) == [1, 1] and calls == [1]
+
+        # a fresh instance (e.g. after a crash) reads the entry back lazily
+        m = memoize_persistent(f, filename, storage='sqlite')
+        assert m.get_cached(2) is None
+        assert m(1) == [1, 1] and calls == [1]
+        m = memoize_persistent(f, filename, storage='sqlite')
+        assert m(1.0) == m(1L) == [1, 1] and calls == [1]     # equal arguments, one entry
+
+        # editing the function invalidates its entries
+        def f(x):
+            calls.append(x)
+            return [x] * 3
+        m = memoize_persistent(f, filename, storage='sqlite')
+        assert m(1) == [1, 1, 1] and calls == [1, 1]
+        m.store.compactor.join()
+        rows = m.store.con.execute("select version from cache").fetchall()
+        assert len(rows) == 1, rows
+    finally:
+        m.store.compactor.join()
+        for ext in ('', '-wal', '-shm'):
+            if os.path.exists(filename + ext):
+                os.remove(filename + ext)
+    print 'pass.'
+
+_shared = None      # persistent_cache used from the Pool in test_persistent_cache
+
+def _call_shared(x):
+    return _shared(x), _shared._pid == os.getpid()
+
+def test_persistent_cache():
+    print 'testing persistent_cache...'
+    import os, tempfile
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        for shared in (False, True):
+            calls = []
+            def square(x):
+                calls.append(x)
+                return x * x
+            c = persistent_cache(key=repr, flush_every=3, shared=shared)(square)
+            assert [c(1), c(2), c(1)] == [1, 4, 1] and calls == [1, 2]
+            assert len(c.pending) == 2
+            c(3)
+            assert not c.pending
+            c(4)
+            c.flush()
+            c.close()
+
+            c = persistent_cache(key=repr, shared=shared)(square)
+            assert [c(x) for x in (1, 2, 3, 4)] == [1, 4, 9, 16]
+            assert calls == [1, 2, 3, 4], calls
+
+            if shared:
+                # created and used before the fork; each worker opens its own
+                global _shared
+                from multiprocessing import Pool
+                _shared = c
+                assert c(2) == 4
+                pool = Pool(2)
+                results = pool.map(_call_shared, range(8))
+                pool.close()
+                pool.join()
+                assert results == [(x * x, True) for x in range(8)]
+                assert c(7) == 49 and _shared._pid == os.getpid()
+
+            # pending entries go out on the timer, without another miss
+            import time as _time
+            c = persistent_cache(key=repr, flush_every=100, flush_interval=0.05,
+                                 shared=shared)(square)
+            c(11)
+            assert c.pending
+            _time.sleep(0.3)
+            assert not c.pending and c.timer is None
+            c.close()
+    finally:
+        os.chdir(cwd)
+    print 'pass.'
+
+if __name__ == '__main__':
+    test_persistent_cache()
+    test_memoize_persistent()
+    test_timed_cache()
+    test_memoize()
+    test_content_key()
+    test_bounded_memoize()
@@ -0,0 +1,223 @@
+"""
+Registry of the caches in this package.
+
+Every cache registers itself here when it is created (weakly -- registering
+never keeps a cache alive), which gives one place to answer "which caches are
+hot, how big are they, and what do they cost?":
+
+    >>> from arsenal.cache import registry
+    >>> registry.dump()                          # table on stderr
+    >>> registry.report('*wordnet*')             # list of dicts, JSON-friendly
+    >>> registry.clear('mymodule.*')
+    >>> registry.resize('mymodule.expensive', 10000)
+    >>> registry.install_signal_handler()        # kill -USR1 <pid> dumps
+    >>> registry.serve(8765)                     # GET http://localhost:8765/
+
+A registered cache must provide `cache_info()`, returning a namedtuple with
+(at least) `hits`, `misses`, `evictions`, `maxsize` and `currsize` fields;
+unknown counts are None. It may also provide `cache_clear()`,
+`resize(maxsize)` and `cache_bytes()`.
+
+Names are glob patterns matched against the names caches registered with,
+usually 'module.function'.
+"""
+
+import sys
+import json
+import signal
+import weakref
+import threading
+from collections import namedtuple
+from fnmatch import fnmatch
+from itertools import islice
+from sys import getsizeof
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses evictions maxsize currsize')
+
+_lock = threading.Lock()
+_caches = {}          # id(cache) -> (weakref, name, kind)
+
+
+def qualname(func):
+    return '%s.%s' % (getattr(func, '__module__', None), getattr(func, '__name__', repr(func)))
+
+
+_kwd_mark = object()     # separates positional from keyword arguments in keys
+
+def _make_key(args, kwargs):
+    """ Hashable key for a call, shared by the decorators in this package. """
+    if kwargs:
+        return args + (_kwd_mark,) + tuple(sorted(kwargs.iteritems()))
+    return args
+
+
+def register(cache, name, kind=None):
+    i = id(cache)
+    def forget(ref):
+        with _lock:
+            if i in _caches and _caches[i][0] is ref:
+                del _caches[i]
+    with _lock:
+        _caches[i] = (weakref.ref(cache, forget), name, kind or type(cache).__name__)
+    return cache
+
+
+def unregister(cache):
+    """ Drop a cache from the registry, e.g. one which is a tier of another. """
+    with _lock:
+        _caches.pop(id(cache), None)
+
+
+def caches(pattern='*'):
+    """ (name, kind, cache) for each live registered cache whose name matches. """
+    with _lock:
+        entries = _caches.values()
+    for ref, name, kind in sorted(entries, key=lambda e: e[1]):
+        cache = ref()
+        if cache is not None and fnmatch(name, pattern):
+            yield name, kind, cache
+
+
+def approx_size(mapping, value=None, sample=100):
+    """
+    Approximate memory held by a mapping, in bytes: the container itself plus
+    the (shallow) size of a sample of its items, extrapolated to all of them.
+    `value` extracts the cached value from a stored entry.
+    """
+    n = len(mapping)
+    size = getsizeof(mapping)
+    if n:
+        items = list(islice(mapping.iteritems(), sample))
+        if value is not None:
+            items = [(k, value(v)) for k, v in items]
+        size += sum(getsizeof(k) + getsizeof(v) for k, v in items) * n // len(items)
+    return size
+
+
+def report(pattern='*'):
+    rows = []
+    for name, kind, cache in caches(pattern):
+        row = dict(cache.cache_info()._asdict())
+        if row['hits'] is None or row['misses'] is None:
+            row['hit_ratio'] = None
+        else:
+            calls = row['hits'] + row['misses']
+            row['hit_ratio'] = float(row['hits']) / calls if calls else None
+        row['bytes'] = cache.cache_bytes() if hasattr(cache, 'cache_bytes') else None
+        row['name'] = name
+        row['kind'] = kind
+        rows.append(row)
+    return rows
+
+
+def dump(pattern='*', out=None, sort='bytes'):
+    """ Print a table of cache statistics, largest first. """
+    out = out or sys.stderr
+    rows = sorted(report(pattern), key=lambda r: r[sort] or 0, reverse=True)
+    fmt = '%-50s %-18s %10s %12s %10s %10s %10s %6s'
+    print >> out, fmt % ('name', 'kind', 'entries', 'bytes', 'hits', 'misses', 'evicted', 'ratio')
+    for r in rows:
+        print >> out, fmt % (r['name'][-50:], r['kind'], _fmt(r['currsize']), _fmt(r['bytes']),
+                             _fmt(r['hits']), _fmt(r['misses']), _fmt(r['evictions']),
+                             '-' if r['hit_ratio'] is None else '%.2f' % r['hit_ratio'])
+
+
+def _fmt(x):
+    return '-' if x is None else x
+
+
+def clear(pattern='*'):
+    """ Clear all matching caches which support it; returns how many were cleared. """
+    n = 0
+    for _, _, cache in caches(pattern):
+        if hasattr(cache, 'cache_clear'):
+            cache.cache_clear()
+            n += 1
+    return n
+
+
+def resize(pattern, maxsize):
+    """ Resize all matching caches which support it; returns how many were resized. """
+    n = 0
+    for _, _, cache in caches(pattern):
+        if hasattr(cache, 'resize'):
+            cache.resize(maxsize)
+            n += 1
+    return n
+
+
+def install_signal_handler(signum=signal.SIGUSR1, pattern='*'):
+    """ Dump cache statistics to stderr whenever the process receives `signum`. """
+    signal.signal(signum, lambda s, frame: dump(pattern))
+
+
+def serve(port=8765, host='127.0.0.1'):
+    """
+    Serve `report()` as JSON over HTTP from a daemon thread. The path is used
+    as the name pattern, e.g. GET /mymodule.* ; the root lists everything.
+    """
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = json.dumps(report(self.path.lstrip('/') or '*'), indent=1)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server
+
+
+def test():
+    print 'testing registry...'
+    import gc
+    from cStringIO import StringIO
+    from memoize import memoize, bounded_memoize
+    from LRU import lru_cache
+    # caches register with the imported module, not with a __main__ copy
+    from registry import report, dump, resize, clear
+
+    @memoize
+    def square(x):
+        return x * x
+
+    @bounded_memoize(maxsize=10)
+    def cube(x):
+        return x ** 3
+
+    @lru_cache(maxsize=10)
+    def half(x):
+        return x / 2.0
+
+    for i in xrange(20):
+        square(i % 5); cube(i); half(i % 3)
+
+    rows = dict((r['name'], r) for r in report('*.square') + report('*.cube') + report('*.half'))
+    assert rows['__main__.square']['hits'] == 15 and rows['__main__.square']['currsize'] == 5
+    assert rows['__main__.cube']['evictions'] == 10
+    assert rows['__main__.half']['hit_ratio'] == 17 / 20.0
+    assert all(r['bytes'] > 0 for r in rows.values())
+
+    out = StringIO()
+    dump('__main__.*', out=out)
+    assert '__main__.square' in out.getvalue()
+
+    assert resize('__main__.cube', 2) == 1 and cube.cache_info().currsize == 2
+    assert clear('__main__.*') == 3 and square.cache_info().currsize == 0
+
+    del square
+    gc.collect()
+    assert not report('__main__.square')     # registration is weak
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,194 @@
+"""
+Cache shared by forked worker processes.
+
+The table lives in an anonymous shared memory map, so every process forked
+after the cache is created (e.g. the workers of a `multiprocessing.Pool`)
+reads and inserts into the same memory: a result computed by one worker is a
+hit for all of them, and is held in RAM once.
+
+Layout: `nslots` fixed-size slots grouped into buckets of `ways` slots. A key
+hashes to one bucket; when the bucket is full the least recently used slot
+in it is overwritten, which bounds memory at `nslots * slotsize` bytes.
+
+Each slot is a seqlock -- writers (serialized by one of `nlocks` striped
+locks) make the sequence number odd while they write, and readers, which
+take no lock, treat the slot as a miss if it changed under them.
+
+Keys and values are pickled; entries which do not fit in a slot are simply
+not cached.
+"""
+
+import mmap
+import struct
+import cPickle as pickle
+from time import time
+from functools import wraps
+from multiprocessing import Lock
+
+from memoize import CacheInfo
+from registry import register, qualname
+
+# seq, last access (ms, wraps around), key hash, key length, value length
+HEADER = struct.Struct('<IIqII')
+
+
+def _stamp():
+    return int(time() * 1000) & 0xffffffff
+
+
+class SharedMemoryCache(object):
+    """ Bounded hash table in shared memory, usable across forked processes. """
+
+    def __init__(self, nslots=1 << 16, slotsize=256, ways=8, nlocks=64, name=None):
+        assert slotsize > HEADER.size
+        self.ways = ways
+        self.nbuckets = max(nslots // ways, 1)
+        self.nslots = self.nbuckets * ways
+        self.slotsize = slotsize
+        self.capacity = slotsize - HEADER.size
+        self.mm = mmap.mmap(-1, self.nslots * slotsize)
+        self.locks = [Lock() for _ in xrange(nlocks)]
+        self.hits = self.misses = 0        # per process
+        register(self, name or 'SharedMemoryCache@%x' % id(self))
+
+    def _locate(self, kbytes):
+        h = hash(kbytes) or 1              # hash 0 marks an empty slot
+        b = h % self.nbuckets
+        return h, b, b * self.ways * self.slotsize
+
+    def _read(self, offset, h, kbytes):
+        """ Value bytes stored at `offset` for `kbytes`, or None. Lock-free. """
+        mm = self.mm
+        seq, _, sh, klen, vlen = HEADER.unpack_from(mm, offset)
+        if seq & 1 or sh != h or klen != len(kbytes):
+            return None
+        start = offset + HEADER.size
+        if mm[start:start + klen] != kbytes:
+            return None
+        vbytes = mm[start + klen:start + klen + vlen]
+        if HEADER.unpack_from(mm, offset)[0] != seq:
+            return None                    # overwritten while we were reading
+        return vbytes
+
+    def get(self, key, default=None):
+        kbytes = pickle.dumps(key, 2)
+        h, b, base = self._locate(kbytes)
+        for offset in xrange(base, base + self.ways * self.slotsize, self.slotsize):
+            vbytes = self._read(offset, h, kbytes)
+            if vbytes is not None:
+                # racy, but only ever makes eviction slightly less accurate
+                struct.pack_into('<I', self.mm, offset + 4, _stamp())
+                self.hits += 1
+                return pickle.loads(vbytes)
+        self.misses += 1
+        return default
+
+    def put(self, key, value):
+        """ Insert or replace an entry. Returns False if it is too big to cache. """
+        kbytes = pickle.dumps(key, 2)
+        vbytes = pickle.dumps(value, 2)
+        if len(kbytes) + len(vbytes) > self.capacity:
+            return False
+        h, b, base = self._locate(kbytes)
+        mm = self.mm
+        with self.locks[b % len(self.locks)]:
+            oldest = None
+            for offset in xrange(base, base + self.ways * self.slotsize, self.slotsize):
+                seq, stamp, sh, klen, _ = HEADER.unpack_from(mm, offset)
+                # slots are filled in order and never emptied one at a time,
+                # so the key can not be stored beyond the first empty slot.
+                if sh == 0 or (sh == h and klen == len(kbytes) and
+                               mm[offset + HEADER.size:offset + HEADER.size + klen] == kbytes):
+                    victim = offset
+                    break
+                if oldest is None or stamp < oldest:
+                    lru, oldest = offset, stamp
+            else:
+                victim = lru
+            seq = HEADER.unpack_from(mm, victim)[0]
+            struct.pack_into('<I', mm, victim, (seq + 1) & 0xffffffff)      # odd: busy
+            start = victim + HEADER.size
+            mm[start:start + len(kbytes) + len(vbytes)] = kbytes + vbytes
+            HEADER.pack_into(mm, victim, (seq + 2) & 0xffffffff, _stamp(), h,
+                             len(kbytes), len(vbytes))
+        return True
+
+    def clear(self):
+        for lock in self.locks:
+            lock.acquire()
+        try:
+            self.mm[:] = '\0' * len(self.mm)
+        finally:
+            for lock in self.locks:
+                lock.release()
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, None, self.nslots, len(self))
+
+    def cache_bytes(self):
+        return len(self.mm)
+
+    cache_clear = clear
+
+    def __len__(self):
+        return sum(1 for offset in xrange(0, len(self.mm), self.slotsize)
+                   if HEADER.unpack_from(self.mm, offset)[2] != 0)
+
+
+def shared_cache(nslots=1 << 16, slotsize=256, ways=8, nlocks=64):
+    """
+    Memoize a function in a `SharedMemoryCache`. Decorate at import time (i.e.
+    before the worker pool forks) so that all workers share the table.
+    """
+    def wrap(f):
+        table = SharedMemoryCache(nslots, slotsize, ways, nlocks, name=qualname(f))
+        missing = object()
+        @wraps(f)
+        def wrapper(*args):
+            value = table.get(args, missing)
+            if value is missing:
+                value = f(*args)
+                table.put(args, value)
+            return value
+        wrapper.table = table
+        return wrapper
+    return wrap
+
+
+def test():
+    print 'testing SharedMemoryCache...'
+    from multiprocessing import Process
+
+    c = SharedMemoryCache(nslots=16, slotsize=64, ways=4)
+    assert c.get('a') is None
+    assert c.put('a', [1, 2]) and c.get('a') == [1, 2]
+    assert c.put('a', 3) and c.get('a') == 3 and len(c) == 1
+    assert not c.put('big', 'x' * 100)
+
+    # bounded: a full bucket overwrites its least recently used slot
+    for i in xrange(100):
+        c.put(i, i)
+    assert len(c) <= 16
+
+    # entries inserted by a forked child are visible to the parent
+    c.clear()
+    def child():
+        for i in xrange(4):
+            c.put(('child', i), i * i)
+    p = Process(target=child)
+    p.start()
+    p.join()
+    assert [c.get(('child', i)) for i in xrange(4)] == [0, 1, 4, 9]
+
+    calls = []
+    @shared_cache(nslots=64)
+    def square(x):
+        calls.append(x)
+        return x * x
+    assert square(3) == square(3) == 9 and calls == [3]
+
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
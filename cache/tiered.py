@@ -0,0 +1,175 @@
+"""
+Two-tier cache: a bounded in-memory tier in front of a persistent disk tier.
+
+Stacking `lru_cache` on top of `persistent_cache` by hand means every memory
+miss re-reads and unpickles from the shelf, even for keys the shelf has
+already told us are bad. `tiered_cache` does the lookup in one place:
+
+  1. memory tier (bounded, see cache/eviction.py for the policies),
+  2. disk tier (a `ShelfBasedCache`, so write-behind and `shared=True` work),
+  3. the function itself.
+
+Disk hits are promoted into memory. With `None_is_bad`, keys whose stored
+value is `None` are remembered in memory (negative caching), so they go
+straight to recomputation instead of being probed on disk again.
+
+`f.cache_info()` has the usual CacheInfo fields (`hits` counts both tiers)
+followed by per-tier hit counts and ratios, to help size the memory tier
+from real traffic. Only the tiered cache is in the registry; its disk tier
+is not listed separately.
+"""
+
+from collections import namedtuple
+from threading import Lock
+
+from eviction import POLICIES
+from memoize import ShelfBasedCache
+from registry import register, unregister, qualname, approx_size
+
+TieredInfo = namedtuple('TieredInfo', 'hits misses evictions maxsize currsize '
+                        'memory_hits disk_hits memory_ratio disk_ratio')
+
+_bad = object()     # memory-tier marker: disk holds a value we must not use
+
+
+class TieredCache(object):
+    """ cache a function's return value in memory, backed by a shelve. """
+
+    def __init__(self, func, key, maxsize=1024, policy='lru', None_is_bad=False, **disk_options):
+        self.func = func
+        self.key = key
+        self.maxsize = maxsize
+        self.None_is_bad = None_is_bad
+        self.disk = ShelfBasedCache(func, key, None_is_bad=None_is_bad, **disk_options)
+        unregister(self.disk)       # its __call__ is never used; we count for it
+        self.memory = {}
+        self.policy = POLICIES[policy](maxsize)
+        self.lock = Lock()
+        self.memory_hits = self.disk_hits = self.misses = self.evictions = 0
+        self.__name__ = 'TieredCache(%s)' % func.__name__
+        self.__doc__ = func.__doc__
+        register(self, qualname(func))
+
+    def __call__(self, *args):
+        p_args = self.key(args)
+
+        with self.lock:
+            try:
+                value = self.memory[p_args]
+            except KeyError:
+                value = None
+                probe = True
+            else:
+                self.policy.hit(p_args)
+                if value is not _bad:
+                    self.memory_hits += 1
+                    return value
+                probe = False
+
+        if probe:
+            try:
+                value = self.disk.lookup(p_args)
+            except KeyError:
+                pass
+            else:
+                if value is not None or not self.None_is_bad:
+                    with self.lock:
+                        self.disk_hits += 1
+                        self._promote(p_args, value)
+                    return value
+
+        value = self.func(*args)
+        with self.lock:
+            self.misses += 1
+            if value is None and self.None_is_bad:
+                self._promote(p_args, _bad)
+            else:
+                self._promote(p_args, value)
+                self.disk.store(p_args, value)
+        return value
+
+    def _promote(self, p_args, value):
+        memory = self.memory
+        if p_args in memory:
+            memory[p_args] = value
+            return
+        memory[p_args] = value
+        for k in self.policy.miss(p_args):
+            del memory[k]
+            self.evictions += 1
+
+    def flush(self):
+        self.disk.flush()
+
+    def close(self):
+        self.disk.close()
+
+    def cache_info(self):
+        total = float(self.memory_hits + self.disk_hits + self.misses) or 1.0
+        return TieredInfo(self.memory_hits + self.disk_hits, self.misses,
+                          self.evictions, self.maxsize, len(self.memory),
+                          self.memory_hits, self.disk_hits,
+                          self.memory_hits / total, self.disk_hits / total)
+
+    def cache_bytes(self):
+        """ Approximate size of the memory tier. """
+        return approx_size(self.memory)
+
+    def resize(self, maxsize):
+        with self.lock:
+            self.maxsize = maxsize
+            for k in self.policy.resize(maxsize):
+                del self.memory[k]
+                self.evictions += 1
+
+    def cache_clear(self):
+        """ Empty the memory tier; the disk tier is left alone. """
+        with self.lock:
+            self.memory.clear()
+            self.policy.clear()
+            self.memory_hits = self.disk_hits = self.misses = self.evictions = 0
+
+
+def tiered_cache(key, maxsize=1024, policy='lru', None_is_bad=False, **disk_options):
+    def wrap(f):
+        return TieredCache(f, key, maxsize=maxsize, policy=policy,
+                           None_is_bad=None_is_bad, **disk_options)
+    return wrap
+
+
+def test():
+    print 'testing tiered_cache...'
+    import os, tempfile
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        calls = []
+        def f(x):
+            calls.append(x)
+            return None if x < 0 else x * 10
+
+        c = tiered_cache(key=repr, maxsize=2, None_is_bad=True)(f)
+        assert [c(1), c(2), c(1), c(3)] == [10, 20, 10, 30]
+        assert calls == [1, 2, 3]
+        assert c(2) == 20 and calls == [1, 2, 3]     # evicted from memory, found on disk
+        info = c.cache_info()
+        assert (info.memory_hits, info.disk_hits, info.misses) == (1, 1, 3), info
+        assert info.hits == 2 and info.evictions == 2 and info.currsize == 2
+
+        # one registry row, for the tiered cache, with the usual fields
+        import registry
+        rows = registry.report('*.f')
+        assert [r['kind'] for r in rows] == ['TieredCache'], rows
+        assert (rows[0]['hits'], rows[0]['misses'], rows[0]['evictions']) == (2, 3, 2)
+
+        c(-1); c(-1)
+        assert calls == [1, 2, 3, -1, -1]
+        assert '(-1,)' not in c.disk.cache        # bad values are not persisted
+        c.close()
+    finally:
+        os.chdir(cwd)
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
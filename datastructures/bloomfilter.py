@@ -5,9 +5,62 @@ Bloom filters in Python, using SHA-1 and Python longs.
 My first attempt stored the whole filter in a single arbitrary-size integer,
 but for some reason that was 100x slower than storing it in a bunch of 256-bit
 integers.
+
+`BloomFilter` is the faster engine: bits live in a `bytearray` (viewed as a
+NumPy array for the batch operations when NumPy is available), and the k
+probe positions come from one 128-bit hash split in two, h1 + i*h2
+(Kirsch & Mitzenmacher, "Less hashing, same performance", 2006).
 """
 
-from hashlib import sha1
+import os
+import math
+import mmap
+import struct
+from hashlib import sha1, md5
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import mmh3
+except ImportError:
+    mmh3 = None
+
+_MASK64 = (1 << 64) - 1
+
+def _md5_pair(s):
+    return struct.unpack('<QQ', md5(s).digest())
+
+def _mmh3_pair(s):
+    h1, h2 = mmh3.hash64(s)
+    return h1 & _MASK64, h2 & _MASK64
+
+# name -> function from a byte string to two 64-bit hashes. The name is stored
+# with persisted filters, since bit positions depend on it.
+HASHES = {'md5': _md5_pair}
+if mmh3 is not None:
+    HASHES['mmh3'] = _mmh3_pair
+DEFAULT_HASH = 'mmh3' if mmh3 is not None else 'md5'
+
+# On-disk format: this 64-byte header followed by the raw bit array.
+# magic, nbits, nhashes, count, hash name
+FILE_HEADER = struct.Struct('<8sQIQ16s20x')
+
+
+class _MappedBits(object):
+    """ Read-only byte access to the bit array in a memory map (no NumPy). """
+    def __init__(self, mm, offset, size):
+        self.mm = mm
+        self.offset = offset
+        self.size = size
+    def __getitem__(self, i):
+        return ord(self.mm[self.offset + i])
+    def __len__(self):
+        return self.size
+    def tobytes(self):
+        return self.mm[self.offset:self.offset + self.size]
 
 def nbits_required(n):
     """ Calculate the number of bits required to represent any integer in [0, n). """
@@ -69,6 +122,393 @@ class Bloom:
             hashlong >>= self.hashbits
         return rv
 
+class BloomFilter(object):
+    """
+    Bloom filter backed by a bit array, with double hashing and batch APIs.
+
+    >>> b = BloomFilter.from_capacity(1000, error_rate=0.01)
+    >>> b.add('asdf')
+    >>> 'asdf' in b, 'fdsa' in b
+    (True, False)
+    >>> b.add_many(['foo', 'bar'])
+    >>> b.contains_many(['foo', 'baz'])
+    [True, False]
+
+    Items are byte strings; unicode is encoded as UTF-8.
+
+    `save` writes a compact file (a small header and the raw bits) which
+    `BloomFilter.open` memory-maps read-only and queries in place: opening is
+    O(1), and processes opening the same file share one copy of it in the
+    page cache.
+    """
+
+    FILE_MAGIC = 'BLOOMF01'
+
+    def __init__(self, nbits, nhashes, hash=DEFAULT_HASH, bits=None):
+        self.nbits = nbits
+        self.nhashes = nhashes
+        self.hash = hash
+        self._pair = HASHES[hash]
+        self.count = 0                  # number of add calls, not distinct items
+        if bits is None:
+            bits = bytearray(self._nbytes(nbits))
+        assert len(bits) >= self._nbytes(nbits)
+        self.bits = bits
+        self._array = None
+        if np is not None and not isinstance(bits, _MappedBits):
+            self._array = np.frombuffer(bits, dtype=np.uint8)
+
+    @staticmethod
+    def _nbytes(nbits):
+        return (nbits + 7) // 8
+
+    @classmethod
+    def from_capacity(cls, capacity, error_rate=0.01, **kwargs):
+        """
+        Filter sized so that after `capacity` distinct items the false-positive
+        rate is about `error_rate`: m = -n ln(p) / ln(2)^2 bits and
+        k = (m/n) ln(2) hashes.
+        """
+        nbits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        nhashes = max(1, int(round(float(nbits) / capacity * math.log(2))))
+        return cls(nbits, nhashes, **kwargs)
+
+    def _offsets(self, item):
+        if isinstance(item, unicode):
+            item = item.encode('utf-8')
+        h1, h2 = self._pair(item)
+        m = self.nbits
+        # wrap at 64 bits like the vectorized version does
+        return [((h1 + i * h2) & _MASK64) % m for i in xrange(self.nhashes)]
+
+    def _offsets_many(self, items):
+        """ (len(items), nhashes) array of bit offsets. """
+        pair = self._pair
+        h = np.array([pair(x.encode('utf-8') if isinstance(x, unicode) else x) for x in items],
+                     dtype=np.uint64).reshape(-1, 2)
+        i = np.arange(self.nhashes, dtype=np.uint64)
+        # uint64 arithmetic wraps around, which is fine for hashing.
+        return (h[:, :1] + i * h[:, 1:]) % np.uint64(self.nbits)
+
+    def add(self, item):
+        """ Add a string to the membership of the filter. """
+        bits = self.bits
+        for offset in self._offsets(item):
+            bits[offset >> 3] |= 1 << (offset & 7)
+        self.count += 1
+
+    def __contains__(self, item):
+        """ Returns true if the string is in the filter or it feels like it. """
+        bits = self.bits
+        for offset in self._offsets(item):
+            if not bits[offset >> 3] & (1 << (offset & 7)):
+                return False
+        return True
+
+    def add_many(self, items):
+        if self._array is None:
+            for x in items:
+                self.add(x)
+            return
+        items = list(items)
+        if not items:
+            return
+        offsets = self._offsets_many(items).ravel()
+        np.bitwise_or.at(self._array, (offsets >> np.uint64(3)).astype(np.intp),
+                         np.uint8(1) << (offsets & np.uint64(7)).astype(np.uint8))
+        self.count += len(items)
+
+    def contains_many(self, items):
+        """ Membership of each item, as a list of bools. """
+        if self._array is None:
+            return [x in self for x in items]
+        items = list(items)
+        if not items:
+            return []
+        offsets = self._offsets_many(items)
+        probe = self._array[(offsets >> np.uint64(3)).astype(np.intp)] \
+            & (np.uint8(1) << (offsets & np.uint64(7)).astype(np.uint8))
+        return probe.all(axis=1).tolist()
+
+    def fill_ratio(self):
+        """ Fraction of bits set. """
+        if self._array is not None:
+            ones = int(np.unpackbits(self._array).sum())
+        else:
+            ones = sum(bin(b).count('1') for b in self.bits)
+        return float(ones) / self.nbits
+
+    def error_rate(self):
+        """ Estimated current false-positive rate. """
+        return self.fill_ratio() ** self.nhashes
+
+    def _tobytes(self):
+        if isinstance(self.bits, bytearray):
+            return bytes(self.bits)
+        return self.bits.tobytes()
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(FILE_HEADER.pack(self.FILE_MAGIC, self.nbits, self.nhashes, self.count, self.hash))
+            f.write(self._tobytes())
+
+    @classmethod
+    def open(cls, filename):
+        """ Memory-map a filter written by `save`; the result is read-only. """
+        with open(filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nbits, nhashes, count, hash = FILE_HEADER.unpack_from(mm, 0)
+        if magic != cls.FILE_MAGIC:
+            raise ValueError('%s is not a %s file.' % (filename, cls.__name__))
+        hash = hash.rstrip('\0')
+        if hash not in HASHES:
+            raise ValueError('%s was built with hash %r, which is not available.' % (filename, hash))
+        nbytes = cls._nbytes(nbits)
+        if len(mm) < FILE_HEADER.size + nbytes:
+            raise ValueError('%s is truncated.' % filename)
+        if np is not None:
+            bits = np.frombuffer(mm, dtype=np.uint8, count=nbytes, offset=FILE_HEADER.size)
+        else:
+            bits = _MappedBits(mm, FILE_HEADER.size, nbytes)
+        b = cls(nbits, nhashes, hash, bits)
+        b.count = count
+        b._mmap = mm
+        return b
+
+    def close(self):
+        """ Release the memory map of a filter returned by `open`. """
+        mm = self.__dict__.pop('_mmap', None)
+        if mm is not None:
+            self.bits = self._array = None
+            mm.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_mmap', None)
+        del state['_array'], state['_pair']
+        state['bits'] = self._tobytes()
+        return state
+
+    def __setstate__(self, state):
+        self.__init__(state['nbits'], state['nhashes'], state['hash'], bytearray(state['bits']))
+        self.count = state['count']
+
+
+class ScalableBloomFilter(object):
+    """
+    Bloom filter which grows with the number of items while keeping the
+    false-positive rate bounded (Almeida et al., "Scalable Bloom Filters",
+    2007).
+
+    Items go into a chain of `BloomFilter` slices. When the newest slice
+    reaches its capacity, a new one `growth` times larger is added, with its
+    error rate tightened by `ratio`. The per-slice rates form a geometric
+    series, so the compound false-positive rate stays below `error_rate`,
+    which is kept as `target_error_rate`.
+    """
+
+    def __init__(self, initial_capacity=1000, error_rate=0.001, growth=2, ratio=0.85, hash=DEFAULT_HASH):
+        self.initial_capacity = initial_capacity
+        self.target_error_rate = error_rate
+        self.growth = growth
+        self.ratio = ratio
+        self.hash = hash
+        self.slices = []
+        self.capacities = []
+        self._grow()
+
+    def _grow(self):
+        i = len(self.slices)
+        capacity = self.initial_capacity * self.growth ** i
+        error = self.target_error_rate * (1 - self.ratio) * self.ratio ** i
+        self.slices.append(BloomFilter.from_capacity(capacity, error, hash=self.hash))
+        self.capacities.append(capacity)
+
+    @property
+    def count(self):
+        return sum(b.count for b in self.slices)
+
+    def error_rate(self):
+        """ Estimated current false-positive rate, over all slices. """
+        miss = 1.0
+        for b in self.slices:
+            miss *= 1 - b.error_rate()
+        return 1 - miss
+
+    def __contains__(self, item):
+        for b in reversed(self.slices):    # newest (largest) slice first
+            if item in b:
+                return True
+        return False
+
+    def contains_many(self, items):
+        items = list(items)
+        found = [False] * len(items)
+        for b in self.slices:
+            todo = [i for i, f in enumerate(found) if not f]
+            if not todo:
+                break
+            for i, f in zip(todo, b.contains_many([items[i] for i in todo])):
+                found[i] = f
+        return found
+
+    def add(self, item):
+        """ Add item; returns True if it was (probably) already present. """
+        if item in self:
+            return True
+        if self.slices[-1].count >= self.capacities[-1]:
+            self._grow()
+        self.slices[-1].add(item)
+        return False
+
+    def add_many(self, items):
+        items = list(items)
+        new = [x for x, f in zip(items, self.contains_many(items)) if not f]
+        while new:
+            b = self.slices[-1]
+            room = self.capacities[-1] - b.count
+            if room <= 0:
+                self._grow()
+                continue
+            b.add_many(new[:room])
+            new = new[room:]
+
+
+class CountingBloomFilter(BloomFilter):
+    """
+    Bloom filter which supports removal. Each position holds a 4-bit counter
+    (two per byte) instead of a bit. Counters saturate at 15 and then stay
+    put, so removal never causes false negatives, but items which share a
+    saturated counter can not be fully removed.
+
+    `nbits` is the number of counters. Same API as `BloomFilter`, plus
+    `remove` and `remove_many`.
+    """
+
+    FILE_MAGIC = 'BLOOMC01'
+    MAX = 15
+
+    @staticmethod
+    def _nbytes(nbits):
+        return (nbits + 1) // 2
+
+    def _get(self, offset):
+        return (self.bits[offset >> 1] >> ((offset & 1) << 2)) & 0xf
+
+    def _set(self, offset, value):
+        shift = (offset & 1) << 2
+        i = offset >> 1
+        self.bits[i] = (self.bits[i] & (0xf0 >> shift)) | (value << shift)
+
+    def add(self, item):
+        for offset in self._offsets(item):
+            c = self._get(offset)
+            if c < self.MAX:
+                self._set(offset, c + 1)
+        self.count += 1
+
+    def __contains__(self, item):
+        for offset in self._offsets(item):
+            if not self._get(offset):
+                return False
+        return True
+
+    def remove(self, item):
+        """ Remove one occurrence of item; raises KeyError if it is not present. """
+        # an offset can come up more than once; add bumped it that many times
+        times = {}
+        for offset in self._offsets(item):
+            times[offset] = times.get(offset, 0) + 1
+        if not all(self._get(o) >= n for o, n in times.iteritems()):
+            raise KeyError(item)
+        for offset, n in times.iteritems():
+            c = self._get(offset)
+            if c < self.MAX:
+                self._set(offset, c - n)
+        self.count -= 1
+
+    def _counters(self, offsets):
+        """ Counter values at an array of offsets (NumPy path). """
+        return (self._array[(offsets >> np.uint64(1)).astype(np.intp)]
+                >> ((offsets & np.uint64(1)) << np.uint64(2)).astype(np.uint8)) & np.uint8(0xf)
+
+    def _bump(self, offsets, sign):
+        """ Add `sign` to the (unsaturated) counters at offsets, with repeats. """
+        offsets, times = np.unique(offsets.ravel(), return_counts=True)
+        counters = self._counters(offsets).astype(np.int64)
+        live = counters < self.MAX
+        counters[live] = np.clip(counters[live] + sign * times[live], 0, self.MAX)
+        counters = counters.astype(np.uint8)
+        # low and high nibbles separately, so no byte is assigned twice at once
+        for parity in (0, 1):
+            sel = (offsets & np.uint64(1)) == np.uint64(parity)
+            idx = (offsets[sel] >> np.uint64(1)).astype(np.intp)
+            shift = 4 * parity
+            keep = np.uint8(0xf0 >> shift)
+            self._array[idx] = (self._array[idx] & keep) | (counters[sel] << np.uint8(shift))
+
+    def add_many(self, items):
+        if self._array is None:
+            for x in items:
+                self.add(x)
+            return
+        items = list(items)
+        if items:
+            self._bump(self._offsets_many(items), +1)
+            self.count += len(items)
+
+    def contains_many(self, items):
+        if self._array is None:
+            return [x in self for x in items]
+        items = list(items)
+        if not items:
+            return []
+        return (self._counters(self._offsets_many(items)) > 0).all(axis=1).tolist()
+
+    def remove_many(self, items):
+        """
+        Remove items; raises KeyError (removing nothing) if any is not present.
+        An item listed twice is removed twice, so it must have been added twice.
+        """
+        items = list(items)
+        if self._array is None:
+            # decrements per counter over the whole batch, checked up front
+            times = {}
+            for x in items:
+                for offset in self._offsets(x):
+                    times[offset] = times.get(offset, 0) + 1
+            short = set(o for o, n in times.iteritems() if n > self._get(o) < self.MAX)
+            if short:
+                raise KeyError(next(x for x in items if short.intersection(self._offsets(x))))
+            for offset, n in times.iteritems():
+                c = self._get(offset)
+                if c < self.MAX:
+                    self._set(offset, c - n)
+            self.count -= len(items)
+            return
+        if not items:
+            return
+        offsets = self._offsets_many(items)
+        unique, inverse = np.unique(offsets.ravel(), return_inverse=True)
+        times = np.bincount(inverse)
+        counters = self._counters(unique)
+        short = (counters < times) & (counters < self.MAX)
+        if short.any():
+            bad = short[inverse].reshape(offsets.shape).any(axis=1)
+            raise KeyError(items[int(np.argmax(bad))])
+        self._bump(offsets, -1)
+        self.count -= len(items)
+
+    def fill_ratio(self):
+        """ Fraction of nonzero counters. """
+        if self._array is not None:
+            a = self._array
+            nonzero = int(np.count_nonzero(a & 0xf) + np.count_nonzero(a >> 4))
+        else:
+            nonzero = sum(1 for i in xrange(self.nbits) if self._get(i))
+        return float(nonzero) / self.nbits
+
+
 def test_bloom():
     """ Very basic sanity test for Bloom filter implementation. """
     print 'runnning test_bloom...'
@@ -95,28 +535,180 @@ def test_bloom():
     print 'pass.'
 
 
+def test_bloomfilter():
+    print 'running test_bloomfilter...'
+    import doctest, cPickle, tempfile
+    global np
+    doctest.run_docstring_examples(BloomFilter, globals(), name='BloomFilter')
+
+    words = ['word%d' % i for i in xrange(2000)]
+    others = ['other%d' % i for i in xrange(20000)]
+    for use_numpy in ([True, False] if np is not None else [False]):
+        saved, np = np, (np if use_numpy else None)
+        try:
+            b = BloomFilter.from_capacity(len(words), error_rate=0.01)
+            assert b.nhashes == 7
+            b.add_many(words[:1000])
+            for w in words[1000:]:
+                b.add(w)
+            assert all(b.contains_many(words))
+            assert all(w in b for w in words)
+            fp = sum(b.contains_many(others)) / float(len(others))
+            assert fp < 0.02, fp
+            assert b.contains_many(others) == [w in b for w in others]
+            assert abs(b.error_rate() - 0.01) < 0.005, b.error_rate()
+            b2 = cPickle.loads(cPickle.dumps(b, 2))
+            assert b2.bits == b.bits and b2.contains_many(words[:10]) == [True] * 10
+
+            filename = tempfile.mktemp()
+            try:
+                b.save(filename)
+                assert os.path.getsize(filename) == FILE_HEADER.size + len(b.bits)
+                m = BloomFilter.open(filename)
+                assert (m.nbits, m.nhashes, m.count) == (b.nbits, b.nhashes, b.count)
+                assert all(m.contains_many(words)) and all(w in m for w in words[:100])
+                assert m.contains_many(others) == b.contains_many(others)
+                assert cPickle.loads(cPickle.dumps(m, 2)).bits == b.bits
+                try:
+                    m.add('new')
+                except (TypeError, ValueError):     # read-only
+                    pass
+                else:
+                    assert False, 'expected mapped filter to be read-only'
+                m.close()
+            finally:
+                os.remove(filename)
+        finally:
+            np = saved
+
+    print 'pass.'
+
+
+def test_scalable_bloom():
+    print 'running test_scalable_bloom...'
+    words = ['word%d' % i for i in xrange(5000)]
+    others = ['other%d' % i for i in xrange(20000)]
+
+    b = ScalableBloomFilter(initial_capacity=100, error_rate=0.01)
+    b.add_many(words[:2500])
+    for w in words[2500:]:
+        b.add(w)
+    assert len(b.slices) > 1
+    assert all(b.contains_many(words)) and all(w in b for w in words[::50])
+    assert all(s.count <= c for s, c in zip(b.slices, b.capacities))
+    assert b.add(words[0]) and b.count <= len(words)
+    fp = sum(b.contains_many(others)) / float(len(others))
+    assert fp < 0.01, fp
+    assert b.target_error_rate == 0.01 and 0 < b.error_rate() < 0.01, b.error_rate()
+    assert b.contains_many(others) == [w in b for w in others]
+    print 'pass.'
+
+
+def test_counting_bloom():
+    print 'running test_counting_bloom...'
+    import tempfile
+    global np
+    words = ['word%d' % i for i in xrange(1000)]
+    for use_numpy in ([True, False] if np is not None else [False]):
+        saved, np = np, (np if use_numpy else None)
+        try:
+            b = CountingBloomFilter.from_capacity(len(words), error_rate=0.01)
+            assert len(b.bits) == (b.nbits + 1) // 2
+            b.add_many(words)
+            b.add_many(words[:10])
+            assert all(b.contains_many(words)) and all(w in b for w in words[:10])
+            b.remove_many(words[:500])
+            for w in words[:10]:
+                b.remove(w)
+            # nothing removed can cause a false negative for what is left
+            assert all(b.contains_many(words[500:]))
+            assert sum(b.contains_many(words[:500])) < 25
+            try:
+                b.remove_many(words[:500] + ['never added'])
+            except KeyError:
+                pass
+            else:
+                assert False, 'expected KeyError'
+            assert b.count == len(words) - 500
+
+            c = CountingBloomFilter(8, 1)
+            for _ in xrange(20):
+                c.add('x')
+            for _ in xrange(20):
+                c.remove('x')            # saturated counters stick
+            assert 'x' in c and 0 < c.fill_ratio() <= 1.0 / 8
+
+            # a false positive whose offsets repeat must not wrap a counter
+            c = CountingBloomFilter(3, 3)
+            x = next(w for w in words if len(set(c._offsets(w))) < 3)
+            for o in xrange(3):
+                c._set(o, 1)
+            assert x in c
+            try:
+                c.remove(x)
+            except KeyError:
+                pass
+            else:
+                assert False, 'expected KeyError'
+            assert [c._get(o) for o in xrange(3)] == [1, 1, 1]
+            c.add(x)
+            c.remove(x)
+            assert [c._get(o) for o in xrange(3)] == [1, 1, 1]
+
+            # a batch removing an item twice needs it added twice
+            c = CountingBloomFilter.from_capacity(100, error_rate=0.01)
+            c.add_many(['a', 'b', 'b'])
+            for batch in (['a', 'a'], ['b', 'a', 'b', 'b']):
+                try:
+                    c.remove_many(batch)
+                except KeyError as e:
+                    assert e.args[0] == batch[-1], e
+                else:
+                    assert False, 'expected KeyError'
+            assert c.contains_many(['a', 'b']) == [True, True] and c.count == 3
+            c.remove_many(['b', 'a', 'b'])
+            assert c.count == 0 and c.fill_ratio() == 0
+
+            filename = tempfile.mktemp()
+            try:
+                b.save(filename)
+                m = CountingBloomFilter.open(filename)
+                assert m.contains_many(words) == b.contains_many(words)
+                try:
+                    BloomFilter.open(filename)
+                except ValueError:
+                    pass
+                else:
+                    assert False, 'expected ValueError'
+                m.close()
+            finally:
+                os.remove(filename)
+        finally:
+            np = saved
+    print 'pass.'
+
+
 def misspellings(passage, WORDS):
 
-    import re, cPickle, sys
+    import re, sys
     try:
-        bf = cPickle.load(file('dict.pkl', 'rb'))
+        bf = BloomFilter.open('dict.bloom')
     except IOError:
         # /usr/share/dict/words has 234936 words on this Mac and is 2.4 megs
         print "reading dictionary..."
         words = file(WORDS)
         # 2^21 bits, 8.9 per word, would give us 1.5% false positives with 5
         # hashes or 1.7% with 6, so we use 4194304 = 2^22 bits, or 17.8 per
-        # word, for 0.09% false positives; that's still only half a mebibyte,
-        # although pickle overhead pushes it up to 559K, 22% of the dictionary.
-        bf = Bloom(4194304, 5)  
-        for line in words: 
-            #bf.add(line[:-1].lower())
-            bf.add(line.strip().lower().split('/')[0])
+        # word, for 0.09% false positives; that's still only half a mebibyte.
+        # The file is the raw bits plus a 64 byte header, and is memory-mapped
+        # rather than unpickled on the next run.
+        bf = BloomFilter(4194304, 5)
+        bf.add_many(line.strip().lower().split('/')[0] for line in words)
 
         print 'done reading dictionary'
         try:
-            cPickle.dump(bf, file('dict.pkl', 'wb'), 2)
-        except:
+            bf.save('dict.bloom')
+        except IOError:
             pass
 
     def candidates(word):
@@ -129,17 +721,22 @@ def misspellings(passage, WORDS):
             if word.endswith(suffix):
                 yield word[:-len(suffix)] + repl
 
+    typos = set()
     for word in passage:
         # we drop the "'" because our dictionary has "didnt" but not "didn't"
         for chance in candidates(word.replace("'", '').lower()):
             if chance in bf: break
         else:
-            print 'typo: %r' % word
-            bf.add(word)
+            if word not in typos:
+                print 'typo: %r' % word
+                typos.add(word)
     sys.stdout.write('\n')
 
 if __name__ == '__main__':
     test_bloom()
+    test_bloomfilter()
+    test_scalable_bloom()
+    test_counting_bloom()
 
     import sys
     if sys.platform.startswith('win') or sys.platform == 'nt':
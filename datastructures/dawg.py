@@ -1,7 +1,11 @@
 #!/usr/bin/python
 # By Steve Hanov, 2011. Released to the public domain.
 import sys
+import mmap
 import time
+import struct
+from array import array
+from bisect import bisect_left
 
 class DawgNode(object):
     """
@@ -12,6 +16,8 @@ class DawgNode(object):
     __eq__ functions allow it to be used as a key in a python dictionary.
     """
 
+    __slots__ = ('id', 'final', 'edges')
+
     NextId = 0
 
     def __init__(self):
@@ -26,16 +32,29 @@ class DawgNode(object):
             arr.append("1")
         else:
             arr.append("0")
-        for (label, node) in self.edges.iteritems():
+        for (label, node) in sorted(self.edges.iteritems()):
             arr.append(label)
             arr.append(str(node.id))
         return '_'.join(arr)
 
+    def signature(self):
+        """
+        Tuple of the final flag and the (label, child id) pairs. Children are
+        minimized before their parents, so equal signatures mean equivalent
+        nodes -- and a tuple of small ints hashes far faster than `str(self)`.
+        """
+        sig = [self.final]
+        edges = self.edges
+        for label in sorted(edges):
+            sig.append(label)
+            sig.append(edges[label].id)
+        return tuple(sig)
+
     def __hash__(self):
-        return hash(str(self))
+        return hash(self.signature())
 
     def __eq__(self, other):
-        return str(self) == str(other)
+        return self.signature() == other.signature()
 
 
 class Dawg(object):
@@ -48,7 +67,7 @@ class Dawg(object):
         self.uncheckedNodes = []
 
         # Here is a list of unique nodes that have been checked for
-        # duplication.
+        # duplication, keyed by their signature.
         self.minimizedNodes = {}
 
     def insert(self, word):
@@ -91,12 +110,13 @@ class Dawg(object):
         # proceed from the leaf up to a certain point
         for i in range(len(self.uncheckedNodes) - 1, downTo - 1, -1):
             (parent, letter, child) = self.uncheckedNodes[i]
-            if child in self.minimizedNodes:
+            sig = child.signature()
+            if sig in self.minimizedNodes:
                 # replace the child with the previously encountered one
-                parent.edges[letter] = self.minimizedNodes[child]
+                parent.edges[letter] = self.minimizedNodes[sig]
             else:
                 # add the state to the minimized nodes.
-                self.minimizedNodes[child] = child
+                self.minimizedNodes[sig] = child
             self.uncheckedNodes.pop()
 
     def lookup(self, word):
@@ -107,6 +127,318 @@ class Dawg(object):
             node = node.edges[letter]
         return node.final
 
+    def freeze(self):
+        """
+        Pack the minimized graph into a `FrozenDawg`. Nodes are numbered
+        breadth-first from the root (node 0); the edges of node n are
+        `first[n]:first[n+1]`, sorted by label.
+        """
+        is_unicode = False
+        self.finish()
+        first = array('I', [0])
+        final = bytearray()
+        labels = array('I')
+        targets = array('I')
+        index = {self.root.id: 0}
+        nodes = [self.root]
+        for node in nodes:          # grows as we go
+            final.append(node.final)
+            edges = node.edges
+            for label in sorted(edges):
+                child = edges[label]
+                j = index.get(child.id)
+                if j is None:
+                    j = index[child.id] = len(nodes)
+                    nodes.append(child)
+                labels.append(ord(label))
+                targets.append(j)
+                is_unicode = is_unicode or isinstance(label, unicode)
+            first.append(len(labels))
+        counts = _count_words(first, final, targets)
+        return FrozenDawg(first, final, labels, targets, counts, is_unicode)
+
+
+def _count_words(first, final, targets):
+    """ Number of words reachable from each node (iterative post-order). """
+    n = len(final)
+    counts = array('I', [0]) * n
+    done = bytearray(n)
+    for root in xrange(n - 1, -1, -1):
+        stack = [root]
+        while stack:
+            node = stack[-1]
+            if done[node]:
+                stack.pop()
+                continue
+            children = targets[first[node]:first[node + 1]]
+            pending = [c for c in children if not done[c]]
+            if pending:
+                stack.extend(pending)
+                continue
+            counts[node] = final[node] + sum(counts[c] for c in children)
+            done[node] = 1
+            stack.pop()
+    return counts
+
+
+class _MappedArray(object):
+    """ Read-only access to an array of fixed-size integers in a memory map. """
+    def __init__(self, mm, offset, size, fmt):
+        self.mm = mm
+        self.offset = offset
+        self.size = size
+        self.unpack = struct.Struct(fmt).unpack_from
+        self.itemsize = struct.calcsize(fmt)
+    def __getitem__(self, i):
+        return self.unpack(self.mm, self.offset + i * self.itemsize)[0]
+    def __len__(self):
+        return self.size
+    def tobytes(self):
+        return self.mm[self.offset:self.offset + self.size * self.itemsize]
+
+
+def _tobytes(a):
+    if isinstance(a, array):
+        if sys.byteorder != 'little':
+            a = array(a.typecode, a)
+            a.byteswap()
+        return a.tostring()
+    if isinstance(a, bytearray):
+        return bytes(a)
+    return a.tobytes()
+
+
+# On-disk format: this header followed by the arrays first (nnodes + 1
+# uint32s), labels and targets (nedges uint32s each), counts (nnodes uint32s)
+# and final (nnodes bytes).
+# magic, nnodes, nedges, flags
+FILE_HEADER = struct.Struct('<8sIII')
+FLAG_UNICODE = 1
+
+
+class FrozenDawg(object):
+    """
+    Immutable DAWG stored in four flat arrays instead of Python objects:
+
+      first[n]            index of node n's first edge (node 0 is the root)
+      labels[e]           character code of edge e
+      targets[e]          node edge e leads to
+      counts[n]           number of words below node n (for ranking)
+      final[n]            whether a word ends at node n
+
+    Build one with `Dawg.freeze()`. `save` writes the arrays to a file which
+    `FrozenDawg.open` memory-maps read-only, so opening is O(1) and queries
+    run against the page cache.
+
+    Words are numbered 0..len(d)-1 in sorted order, so `index` and `word`
+    form a minimal perfect hash between the words and their ranks -- a
+    compact stand-in for a large string -> int dictionary:
+
+    >>> d = dawg(['cat', 'cats', 'dog', 'dot']).freeze()
+    >>> d.index('dog'), d.word(3)
+    (2, 'dot')
+    >>> list(d.keys('ca')), list(d.match('do?')), list(d.match('*s'))
+    (['cat', 'cats'], ['dog', 'dot'], ['cats'])
+    """
+
+    FILE_MAGIC = 'DAWG0002'
+
+    def __init__(self, first, final, labels, targets, counts, is_unicode=False):
+        self.first = first
+        self.final = final
+        self.labels = labels
+        self.targets = targets
+        self.counts = counts
+        self.is_unicode = is_unicode
+        self._chr = unichr if is_unicode else chr
+
+    @property
+    def nnodes(self):
+        return len(self.final)
+
+    @property
+    def nedges(self):
+        return len(self.labels)
+
+    def _child(self, node, label):
+        """ Node reached from `node` by the edge labelled `label`, or -1. """
+        lo = self.first[node]
+        hi = self.first[node + 1]
+        e = bisect_left(self.labels, label, lo, hi)
+        if e < hi and self.labels[e] == label:
+            return self.targets[e]
+        return -1
+
+    def _walk(self, word, node=0):
+        for letter in word:
+            node = self._child(node, ord(letter))
+            if node < 0:
+                break
+        return node
+
+    def lookup(self, word):
+        node = self._walk(word)
+        return node >= 0 and bool(self.final[node])
+
+    __contains__ = lookup
+
+    def __len__(self):
+        return self.counts[0]
+
+    def __iter__(self):
+        return self.keys()
+
+    def _edges(self, node):
+        """ (label, target) pairs leaving node, in label order. """
+        labels = self.labels
+        targets = self.targets
+        for e in xrange(self.first[node], self.first[node + 1]):
+            yield labels[e], targets[e]
+
+    def _words(self, node, prefix):
+        """ All words below node, in sorted order, each prepended with prefix. """
+        chr = self._chr
+        stack = [(node, prefix)]
+        while stack:
+            node, word = stack.pop()
+            if self.final[node]:
+                yield word
+            stack.extend((t, word + chr(l)) for l, t in reversed(list(self._edges(node))))
+
+    def keys(self, prefix=''):
+        """ Words starting with prefix, in sorted order. """
+        node = self._walk(prefix)
+        if node < 0:
+            return iter(())
+        return self._words(node, prefix)
+
+    def match(self, pattern):
+        """
+        Words matching a pattern in which '?' stands for any one character
+        and '*' for any run of characters, in sorted order.
+        """
+        # walk the literal prefix directly, then run the pattern as an NFA
+        # whose states are positions in the rest of it.
+        stop = min([i for i in (pattern.find('?'), pattern.find('*')) if i >= 0] or [len(pattern)])
+        prefix, pattern = pattern[:stop], pattern[stop:]
+        node = self._walk(prefix)
+        if node < 0:
+            return
+        n = len(pattern)
+
+        def closure(states):
+            for p in list(states):
+                while p < n and pattern[p] == '*':
+                    p += 1
+                    states.add(p)
+            return frozenset(states)
+
+        def step(states, c):
+            moved = set()
+            for p in states:
+                if p < n:
+                    q = pattern[p]
+                    if q == '*':
+                        moved.add(p)
+                    elif q == '?' or q == c:
+                        moved.add(p + 1)
+            return closure(moved)
+
+        chr = self._chr
+        stack = [(node, prefix, closure(set([0])))]
+        while stack:
+            node, word, states = stack.pop()
+            if n in states and self.final[node]:
+                yield word
+            children = []
+            for l, t in self._edges(node):
+                c = chr(l)
+                s = step(states, c)
+                if s:
+                    children.append((t, word + c, s))
+            stack.extend(reversed(children))
+
+    def index(self, word):
+        """ Rank of word among all words in sorted order; KeyError if absent. """
+        counts = self.counts
+        i = 0
+        node = 0
+        for letter in word:
+            if self.final[node]:
+                i += 1
+            label = ord(letter)
+            for l, t in self._edges(node):
+                if l == label:
+                    node = t
+                    break
+                elif l > label:
+                    raise KeyError(word)
+                i += counts[t]
+            else:
+                raise KeyError(word)
+        if not self.final[node]:
+            raise KeyError(word)
+        return int(i)
+
+    def word(self, i):
+        """ The word with rank i; inverse of `index`. """
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        counts = self.counts
+        chr = self._chr
+        node = 0
+        word = []
+        while True:
+            if self.final[node]:
+                if i == 0:
+                    return ''.join(word)
+                i -= 1
+            for l, t in self._edges(node):
+                if i < counts[t]:
+                    word.append(chr(l))
+                    node = t
+                    break
+                i -= counts[t]
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(FILE_HEADER.pack(self.FILE_MAGIC, self.nnodes, self.nedges,
+                                     FLAG_UNICODE if self.is_unicode else 0))
+            for a in (self.first, self.labels, self.targets, self.counts, self.final):
+                f.write(_tobytes(a))
+
+    @classmethod
+    def open(cls, filename):
+        """ Memory-map a DAWG written by `save`; the result is read-only. """
+        with open(filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nnodes, nedges, flags = FILE_HEADER.unpack_from(mm, 0)
+        if magic != cls.FILE_MAGIC:
+            raise ValueError('%s is not a %s file.' % (filename, cls.__name__))
+        if len(mm) < FILE_HEADER.size + 4 * (2 * nnodes + 1 + 2 * nedges) + nnodes:
+            raise ValueError('%s is truncated.' % filename)
+        offset = FILE_HEADER.size
+        first = _MappedArray(mm, offset, nnodes + 1, '<I')
+        offset += 4 * (nnodes + 1)
+        labels = _MappedArray(mm, offset, nedges, '<I')
+        offset += 4 * nedges
+        targets = _MappedArray(mm, offset, nedges, '<I')
+        offset += 4 * nedges
+        counts = _MappedArray(mm, offset, nnodes, '<I')
+        offset += 4 * nnodes
+        final = _MappedArray(mm, offset, nnodes, 'B')
+        d = cls(first, final, labels, targets, counts, bool(flags & FLAG_UNICODE))
+        d._mmap = mm
+        return d
+
+    def close(self):
+        """ Release the memory map of a DAWG returned by `open`. """
+        mm = self.__dict__.pop('_mmap', None)
+        if mm is not None:
+            self.first = self.final = self.labels = self.targets = self.counts = None
+            mm.close()
+
+
 def dawg(words):
     d = Dawg()
     words.sort()
@@ -125,13 +457,78 @@ def main(dictionary, *queries):
     print "Dawg creation took %g s" % (time.time() - start)
     print "Read %d words into %d nodes and %d edges" % (len(words),
                                                         len(d.minimizedNodes),
-                                                        sum(len(node.edges) for node in d.minimizedNodes))
+                                                        sum(len(node.edges) for node in d.minimizedNodes.itervalues()))
+
+    start = time.time()
+    f = d.freeze()
+    print "Freezing took %g s (%d nodes, %d edges)" % (time.time() - start, f.nnodes, f.nedges)
 
     for word in queries:
-        if not d.lookup(word):
+        if not f.lookup(word):
             print "%s not in dictionary." % word
         else:
             print "%s is in the dictionary." % word
 
+def test():
+    print 'testing dawg...'
+    import os, tempfile, random
+    words = ['cat', 'cats', 'fact', 'facts', 'facet', 'facets', 'a', 'tap', 'taps', 'top', 'tops']
+    rnd = random.Random(0)
+    words += [''.join(rnd.choice('abcdef') for _ in xrange(rnd.randint(1, 8))) for _ in xrange(2000)]
+    words = sorted(set(words))
+    probes = words + [w + 'x' for w in words[::7]] + [w[:-1] for w in words[::5]] + ['', 'zzz']
+
+    d = dawg(list(words))
+    f = d.freeze()
+    assert f.nnodes == len(d.minimizedNodes) + 1
+    assert f.nedges == sum(len(n.edges) for n in d.minimizedNodes.itervalues()) + len(d.root.edges)
+    expect = [d.lookup(w) for w in probes]
+    assert expect == [w in set(words) for w in probes]
+    assert [f.lookup(w) for w in probes] == expect
+
+    def queries(f):
+        import fnmatch, re
+        assert len(f) == len(words) and list(f) == words
+        assert [f.index(w) for w in words] == range(len(words))
+        assert [f.word(i) for i in xrange(len(words))] == words
+        for w in ['', 'zzz', 'ab' + 'x']:
+            try:
+                f.index(w)
+            except KeyError:
+                pass
+            else:
+                assert False, 'expected KeyError'
+        for prefix in ['', 'a', 'fa', 'abc', 'fact', 'q']:
+            assert list(f.keys(prefix)) == [w for w in words if w.startswith(prefix)], prefix
+        for pattern in ['?', 'a?c*', '*s', '*a*b*', 'fac*', 'f*t?', '**', 'cat', 'c?t', '*x']:
+            # fnmatch without [] classes is exactly the ?/* language
+            r = re.compile(fnmatch.translate(pattern))
+            assert list(f.match(pattern)) == [w for w in words if r.match(w)], pattern
+
+    queries(f)
+    import doctest
+    doctest.run_docstring_examples(FrozenDawg, globals(), name='FrozenDawg')
+
+    u = dawg([u'na\xefve', u'caf\xe9', u'cafe']).freeze()
+    assert u.word(1) == u'caf\xe9' and list(u.match(u'*\xef*')) == [u'na\xefve']
+
+    # minimal: 'cat'/'tap' and their plurals share suffix states
+    small = dawg(['cat', 'cats', 'fact', 'facts'])
+    assert len(small.minimizedNodes) == 6, len(small.minimizedNodes)
+
+    filename = tempfile.mktemp()
+    try:
+        f.save(filename)
+        m = FrozenDawg.open(filename)
+        assert (m.nnodes, m.nedges) == (f.nnodes, f.nedges)
+        assert [m.lookup(w) for w in probes] == expect
+        queries(m)
+        m.close()
+    finally:
+        os.remove(filename)
+    print 'pass.'
+
+
 if __name__ == '__main__':
+    test()
     main(*sys.argv[1:])
@@ -1,55 +1,467 @@
 #!/usr/bin/python
-import os, os.path, UserDict
+import os, os.path, UserDict, zlib, threading, time
+from collections import OrderedDict
+from contextlib import contextmanager
 from sqlite3 import dbapi2 as sqlite
 
+if sqlite.sqlite_version_info >= (3, 24, 0):
+    UPSERT = "insert into data (key,value) values (?,?) on conflict(key) do update set value=excluded.value"
+else:
+    UPSERT = "insert or replace into data (key,value) values (?,?)"
+
 class dbdict(UserDict.DictMixin):
-    ''' dbdict, a persistent dictionnary-like object for large datasets '''
+    ''' dbdict, a persistent dictionnary-like object for large datasets
+
+    The database is in WAL mode, so readers do not block the writer. Each
+    assignment is its own transaction unless it happens inside `batch()`:
+
+        with d.batch():
+            for k, v in pairs:
+                d[k] = v            # one commit at the end
+
+    `update` writes all its items in one batch, and `iterkeys`/`iteritems`
+    stream from a cursor instead of loading the whole table.
+
+    Values are stored as raw sqlite types unless a `serializer` -- anything
+    with `dumps` and `loads`, such as cPickle, marshal or json -- is given.
+    The last `cachesize` values read or written are kept in memory (0 turns
+    this off), in their stored form, so with a serializer every read still
+    returns a fresh copy; other processes' writes to the same file are not
+    seen through it, so leave it off for a file with several writers.
+    '''
 
-    def __init__(self,dictName):
+    def __init__(self, dictName, serializer=None, cachesize=128, timeout=5.0):
         self.db_filename = "dbdict_%s.sqlite" % dictName
-        if not os.path.isfile(self.db_filename):
-            self.con = sqlite.connect(self.db_filename)
-            self.con.execute("create table data (key PRIMARY KEY,value)")
+        self.con = sqlite.connect(self.db_filename, timeout=timeout)
+        self.con.execute("pragma journal_mode=wal")
+        self.con.execute("pragma synchronous=normal")
+        self.con.execute("create table if not exists data (key PRIMARY KEY,value)")
+        self.con.commit()
+        self.serializer = serializer
+        self.cachesize = cachesize
+        self.cache = OrderedDict()
+        self.depth = 0              # nesting of batch()
+
+    def _dumps(self, item):
+        if self.serializer is None:
+            return item
+        return sqlite.Binary(self.serializer.dumps(item))
+
+    def _loads(self, value):
+        if self.serializer is None:
+            return value
+        return self.serializer.loads(str(value))
+
+    def _remember(self, key, value):
+        if self.cachesize:
+            cache = self.cache
+            cache.pop(key, None)
+            cache[key] = value
+            if len(cache) > self.cachesize:
+                cache.popitem(last=False)
+
+    def _commit(self):
+        if not self.depth:
+            self.con.commit()
+
+    @contextmanager
+    def batch(self):
+        ''' Group the writes in the block into one transaction. '''
+        self.depth += 1
+        try:
+            yield self
+        except:
+            self.depth -= 1
+            if not self.depth:
+                self.con.rollback()
+                self.cache.clear()
+            raise
         else:
-            self.con = sqlite.connect(self.db_filename)
+            self.depth -= 1
+            self._commit()
 
     def __getitem__(self, key):
-        row = self.con.execute("select value from data where key=?",(key,)).fetchone()
-        if not row: raise KeyError
-        return row[0]
+        try:
+            value = self.cache.pop(key)
+        except KeyError:
+            row = self.con.execute("select value from data where key=?",(key,)).fetchone()
+            if not row: raise KeyError(key)
+            value = row[0]
+        self._remember(key, value)
+        return self._loads(value)
 
     def __setitem__(self, key, item):
-        if self.con.execute("select key from data where key=?",(key,)).fetchone():
-            self.con.execute("update data set value=? where key=?",(item,key))
-        else:
-            self.con.execute("insert into data (key,value) values (?,?)",(key, item))
+        value = self._dumps(item)
+        self.con.execute(UPSERT, (key, value))
+        self._remember(key, value)
+        self._commit()
+
+    def __delitem__(self, key):
+        self.cache.pop(key, None)
+        if not self.con.execute("delete from data where key=?",(key,)).rowcount:
+            raise KeyError(key)
+        self._commit()
+
+    def update(self, other=(), **kwargs):
+        ''' Write all items in one transaction. '''
+        if hasattr(other, 'iteritems'):
+            other = other.iteritems()
+        elif hasattr(other, 'keys'):
+            other = ((k, other[k]) for k in other.keys())
+        with self.batch():
+            for pairs in (other, kwargs.iteritems()):
+                rows = []
+                for key, item in pairs:
+                    value = self._dumps(item)
+                    rows.append((key, value))
+                    self._remember(key, value)
+                self.con.executemany(UPSERT, rows)
+
+    def __contains__(self, key):
+        return key in self.cache or \
+            self.con.execute("select 1 from data where key=?",(key,)).fetchone() is not None
+
+    has_key = __contains__
+
+    def __len__(self):
+        return self.con.execute("select count(*) from data").fetchone()[0]
+
+    def iterkeys(self):
+        for row in self.con.execute("select key from data"):
+            yield row[0]
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        loads = self._loads
+        for key, value in self.con.execute("select key,value from data"):
+            yield key, loads(value)
+
+    def itervalues(self):
+        for _, item in self.iteritems():
+            yield item
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def clear(self):
+        self.con.execute("delete from data")
+        self.cache.clear()
+        self._commit()
+
+    def close(self):
         self.con.commit()
+        self.con.close()
+
+
+_DELETED = object()     # buffered deletion in sharded_dbdict.batch()
+
+
+class sharded_dbdict(UserDict.DictMixin):
+    ''' dbdict whose keys are hashed across `nshards` sqlite files
+
+    Writers to one sqlite file take turns; with the data spread over several
+    files, processes writing different keys mostly hold different locks, and
+    WAL mode lets any number of readers run alongside them.
+
+    sqlite connections can not be shared between threads or carried across a
+    fork, so each thread of each process lazily opens its own connection to
+    each shard -- a sharded_dbdict created before a `multiprocessing.Pool`
+    forks can be used from all the workers.
+
+    `batch()` buffers its writes in memory; when the block ends, each shard
+    is written in its own short transaction, as `update()` does. Holding
+    several shards' write locks at once would let two batching processes
+    wait on each other until sqlite's timeout. Lookups in the block see its
+    buffered writes, but `len` and iteration only see committed data. The
+    read cache is off by default, since other processes write to the same
+    files.
+    '''
+
+    def __init__(self, dictName, nshards=8, serializer=None, cachesize=0, timeout=60.0):
+        self.dictName = dictName
+        self.nshards = nshards
+        self.options = dict(serializer=serializer, cachesize=cachesize, timeout=timeout)
+        self.local = threading.local()
+        self._shards()          # create the files up front
+
+    def __getstate__(self):
+        # connections stay behind; the receiving process opens its own
+        return (self.dictName, self.nshards, self.options)
+
+    def __setstate__(self, state):
+        self.dictName, self.nshards, self.options = state
+        self.local = threading.local()
+
+    def _shards(self):
+        local = self.local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.pid = os.getpid()
+            local.shards = [dbdict("%s.%d" % (self.dictName, i), **self.options)
+                            for i in xrange(self.nshards)]
+        return local.shards
+
+    def _shard(self, key):
+        return self._shards()[self._index(key)]
+
+    def _index(self, key):
+        if isinstance(key, float) and key.is_integer():
+            key = int(key)
+        if isinstance(key, unicode):
+            h = key.encode('utf-8')
+        elif isinstance(key, str):
+            h = key
+        elif isinstance(key, (int, long)):
+            # sqlite finds 1, 1L, 1.0 and True under the same key; so must we
+            h = str(int(key))
+        else:
+            h = repr(key)
+        # stable across processes, unlike hash()
+        return zlib.crc32(h) % self.nshards
+
+    def _pending(self, key):
+        ''' This thread's buffered writes for key's shard, or None outside batch(). '''
+        pending = getattr(self.local, 'pending', None)
+        if pending is not None:
+            return pending.setdefault(self._index(key), {})
+
+    @contextmanager
+    def batch(self):
+        ''' Write the block's writes when it ends, in one transaction per shard. '''
+        local = self.local
+        outer = getattr(local, 'pending', None) is None
+        if outer:
+            local.pending = {}      # shard number -> {key: item or _DELETED}
+        try:
+            yield self
+        except:
+            if outer:
+                local.pending = None
+            raise
+        if outer:
+            pending, local.pending = local.pending, None
+            shards = self._shards()
+            for i, writes in sorted(pending.iteritems()):
+                shard = shards[i]
+                with shard.batch():
+                    for key, item in writes.iteritems():
+                        if item is _DELETED:
+                            shard.cache.pop(key, None)
+                            shard.con.execute("delete from data where key=?", (key,))
+                        else:
+                            shard[key] = item
+
+    def __getitem__(self, key):
+        pending = self._pending(key)
+        if pending is not None and key in pending:
+            item = pending[key]
+            if item is _DELETED:
+                raise KeyError(key)
+            return item
+        return self._shard(key)[key]
+
+    def __setitem__(self, key, item):
+        pending = self._pending(key)
+        if pending is None:
+            self._shard(key)[key] = item
+        else:
+            pending[key] = item
 
     def __delitem__(self, key):
-        if self.con.execute("select key from data where key=?",(key,)).fetchone():
-            self.con.execute("delete from data where key=?",(key,))
-            self.con.commit()
+        pending = self._pending(key)
+        if pending is None:
+            del self._shard(key)[key]
+        elif key not in self:
+            raise KeyError(key)
         else:
-             raise KeyError
+            pending[key] = _DELETED
+
+    def __contains__(self, key):
+        pending = self._pending(key)
+        if pending is not None and key in pending:
+            return pending[key] is not _DELETED
+        return key in self._shard(key)
+
+    has_key = __contains__
+
+    def update(self, other=(), **kwargs):
+        ''' Write all items, in one transaction per shard. '''
+        if hasattr(other, 'iteritems'):
+            other = other.iteritems()
+        elif hasattr(other, 'keys'):
+            other = ((k, other[k]) for k in other.keys())
+        with self.batch():
+            for pairs in (other, kwargs.iteritems()):
+                for key, item in pairs:
+                    self[key] = item
+
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards())
+
+    def iterkeys(self):
+        for shard in self._shards():
+            for key in shard.iterkeys():
+                yield key
+
+    __iter__ = iterkeys
+
+    def iteritems(self):
+        for shard in self._shards():
+            for pair in shard.iteritems():
+                yield pair
+
+    def itervalues(self):
+        for _, item in self.iteritems():
+            yield item
 
     def keys(self):
-        return [row[0] for row in self.con.execute("select key from data").fetchall()]
+        return list(self.iterkeys())
 
+    def items(self):
+        return list(self.iteritems())
 
-if __name__ == '__main__':
+    def values(self):
+        return list(self.itervalues())
+
+    def clear(self):
+        for shard in self._shards():
+            shard.clear()
+
+    def close(self):
+        ''' Close this thread's connections. '''
+        for shard in self.local.__dict__.pop('shards', ()):
+            shard.close()
+        self.local.__dict__.pop('pid', None)
+
+
+def _fill(args):
+    d, lo, hi, pause = args
+    with d.batch():
+        for i in xrange(lo, hi):
+            d[i] = i * i
+            time.sleep(pause)
+    return len(d)
 
-    d = dbdict("mydummydict")
-    d["foo"] = "bar"
 
-    # At this point, foo and bar are *written* to disk.
-    d["John"] = "doh!"
-    d["pi"] = 3.999
-    d["pi"] = 3.14159
+def test():
+    print 'testing dbdict...'
+    import tempfile, cPickle
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    try:
+        d = dbdict("mydummydict")
+        d["foo"] = "bar"
 
-    # You can access your dictionnary later on:
-    d = dbdict("mydummydict")
-    del d["foo"]
+        # At this point, foo and bar are *written* to disk.
+        d["John"] = "doh!"
+        d["pi"] = 3.999
+        d["pi"] = 3.14159
 
-    if "John" in d:
-        print "John is in there !"
-    print d.items()
+        # You can access your dictionnary later on:
+        d = dbdict("mydummydict")
+        del d["foo"]
+        assert "John" in d and "foo" not in d
+        assert sorted(d.items()) == [("John", "doh!"), ("pi", 3.14159)]
+        try:
+            del d["foo"]
+        except KeyError:
+            pass
+        else:
+            assert False, 'expected KeyError'
+
+        # batches commit once, or not at all
+        other = dbdict("mydummydict", cachesize=0)
+        with d.batch():
+            d.update((str(i), i) for i in xrange(1000))
+            d["x"] = 1
+            assert "x" not in other          # not committed yet
+        assert len(other) == 1003 and other["999"] == 999
+        try:
+            with d.batch():
+                d["y"] = 1
+                raise ValueError
+        except ValueError:
+            pass
+        assert "y" not in d and "y" not in other
+
+        # streaming iteration
+        assert sum(1 for _ in d.iterkeys()) == len(d) == len(d.keys())
+        assert dict(d.iteritems())["500"] == 500
+
+        # serialized values
+        p = dbdict("pickled", serializer=cPickle, cachesize=2)
+        p.update(a={'x': [1, 2]}, b=(1, None))
+        p["c"] = set([3])
+        p = dbdict("pickled", serializer=cPickle)
+        assert p["a"] == {'x': [1, 2]} and p["b"] == (1, None) and p["c"] == set([3])
+        assert sorted(p.itervalues()) == sorted([{'x': [1, 2]}, (1, None), set([3])])
+        p["a"]['x'].append(3)            # not written back, so not seen again
+        assert p["a"] == {'x': [1, 2]}
+        p.close()
+
+        # sharded, written from several processes and read from threads
+        from multiprocessing import Pool
+        s = sharded_dbdict("sharded", nshards=4)
+        s.update((u'k%d' % i, i) for i in xrange(100))
+        pool = Pool(4)
+        pool.map(_fill, [(s, lo, lo + 250, 0) for lo in xrange(0, 1000, 250)])
+        pool.close()
+        pool.join()
+        assert len(s) == 1100 and s[999] == 999 * 999 and s[u'k5'] == 5
+        assert s[999L] == s[999.0] == 999 * 999 and s[True] == 1 and 3.0 in s
+        assert all(len(shard) for shard in s._shards())
+        sizes = []
+        def read():
+            sizes.append(sum(1 for k, v in s.iteritems() if k in s))
+            s.close()
+        threads = [threading.Thread(target=read) for _ in xrange(4)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        assert sizes == [1100] * 4
+        try:
+            with s.batch():
+                s['z'] = 1
+                raise ValueError
+        except ValueError:
+            pass
+        assert 'z' not in s
+        with s.batch():
+            s['z'] = 2
+            del s[u'k1']
+            assert s['z'] == 2 and 'z' in s and u'k1' not in s
+            try:
+                del s[u'k1']
+            except KeyError:
+                pass
+            else:
+                assert False, 'expected KeyError'
+            assert 'z' not in s._shard('z')     # not written yet
+        assert s['z'] == 2 and u'k1' not in s and len(s) == 1100
+        del s['z']
+        s[u'k1'] = 1
+
+        # overlapping batches in several processes do not wait on each other
+        c = sharded_dbdict("contended", nshards=4, timeout=2.0)
+        pool = Pool(4)
+        start = time.time()
+        pool.map(_fill, [(c, lo, lo + 200, 0.001) for lo in xrange(0, 800, 200)])
+        pool.close()
+        pool.join()
+        assert len(c) == 800 and time.time() - start < 2.0, time.time() - start
+        assert cPickle.loads(cPickle.dumps(s, 2))[u'k7'] == 7
+        del s[0]
+        assert 0 not in s and len(s) == 1099
+        s.close()
+    finally:
+        os.chdir(cwd)
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
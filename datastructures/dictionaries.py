@@ -50,108 +50,392 @@ class MergeDict(object):
         """Returns a copy of this object."""
         return self.__copy__()
 
+PREV, NEXT, KEY, BLOCK = 0, 1, 2, 3    # names for the link fields
+
+
+class _Block(object):
+    """ A run of consecutive keys in an _OrderIndex. """
+    __slots__ = 'keys', 'pos'
+    def __init__(self, keys, pos):
+        self.keys = keys
+        self.pos = pos              # number of this block in _OrderIndex.blocks
+
+
+class _OrderIndex(object):
+    """
+    Order-statistic index over the keys of a SortedDict: the keys in order,
+    cut into blocks of at most 2 * LOAD, with a Fenwick tree over the block
+    sizes. Each key's link stores its block in the BLOCK field, so the rank
+    of a key and the k-th key are found in O(log n + LOAD), and a key can be
+    inserted or removed anywhere in the same time. Blocks which grow too big
+    are split, and empty ones are dropped; either renumbers the blocks and
+    rebuilds the tree, which is O(n / LOAD) but happens at most once per
+    LOAD inserts or per emptied block.
+    """
+
+    LOAD = 512
+
+    def __init__(self, keys, links):
+        load = self.LOAD
+        keys = list(keys)
+        self.blocks = [_Block(keys[i:i + load], 0) for i in xrange(0, len(keys), load)]
+        for block in self.blocks:
+            for key in block.keys:
+                links[key][BLOCK] = block
+        self._rebuild()
+
+    def _rebuild(self):
+        blocks = self.blocks
+        n = len(blocks)
+        tree = [0] * (n + 1)
+        for i, block in enumerate(blocks):
+            block.pos = i
+            tree[i + 1] = len(block.keys)
+        for i in xrange(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self.tree = tree
+
+    def _add(self, pos, delta):
+        tree = self.tree
+        i = pos + 1
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _split(self, block, links):
+        """ Cut a full block in two, pointing the moved keys at the new one. """
+        half = len(block.keys) // 2
+        new = _Block(block.keys[half:], 0)
+        del block.keys[half:]
+        for key in new.keys:
+            links[key][BLOCK] = new
+        self.blocks.insert(block.pos + 1, new)
+        self._rebuild()
+
+    def insert(self, link, before, links):
+        """ Add link's key in front of the key of link `before` (None: at the end). """
+        if before is None:
+            if not self.blocks:
+                self.blocks.append(_Block([], 0))
+                self._rebuild()
+            block = self.blocks[-1]
+            block.keys.append(link[KEY])
+        else:
+            block = before[BLOCK]
+            block.keys.insert(block.keys.index(before[KEY]), link[KEY])
+        link[BLOCK] = block
+        self._add(block.pos, 1)
+        if len(block.keys) > 2 * self.LOAD:
+            self._split(block, links)
+
+    def remove(self, link):
+        block = link[BLOCK]
+        del block.keys[block.keys.index(link[KEY])]
+        if block.keys:
+            self._add(block.pos, -1)
+        else:
+            del self.blocks[block.pos]
+            self._rebuild()
+
+    def rank(self, link):
+        """ Position of link's key in the order. """
+        block = link[BLOCK]
+        tree = self.tree
+        total = block.keys.index(link[KEY])
+        i = block.pos
+        while i:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, k):
+        """ The k-th (0-based) key. """
+        tree = self.tree
+        pos = 0
+        step = 1 << (len(tree).bit_length() - 1)
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and tree[nxt] <= k:
+                pos = nxt
+                k -= tree[nxt]
+            step >>= 1
+        return self.blocks[pos].keys[k]
+
+
+class _KeyOrder(object):
+    """
+    The keys of a SortedDict, in order: a live view, so getting it is O(1).
+    `len`, iteration and `in` go to the dictionary, and `order[i]` and
+    `order.index(key)` to its order index, in O(log n).
+
+    Changing the view in place (`d.keyOrder.sort()`, or `remove(key)` then
+    `insert(0, key)`) does so on a list of the keys, which is then written
+    back to the dictionary; each such change is O(n).
+    """
+
+    def __init__(self, owner):
+        self._owner = owner
+
+    def __len__(self):
+        return len(self._owner)
+
+    def __iter__(self):
+        return self._owner.iterkeys()
+
+    def __reversed__(self):
+        return reversed(self._owner)
+
+    def __contains__(self, key):
+        return dict.__contains__(self._owner, key)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        return self._owner._key_for_index(index)
+
+    def __getslice__(self, i, j):
+        return list(self)[i:j]
+
+    def index(self, key):
+        if key not in self:
+            raise ValueError('%r is not in list' % (key,))
+        owner = self._owner
+        return owner._order_index().rank(owner._links[key])
+
+    def count(self, key):
+        return int(key in self)
+
+    def __eq__(self, other):
+        return list(self) == (list(other) if isinstance(other, _KeyOrder) else other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __add__(self, other):
+        return list(self) + other
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+def _writes_back(name):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        keys = list(self)
+        result = method(keys, *args, **kwargs)
+        self._owner.keyOrder = keys
+        return self if result is keys else result
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__',
+              '__iadd__', '__imul__', 'append', 'extend', 'insert', 'pop',
+              'remove', 'reverse', 'sort'):
+    setattr(_KeyOrder, _name, _writes_back(_name))
+del _name
+
+
 class SortedDict(dict):
     """
     A dictionary that keeps its keys in the order in which they're inserted.
+
+    The order is a doubly-linked list threaded through a dict of links (as in
+    cache/LRU.py), so deleting a key and `move_to_end` are O(1). Positional
+    access (`value_for_index`, `insert`) builds an order-statistic index (see
+    _OrderIndex) the first time it is needed. From then on it is kept up to
+    date, so positional access, inserts anywhere and deletes all cost
+    O(log n) plus a list operation on one block of at most 1024 keys.
+
+    `keyOrder` is a live view of the keys (see _KeyOrder); changing it in
+    place, or assigning a list of keys to it, reorders the dictionary. Keys
+    left out of an assigned list follow the listed ones in their old order,
+    and a key listed twice goes where it is first listed.
     """
     def __new__(cls, *args, **kwargs):
         instance = super(SortedDict, cls).__new__(cls, *args, **kwargs)
-        instance.keyOrder = []
+        instance._clear_order()
         return instance
 
     def __init__(self, data=None):
         if data is None:
             data = {}
-        super(SortedDict, self).__init__(data)
+        super(SortedDict, self).__init__()
+        self._clear_order()
         if isinstance(data, dict):
-            self.keyOrder = data.keys()
+            for key in data.keys():
+                self[key] = data[key]
         else:
-            self.keyOrder = []
             for key, value in data:
-                if key not in self.keyOrder:
-                    self.keyOrder.append(key)
+                self[key] = value
+
+    def _clear_order(self):
+        root = []
+        root[:] = [root, root, None, None]
+        self._root = root           # sentinel; root[NEXT] is the first key
+        self._links = {}            # key -> [prev, next, key, block]
+        self._index = None          # _OrderIndex, once positions are asked for
+
+    def _link(self, key, before=None):
+        """ Add key to the order in front of the link `before` (default: at the end). """
+        if before is self._root:
+            before = None
+        after = self._root if before is None else before
+        last = after[PREV]
+        link = [last, after, key, None]
+        last[NEXT] = after[PREV] = self._links[key] = link
+        if self._index is not None:
+            self._index.insert(link, before, self._links)
+        return link
+
+    def _unlink(self, key):
+        link = self._links.pop(key)
+        link_prev, link_next = link[PREV], link[NEXT]
+        link_prev[NEXT] = link_next
+        link_next[PREV] = link_prev
+        if self._index is not None:
+            self._index.remove(link)
+
+    def _order_index(self):
+        index = self._index
+        if index is None:
+            index = self._index = _OrderIndex(self.iterkeys(), self._links)
+        return index
+
+    def _key_for_index(self, index):
+        n = len(self._links)
+        if index < 0:
+            index += n
+        if not 0 <= index < n:
+            raise IndexError('list index out of range')
+        return self._order_index().find(index)
+
+    @property
+    def keyOrder(self):
+        return _KeyOrder(self)
+
+    @keyOrder.setter
+    def keyOrder(self, keys):
+        keys = list(keys)
+        for key in keys:
+            if not dict.__contains__(self, key):
+                raise ValueError('keyOrder: %r is not a key.' % (key,))
+        listed = set(keys)
+        keys.extend(key for key in self if key not in listed)
+        self._clear_order()
+        for key in keys:
+            if key not in self._links:
+                self._link(key)
 
     def __deepcopy__(self, memo):
         from copy import deepcopy
         return self.__class__([(key, deepcopy(value, memo))
                                for key, value in self.iteritems()])
 
+    def __reduce__(self):
+        return (self.__class__, (self.items(),))
+
     def __setitem__(self, key, value):
         super(SortedDict, self).__setitem__(key, value)
-        if key not in self.keyOrder:
-            self.keyOrder.append(key)
+        if key not in self._links:
+            self._link(key)
 
     def __delitem__(self, key):
         super(SortedDict, self).__delitem__(key)
-        self.keyOrder.remove(key)
+        self._unlink(key)
 
     def __iter__(self):
-        for k in self.keyOrder:
-            yield k
+        root = self._root
+        link = root[NEXT]
+        while link is not root:
+            yield link[KEY]
+            link = link[NEXT]
+
+    def __reversed__(self):
+        root = self._root
+        link = root[PREV]
+        while link is not root:
+            yield link[KEY]
+            link = link[PREV]
 
     def pop(self, k, *args):
         result = super(SortedDict, self).pop(k, *args)
-        try:
-            self.keyOrder.remove(k)
-        except ValueError:
-            # Key wasn't in the dictionary in the first place. No problem.
-            pass
+        if k in self._links:
+            self._unlink(k)
         return result
 
     def popitem(self):
-        result = super(SortedDict, self).popitem()
-        self.keyOrder.remove(result[0])
-        return result
+        """Removes and returns the most recently inserted (key, value) pair."""
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        key = self._root[PREV][KEY]
+        return key, self.pop(key)
+
+    def move_to_end(self, key, last=True):
+        """Moves an existing key to the end (or, with last=False, the front)."""
+        if key not in self:
+            raise KeyError(key)
+        self._unlink(key)
+        self._link(key, None if last else self._root[NEXT])
 
     def items(self):
-        return zip(self.keyOrder, self.values())
+        return list(self.iteritems())
 
     def iteritems(self):
-        for key in self.keyOrder:
-            yield key, super(SortedDict, self).__getitem__(key)
+        get = super(SortedDict, self).__getitem__
+        for key in self:
+            yield key, get(key)
 
     def keys(self):
-        return self.keyOrder[:]
+        return list(self)
 
     def iterkeys(self):
-        return iter(self.keyOrder)
+        return iter(self)
 
     def values(self):
-        return [super(SortedDict, self).__getitem__(k) for k in self.keyOrder]
+        return list(self.itervalues())
 
     def itervalues(self):
-        for key in self.keyOrder:
-            yield super(SortedDict, self).__getitem__(key)
+        get = super(SortedDict, self).__getitem__
+        for key in self:
+            yield get(key)
 
     def update(self, dict_):
         for k, v in dict_.items():
             self.__setitem__(k, v)
 
     def setdefault(self, key, default):
-        if key not in self.keyOrder:
-            self.keyOrder.append(key)
+        if key not in self._links:
+            self._link(key)
         return super(SortedDict, self).setdefault(key, default)
 
     def value_for_index(self, index):
         """Returns the value of the item at the given zero-based index."""
-        return self[self.keyOrder[index]]
+        return self[self._key_for_index(index)]
 
     def insert(self, index, key, value):
         """Inserts the key, value pair before the item with the given index."""
-        if key in self.keyOrder:
-            n = self.keyOrder.index(key)
-            del self.keyOrder[n]
+        if key in self._links:
+            n = self._order_index().rank(self._links[key])
+            self._unlink(key)
             if n < index:
                 index -= 1
-        self.keyOrder.insert(index, key)
         super(SortedDict, self).__setitem__(key, value)
+        n = len(self._links)
+        if index < 0:
+            index = max(0, index + n)
+        if index < n:
+            self._link(key, self._links[self._key_for_index(index)])
+        else:
+            self._link(key)
 
     def copy(self):
         """Returns a copy of this object."""
         # This way of initializing the copy means it works for subclasses, too.
-        obj = self.__class__(self)
-        obj.keyOrder = self.keyOrder[:]
-        return obj
+        return self.__class__(self)
 
     def __repr__(self):
         """
@@ -162,7 +446,7 @@ class SortedDict(dict):
 
     def clear(self):
         super(SortedDict, self).clear()
-        self.keyOrder = []
+        self._clear_order()
 
 class MultiValueDictKeyError(KeyError):
     pass
@@ -436,3 +720,115 @@ class storage(dict):
         return '<Storage ' + dict.__repr__(self) + '>'
 
 
+def test_sorteddict():
+    print 'testing SortedDict...'
+    import random, cPickle, copy, time
+    rnd = random.Random(0)
+    d = SortedDict()
+    ref = []        # [(key, value)] in order
+    load = _OrderIndex.LOAD
+    _OrderIndex.LOAD = 2        # small blocks, so they split and empty often
+
+    def check():
+        assert d.keys() == [k for k, _ in ref] == d.keyOrder
+        assert d.items() == ref and len(d) == len(ref)
+        assert list(reversed(d)) == [k for k, _ in reversed(ref)]
+
+    def position(key):
+        return [k for k, _ in ref].index(key)
+
+    for step in xrange(3000):
+        op = rnd.randrange(8)
+        key = rnd.randrange(60)
+        if op < 2:
+            d[key] = step
+            if any(k == key for k, _ in ref):
+                ref[position(key)] = (key, step)
+            else:
+                ref.append((key, step))
+        elif op == 2 and key in d:
+            del d[key]
+            del ref[position(key)]
+        elif op == 3:
+            assert d.pop(key, None) == (ref.pop(position(key))[1] if any(k == key for k, _ in ref) else None)
+        elif op == 4 and ref:
+            i = rnd.randrange(-len(ref), len(ref))
+            assert d.value_for_index(i) == ref[i][1]
+        elif op == 5:
+            i = rnd.randint(-len(ref) - 2, len(ref) + 2)
+            d.insert(i, key, step)
+            if any(k == key for k, _ in ref):
+                n = position(key)
+                del ref[n]
+                if n < i:
+                    i -= 1
+            ref.insert(i, (key, step))
+        elif op == 6 and key in d:
+            last = rnd.random() < 0.7
+            d.move_to_end(key, last=last)
+            item = ref.pop(position(key))
+            ref.insert(len(ref) if last else 0, item)
+        elif op == 7 and ref and rnd.random() < 0.2:
+            assert d.popitem() == ref.pop()
+        check()
+    _OrderIndex.LOAD = load
+
+    c = d.copy()
+    c[-1] = 'new'
+    assert -1 not in d and c.keys()[-1] == -1
+    assert cPickle.loads(cPickle.dumps(d, 2)).items() == d.items()
+    assert copy.deepcopy(d).items() == d.items()
+    assert SortedDict([('b', 1), ('a', 2), ('b', 3)]).items() == [('b', 3), ('a', 2)]
+    d.keyOrder = list(reversed(d.keyOrder))
+    ref.reverse()
+    check()
+
+    # changes made through keyOrder reach the dictionary
+    d.keyOrder.sort()
+    ref.sort()
+    check()
+    order = d.keyOrder
+    order.insert(0, order.pop())
+    ref.insert(0, ref.pop())
+    check()
+    try:
+        d.keyOrder.append('missing')
+    except ValueError:
+        pass
+    else:
+        assert False, 'expected ValueError'
+    check()
+    order = d.keyOrder
+    assert order[3] == ref[3][0] and order[-1] == ref[-1][0] and order[1:3] == [k for k, _ in ref[1:3]]
+    assert order.index(ref[4][0]) == 4 and ref[0][0] in order and 'missing' not in order
+    order.reverse()
+    assert order == d.keyOrder == [k for k, _ in reversed(ref)]
+    ref.reverse()
+    check()
+
+    # keyOrder is a view: indexing into it is not a copy of the keys each time
+    d = SortedDict((i, i) for i in xrange(20000))
+    t0 = time.time()
+    assert [d.keyOrder[i] for i in xrange(0, 20000, 4)] == range(0, 20000, 4)
+    assert time.time() - t0 < 1.0, time.time() - t0
+
+    # inserting in the middle keeps the index instead of rebuilding it
+    keys = range(20000)
+    d = SortedDict((i, i) for i in keys)
+    d.value_for_index(0)
+    index = d._index
+    t0 = time.time()
+    for i in xrange(1, 2001):
+        d.insert(i % 3 * 5000, -i, i)
+    assert d._index is index and time.time() - t0 < 1.0, time.time() - t0
+    for i in xrange(1, 2001):
+        keys.insert(i % 3 * 5000, -i)
+    assert d.keys() == keys and d.value_for_index(5000) == d[keys[5000]]
+    assert len(index.blocks) > 20000 // _OrderIndex.LOAD
+    d.clear()
+    assert d.items() == [] and d.keyOrder == []
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test_sorteddict()
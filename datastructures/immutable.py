@@ -124,11 +124,695 @@ class ImmutableDict(object):
 """ 
 
 
-if __name__ == '__main__':
+# Persistent data structures
+#
+# PersistentVector and PersistentMap never change once built; "modifying"
+# one returns a new version which shares all but O(log32 n) nodes with the
+# old one, so keeping many versions around is cheap. Their `transient()`
+# builders mutate nodes in place -- but only nodes they created themselves,
+# so the versions they were made from are unaffected. Nodes carry the
+# `edit` token of the transient which owns them (None once persistent).
+#
+# Both follow Clojure's implementations: Bagwell's hash array mapped trie
+# for the map, and a 32-way radix tree with a separate tail for the vector.
+
+from collections import Mapping, MutableMapping, Sequence
+
+_BITS = 5
+_WIDTH = 1 << _BITS
+_MASK = _WIDTH - 1
+
+
+class _VNode(object):
+    __slots__ = ('edit', 'array')
+    def __init__(self, edit, array):
+        self.edit = edit
+        self.array = array
+
+
+_EMPTY_VNODE = _VNode(None, [])
+
+
+def _editable_vnode(edit, node):
+    if edit is not None and node.edit is edit:
+        return node
+    return _VNode(edit, node.array[:])
+
+
+def _new_path(edit, level, node):
+    while level:
+        node = _VNode(edit, [node])
+        level -= _BITS
+    return node
+
+
+def _push_tail(edit, cnt, level, parent, tailnode):
+    # `cnt` is the count including the elements in `tailnode`
+    parent = _editable_vnode(edit, parent)
+    arr = parent.array
+    subidx = ((cnt - 1) >> level) & _MASK
+    if level == _BITS:
+        child = tailnode
+    elif subidx < len(arr):
+        child = _push_tail(edit, cnt, level - _BITS, arr[subidx], tailnode)
+    else:
+        child = _new_path(edit, level - _BITS, tailnode)
+    if subidx < len(arr):
+        arr[subidx] = child
+    else:
+        arr.append(child)
+    return parent
+
+
+def _do_assoc(edit, level, node, i, val):
+    node = _editable_vnode(edit, node)
+    if level == 0:
+        node.array[i & _MASK] = val
+    else:
+        subidx = (i >> level) & _MASK
+        node.array[subidx] = _do_assoc(edit, level - _BITS, node.array[subidx], i, val)
+    return node
+
+
+def _pop_tail(cnt, level, node):
+    # node without the leaf holding element cnt - 2, or None if that empties it
+    subidx = ((cnt - 2) >> level) & _MASK
+    if level > _BITS:
+        child = _pop_tail(cnt, level - _BITS, node.array[subidx])
+        if child is None and subidx == 0:
+            return None
+        arr = node.array[:subidx]
+        if child is not None:
+            arr.append(child)
+        return _VNode(None, arr)
+    elif subidx == 0:
+        return None
+    return _VNode(None, node.array[:subidx])
+
+
+class _VectorBase(object):
+    """ Read access shared by PersistentVector and TransientVector. """
+
+    def _tailoff(self):
+        cnt = self._cnt
+        return 0 if cnt < _WIDTH else ((cnt - 1) >> _BITS) << _BITS
+
+    def _leaf(self, i):
+        if i >= self._tailoff():
+            return self._tail
+        node = self._root
+        level = self._shift
+        while level:
+            node = node.array[(i >> level) & _MASK]
+            level -= _BITS
+        return node.array
+
+    def _check(self, i):
+        if i < 0:
+            i += self._cnt
+        if not 0 <= i < self._cnt:
+            raise IndexError('vector index out of range')
+        return i
+
+    def __len__(self):
+        return self._cnt
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return PersistentVector(self[j] for j in xrange(*i.indices(self._cnt)))
+        i = self._check(i)
+        return self._leaf(i)[i & _MASK]
+
+    def __iter__(self):
+        for start in xrange(0, self._cnt, _WIDTH):
+            for x in self._leaf(start):
+                yield x
+
+
+class PersistentVector(_VectorBase, Sequence):
+    """
+    Immutable sequence with O(log32 n) `set`, `append` and `pop`, each of
+    which returns a new vector sharing structure with this one.
+
+    >>> v = PersistentVector(range(3))
+    >>> w = v.append(3).set(0, 'x')
+    >>> list(v), list(w), w[-1]
+    ([0, 1, 2], ['x', 1, 2, 3], 3)
+    >>> t = w.transient()
+    >>> t.extend(range(100))
+    >>> t[0] = 'y'
+    >>> u = t.persistent()
+    >>> len(u), u[0], w[0]
+    (104, 'y', 'x')
+    """
+
+    __slots__ = ('_cnt', '_shift', '_root', '_tail')
+
+    def __init__(self, iterable=()):
+        self._cnt, self._shift, self._root, self._tail = 0, _BITS, _EMPTY_VNODE, []
+        t = TransientVector(self)
+        t.extend(iterable)
+        v = t.persistent()
+        self._cnt, self._shift, self._root, self._tail = v._cnt, v._shift, v._root, v._tail
+
+    @classmethod
+    def _make(cls, cnt, shift, root, tail):
+        v = object.__new__(cls)
+        v._cnt, v._shift, v._root, v._tail = cnt, shift, root, tail
+        return v
+
+    def set(self, i, val):
+        """ Copy with element i replaced; i == len(self) appends. """
+        if i == self._cnt:
+            return self.append(val)
+        i = self._check(i)
+        if i >= self._tailoff():
+            tail = self._tail[:]
+            tail[i & _MASK] = val
+            return self._make(self._cnt, self._shift, self._root, tail)
+        return self._make(self._cnt, self._shift,
+                          _do_assoc(None, self._shift, self._root, i, val), self._tail)
+
+    assoc = set
+
+    def append(self, val):
+        """ Copy with val added at the end. """
+        cnt, shift = self._cnt, self._shift
+        if cnt - self._tailoff() < _WIDTH:
+            return self._make(cnt + 1, shift, self._root, self._tail + [val])
+        tailnode = _VNode(None, self._tail)
+        if (cnt >> _BITS) > (1 << shift):
+            # root overflow
+            root = _VNode(None, [self._root, _new_path(None, shift, tailnode)])
+            shift += _BITS
+        else:
+            root = _push_tail(None, cnt, shift, self._root, tailnode)
+        return self._make(cnt + 1, shift, root, [val])
+
+    def pop(self):
+        """ Copy without the last element. """
+        cnt = self._cnt
+        if not cnt:
+            raise IndexError('pop from empty vector')
+        if cnt == 1:
+            return _EMPTY_VECTOR
+        if cnt - self._tailoff() > 1:
+            return self._make(cnt - 1, self._shift, self._root, self._tail[:-1])
+        tail = self._leaf(cnt - 2)
+        shift = self._shift
+        root = _pop_tail(cnt, shift, self._root) or _EMPTY_VNODE
+        if shift > _BITS and len(root.array) == 1:
+            root = root.array[0]
+            shift -= _BITS
+        return self._make(cnt - 1, shift, root, tail)
+
+    def extend(self, iterable):
+        """ Copy with all of iterable added at the end. """
+        t = self.transient()
+        t.extend(iterable)
+        return t.persistent()
+
+    def transient(self):
+        return TransientVector(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, (PersistentVector, list, tuple)):
+            return NotImplemented
+        return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'PersistentVector(%r)' % list(self)
+
+    def __reduce__(self):
+        return (PersistentVector, (list(self),))
+
+
+class TransientVector(_VectorBase):
+    """
+    Mutable builder for a PersistentVector: `append`, `extend` and item
+    assignment work in place. `persistent()` returns the finished vector in
+    O(1); the transient can not be used after that.
+    """
+
+    def __init__(self, vector):
+        self._edit = object()
+        self._cnt = vector._cnt
+        self._shift = vector._shift
+        self._root = _VNode(self._edit, vector._root.array[:])
+        self._tail = vector._tail[:]
+
+    def _ensure(self):
+        if self._edit is None:
+            raise RuntimeError('transient used after persistent()')
+
+    def append(self, val):
+        self._ensure()
+        cnt = self._cnt
+        if cnt - self._tailoff() < _WIDTH:
+            self._tail.append(val)
+        else:
+            edit = self._edit
+            tailnode = _VNode(edit, self._tail)
+            self._tail = [val]
+            if (cnt >> _BITS) > (1 << self._shift):
+                self._root = _VNode(edit, [self._root, _new_path(edit, self._shift, tailnode)])
+                self._shift += _BITS
+            else:
+                self._root = _push_tail(edit, cnt, self._shift, self._root, tailnode)
+        self._cnt = cnt + 1
+
+    def extend(self, iterable):
+        append = self.append
+        for x in iterable:
+            append(x)
+
+    def __setitem__(self, i, val):
+        self._ensure()
+        i = self._check(i)
+        if i >= self._tailoff():
+            self._tail[i & _MASK] = val
+        else:
+            self._root = _do_assoc(self._edit, self._shift, self._root, i, val)
+
+    def persistent(self):
+        self._ensure()
+        self._edit = None
+        return PersistentVector._make(self._cnt, self._shift, self._root, self._tail)
+
+
+_EMPTY_VECTOR = PersistentVector()
+
+
+_NODE = object()        # key slot marker: the value slot holds a child node
+_HASH_MASK = (1 << 64) - 1
+
+
+def _hash(key):
+    return hash(key) & _HASH_MASK
+
+
+def _popcount(x):
+    return bin(x).count('1')
+
 
-    # TODO: add some tests
-    def example():
-        
-        x = ImmutableList([])
+class _HNode(object):
+    """ Bitmap-indexed node: array is [key, value, ...] or [_NODE, child, ...] """
+    __slots__ = ('edit', 'bitmap', 'array')
+    def __init__(self, edit, bitmap, array):
+        self.edit = edit
+        self.bitmap = bitmap
+        self.array = array
 
-    example()
+
+class _CollisionNode(object):
+    """ Keys whose full hashes are equal: array is [key, value, ...] """
+    __slots__ = ('edit', 'hash', 'array')
+    def __init__(self, edit, hash, array):
+        self.edit = edit
+        self.hash = hash
+        self.array = array
+
+
+_EMPTY_HNODE = _HNode(None, 0, [])
+
+
+def _editable_hnode(edit, node):
+    if edit is not None and node.edit is edit:
+        return node
+    if type(node) is _CollisionNode:
+        return _CollisionNode(edit, node.hash, node.array[:])
+    return _HNode(edit, node.bitmap, node.array[:])
+
+
+def _find(node, shift, h, key, default):
+    while True:
+        if type(node) is _CollisionNode:
+            arr = node.array
+            for i in xrange(0, len(arr), 2):
+                if arr[i] is key or arr[i] == key:
+                    return arr[i + 1]
+            return default
+        bit = 1 << ((h >> shift) & _MASK)
+        if not node.bitmap & bit:
+            return default
+        idx = 2 * _popcount(node.bitmap & (bit - 1))
+        k = node.array[idx]
+        if k is _NODE:
+            node = node.array[idx + 1]
+            shift += _BITS
+            continue
+        if k is key or k == key:
+            return node.array[idx + 1]
+        return default
+
+
+def _assoc(edit, node, shift, h, key, val, added):
+    """ node with key -> val; sets added[0] if key was not there before. """
+    if type(node) is _CollisionNode:
+        if h == node.hash:
+            arr = node.array
+            for i in xrange(0, len(arr), 2):
+                if arr[i] is key or arr[i] == key:
+                    if arr[i + 1] is val:
+                        return node
+                    node = _editable_hnode(edit, node)
+                    node.array[i + 1] = val
+                    return node
+            added[0] = True
+            node = _editable_hnode(edit, node)
+            node.array.extend((key, val))
+            return node
+        # nest the collision node in a bitmap node and try again
+        node = _HNode(edit, 1 << ((node.hash >> shift) & _MASK), [_NODE, node])
+        return _assoc(edit, node, shift, h, key, val, added)
+
+    bit = 1 << ((h >> shift) & _MASK)
+    idx = 2 * _popcount(node.bitmap & (bit - 1))
+    if node.bitmap & bit:
+        k = node.array[idx]
+        v = node.array[idx + 1]
+        if k is _NODE:
+            child = _assoc(edit, v, shift + _BITS, h, key, val, added)
+            if child is v:
+                return node
+            node = _editable_hnode(edit, node)
+            node.array[idx + 1] = child
+            return node
+        if k is key or k == key:
+            if v is val:
+                return node
+            node = _editable_hnode(edit, node)
+            node.array[idx + 1] = val
+            return node
+        added[0] = True
+        node = _editable_hnode(edit, node)
+        node.array[idx] = _NODE
+        node.array[idx + 1] = _create_node(edit, shift + _BITS, k, v, h, key, val)
+        return node
+    added[0] = True
+    node = _editable_hnode(edit, node)
+    node.array[idx:idx] = [key, val]
+    node.bitmap |= bit
+    return node
+
+
+def _create_node(edit, shift, k1, v1, h2, k2, v2):
+    h1 = _hash(k1)
+    if h1 == h2:
+        return _CollisionNode(edit, h1, [k1, v1, k2, v2])
+    added = [False]
+    node = _assoc(edit, _EMPTY_HNODE, shift, h1, k1, v1, added)
+    return _assoc(edit, node, shift, h2, k2, v2, added)
+
+
+def _without(edit, node, shift, h, key, removed):
+    """ node without key, or None if that leaves it empty. """
+    if type(node) is _CollisionNode:
+        arr = node.array
+        for i in xrange(0, len(arr), 2):
+            if arr[i] is key or arr[i] == key:
+                removed[0] = True
+                if len(arr) == 2:
+                    return None
+                node = _editable_hnode(edit, node)
+                del node.array[i:i + 2]
+                return node
+        return node
+
+    bit = 1 << ((h >> shift) & _MASK)
+    if not node.bitmap & bit:
+        return node
+    idx = 2 * _popcount(node.bitmap & (bit - 1))
+    k = node.array[idx]
+    v = node.array[idx + 1]
+    if k is _NODE:
+        child = _without(edit, v, shift + _BITS, h, key, removed)
+        if child is v:
+            return node
+        if child is not None:
+            node = _editable_hnode(edit, node)
+            node.array[idx + 1] = child
+            return node
+    elif not (k is key or k == key):
+        return node
+    else:
+        removed[0] = True
+    if node.bitmap == bit:
+        return None
+    node = _editable_hnode(edit, node)
+    del node.array[idx:idx + 2]
+    node.bitmap ^= bit
+    return node
+
+
+def _iter_nodes(root):
+    """ (key, value) pairs below root. """
+    stack = [root]
+    while stack:
+        arr = stack.pop().array
+        for i in xrange(0, len(arr), 2):
+            if arr[i] is _NODE:
+                stack.append(arr[i + 1])
+            else:
+                yield arr[i], arr[i + 1]
+
+
+_missing = object()
+
+
+class _MapBase(object):
+    """ Read access shared by PersistentMap and TransientMap. """
+
+    def __len__(self):
+        return self._cnt
+
+    def __getitem__(self, key):
+        val = _find(self._root, 0, _hash(key), key, _missing)
+        if val is _missing:
+            raise KeyError(key)
+        return val
+
+    def get(self, key, default=None):
+        return _find(self._root, 0, _hash(key), key, default)
+
+    def __contains__(self, key):
+        return _find(self._root, 0, _hash(key), key, _missing) is not _missing
+
+    def __iter__(self):
+        for k, _ in _iter_nodes(self._root):
+            yield k
+
+    def iteritems(self):
+        return _iter_nodes(self._root)
+
+    def itervalues(self):
+        for _, v in _iter_nodes(self._root):
+            yield v
+
+    iterkeys = __iter__
+
+
+class PersistentMap(_MapBase, Mapping):
+    """
+    Immutable mapping (a hash array mapped trie) with O(log32 n) `assoc` and
+    `without`, which return a new map sharing structure with this one.
+
+    >>> m = PersistentMap(a=1)
+    >>> n = m.assoc('b', 2).without('a')
+    >>> sorted(m.items()), sorted(n.items())
+    ([('a', 1)], [('b', 2)])
+    >>> t = n.transient()
+    >>> t.update((i, i * i) for i in range(100))
+    >>> len(t.persistent()), len(n)
+    (101, 1)
+    """
+
+    __slots__ = ('_cnt', '_root')
+
+    def __init__(self, *args, **kwargs):
+        if args or kwargs:
+            t = _EMPTY_MAP.transient()
+            t.update(*args, **kwargs)
+            m = t.persistent()
+            self._cnt, self._root = m._cnt, m._root
+        else:
+            self._cnt, self._root = 0, _EMPTY_HNODE
+
+    @classmethod
+    def _make(cls, cnt, root):
+        m = object.__new__(cls)
+        m._cnt, m._root = cnt, root
+        return m
+
+    def assoc(self, key, val):
+        """ Copy with key -> val. """
+        added = [False]
+        root = _assoc(None, self._root, 0, _hash(key), key, val, added)
+        if root is self._root:
+            return self
+        return self._make(self._cnt + added[0], root)
+
+    set = assoc
+
+    def without(self, key):
+        """ Copy without key; the same map if key is not in it. """
+        removed = [False]
+        root = _without(None, self._root, 0, _hash(key), key, removed)
+        if not removed[0]:
+            return self
+        return self._make(self._cnt - 1, root or _EMPTY_HNODE)
+
+    def update(self, *args, **kwargs):
+        """ Copy with the items of a mapping or iterable of pairs added. """
+        t = self.transient()
+        t.update(*args, **kwargs)
+        return t.persistent()
+
+    def transient(self):
+        return TransientMap(self)
+
+    def __hash__(self):
+        return hash(frozenset(self.iteritems()))
+
+    def __repr__(self):
+        return 'PersistentMap(%r)' % dict(self.iteritems())
+
+    def __reduce__(self):
+        return (PersistentMap, (dict(self.iteritems()),))
+
+
+_EMPTY_MAP = PersistentMap()
+
+
+class TransientMap(_MapBase, MutableMapping):
+    """
+    Mutable builder for a PersistentMap. `persistent()` returns the finished
+    map in O(1); the transient can not be used after that.
+    """
+
+    def __init__(self, m):
+        self._edit = object()
+        self._cnt = m._cnt
+        self._root = m._root
+
+    def _ensure(self):
+        if self._edit is None:
+            raise RuntimeError('transient used after persistent()')
+
+    def __setitem__(self, key, val):
+        self._ensure()
+        added = [False]
+        self._root = _assoc(self._edit, self._root, 0, _hash(key), key, val, added)
+        self._cnt += added[0]
+
+    def __delitem__(self, key):
+        self._ensure()
+        removed = [False]
+        root = _without(self._edit, self._root, 0, _hash(key), key, removed)
+        if not removed[0]:
+            raise KeyError(key)
+        self._root = root or _EMPTY_HNODE
+        self._cnt -= 1
+
+    def persistent(self):
+        self._ensure()
+        self._edit = None
+        return PersistentMap._make(self._cnt, self._root)
+
+
+def test():
+    print 'testing persistent structures...'
+    import doctest, random, cPickle
+    doctest.testmod()
+    rnd = random.Random(0)
+
+    # vector: every version keeps its contents
+    versions = [(PersistentVector(), [])]
+    v, ref = versions[0]
+    for step in xrange(3000):
+        op = rnd.random()
+        if op < 0.6 or not ref:
+            v = v.append(step)
+            ref = ref + [step]
+        elif op < 0.8:
+            i = rnd.randrange(len(ref))
+            v = v.set(i, -step)
+            ref = ref[:]
+            ref[i] = -step
+        else:
+            v = v.pop()
+            ref = ref[:-1]
+        if step % 50 == 0:
+            versions.append((v, ref))
+    versions.append((v, ref))
+    for v, ref in versions:
+        assert len(v) == len(ref) and list(v) == ref and v == ref
+        assert [v[i] for i in xrange(len(ref))] == ref
+    big = PersistentVector(xrange(40000))
+    assert list(big[::1000]) == range(0, 40000, 1000) and big[-1] == 39999
+    t = big.transient()
+    t.extend(xrange(40000, 70000))
+    for i in xrange(0, 70000, 7):
+        t[i] = 'x'
+    bigger = t.persistent()
+    assert list(big) == range(40000)
+    assert len(bigger) == 70000 and bigger[7] == 'x' and bigger[69999] == 69999
+    x = bigger
+    for _ in xrange(70000):
+        x = x.pop()
+    assert len(x) == 0 and list(x) == []
+    try:
+        t.append(1)
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'expected RuntimeError'
+    assert cPickle.loads(cPickle.dumps(v, 2)) == v
+
+    # map, including keys whose hashes collide
+    class Collide(object):
+        def __init__(self, x): self.x = x
+        def __hash__(self): return self.x % 3
+        def __eq__(self, other): return isinstance(other, Collide) and self.x == other.x
+    keys = range(-500, 500) + ['s%d' % i for i in xrange(500)] + [Collide(i) for i in xrange(30)]
+    versions = [(PersistentMap(), {})]
+    m, ref = versions[0]
+    for step in xrange(4000):
+        k = rnd.choice(keys)
+        if rnd.random() < 0.7:
+            m = m.assoc(k, step)
+            ref = dict(ref)
+            ref[k] = step
+        else:
+            m = m.without(k)
+            ref = dict(ref)
+            ref.pop(k, None)
+        if step % 100 == 0:
+            versions.append((m, ref))
+    versions.append((m, ref))
+    for m, ref in versions:
+        assert len(m) == len(ref) and dict(m.iteritems()) == ref and m == ref
+        assert all(m[k] == v for k, v in ref.iteritems())
+        assert all(k not in m for k in keys if k not in ref)
+    t = m.transient()
+    for k in keys:
+        t[k] = 'new'
+    for k in keys[::2]:
+        del t[k]
+    n = t.persistent()
+    assert len(n) == len(keys) - len(keys[::2]) and dict(m.iteritems()) == ref
+    assert n.without('nope') is n and m.assoc(keys[0], m.get(keys[0], 0)).get(keys[0], 0) == m.get(keys[0], 0)
+    assert PersistentMap({'a': 1}, b=2) == {'a': 1, 'b': 2}
+    assert hash(PersistentMap(a=1)) == hash(PersistentMap(a=1))
+    assert cPickle.loads(cPickle.dumps(PersistentMap(a=1), 2)) == {'a': 1}
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
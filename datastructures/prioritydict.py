@@ -1,5 +1,3 @@
-from heapq import heapify, heappush, heappop
-
 class OrderedSet(object):
     """
     Set which remembers insertion ordering allowed iteration while changing size
@@ -25,75 +23,224 @@ class prioritydict(dict):
     Keys of the dictionary are items to be put into the queue, and values
     are their respective priorities. All dictionary methods work as expected.
     The advantage over a standard heapq-based priority queue is
-    that priorities of items can be efficiently updated (amortized O(1))
-    using code as 'thedict[item] = new_priority.'
+    that priorities of items can be efficiently updated (O(log n))
+    using code as 'thedict[item] = new_priority', and items can be deleted
+    (O(log n)) with 'del thedict[item]'.
 
     The 'smallest' method can be used to return the object with lowest
     priority, and 'pop_smallest' also removes it.
 
     The 'sorted_iter' method provides a destructive sorted iterator.
+
+    Internally this is an indexed binary heap: '_heap' holds the keys in heap
+    order and '_pos' maps each key to its index in '_heap', so the heap never
+    holds stale entries.
     """
-    
+
     def __init__(self, *args, **kwargs):
         super(prioritydict, self).__init__(*args, **kwargs)
         self._rebuild_heap()
 
     def _rebuild_heap(self):
-        self._heap = [(v, k) for k, v in self.iteritems()]
-        heapify(self._heap)
+        self._heap = self.keys()
+        self._pos = dict((k, i) for i, k in enumerate(self._heap))
+        for i in reversed(xrange(len(self._heap) // 2)):
+            self._siftdown(i)
+
+    def _siftup(self, i):
+        # move heap[i] towards the root until its parent is not larger
+        heap = self._heap
+        pos = self._pos
+        get = dict.__getitem__
+        key = heap[i]
+        val = get(self, key)
+        while i > 0:
+            parent = (i - 1) >> 1
+            pkey = heap[parent]
+            if val < get(self, pkey):
+                heap[i] = pkey
+                pos[pkey] = i
+                i = parent
+            else:
+                break
+        heap[i] = key
+        pos[key] = i
+
+    def _siftdown(self, i):
+        # move heap[i] towards the leaves until no child is smaller
+        heap = self._heap
+        pos = self._pos
+        get = dict.__getitem__
+        n = len(heap)
+        key = heap[i]
+        val = get(self, key)
+        while True:
+            child = 2 * i + 1
+            if child >= n:
+                break
+            ckey = heap[child]
+            cval = get(self, ckey)
+            right = child + 1
+            if right < n:
+                rkey = heap[right]
+                rval = get(self, rkey)
+                if rval < cval:
+                    child, ckey, cval = right, rkey, rval
+            if cval < val:
+                heap[i] = ckey
+                pos[ckey] = i
+                i = child
+            else:
+                break
+        heap[i] = key
+        pos[key] = i
 
     def smallest(self):
         """Return the item with the lowest priority.
 
         Raises IndexError if the object is empty.
         """
-        
-        heap = self._heap
-        v, k = heap[0]
-        while k not in self or self[k] != v:
-            heappop(heap)
-            v, k = heap[0]
-        return k
+        return self._heap[0]
 
     def pop_smallest(self):
         """Return the item with the lowest priority and remove it.
 
         Raises IndexError if the object is empty.
         """
-        
-        heap = self._heap
-        v, k = heappop(heap)
-        while k not in self or self[k] != v:
-            v, k = heappop(heap)
+        k = self._heap[0]
         del self[k]
         return k
 
+    def sorted_iter(self):
+        """Iterate over the items in order of priority, removing them."""
+        while self:
+            yield self.pop_smallest()
+
     def __setitem__(self, key, val):
-        # We are not going to remove the previous value from the heap,
-        # since this would have a cost O(n).
-        
-        super(prioritydict, self).__setitem__(key, val)
-        
-        if len(self._heap) < 2 * len(self):
-            heappush(self._heap, (val, key))
+        pos = self._pos.get(key)
+        if pos is None:
+            super(prioritydict, self).__setitem__(key, val)
+            self._heap.append(key)
+            self._siftup(len(self._heap) - 1)
         else:
-            # When the heap grows larger than 2 * len(self), we rebuild it
-            # from scratch to avoid wasting too much memory.
+            old = self[key]
+            super(prioritydict, self).__setitem__(key, val)
+            if val < old:
+                self._siftup(pos)
+            else:
+                self._siftdown(pos)
+
+    def __delitem__(self, key):
+        super(prioritydict, self).__delitem__(key)
+        i = self._pos.pop(key)
+        heap = self._heap
+        last = heap.pop()
+        if i < len(heap):
+            # move the last leaf into the hole, then restore the heap order
+            heap[i] = last
+            self._pos[last] = i
+            self._siftdown(i)
+            self._siftup(self._pos[last])
+
+    def pop(self, key, *default):
+        if key in self:
+            val = self[key]
+            del self[key]
+            return val
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def popitem(self):
+        """Remove and return the (item, priority) pair with the lowest priority.
+
+        Raises KeyError if the object is empty.
+        """
+        if not self:
+            raise KeyError('popitem(): dictionary is empty')
+        k = self._heap[0]
+        return k, self.pop(k)
+
+    def setdefault(self, key, val=None):
+        if key not in self:
+            self[key] = val
+            return val
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        if len(other) > len(self) // 2:
+            # cheaper to heapify everything again, in O(n)
+            super(prioritydict, self).update(other)
             self._rebuild_heap()
-
-    setdefault = None
-    update = None
-
-#    def setdefault(self, key, val):
-#        if key not in self:
-#            self[key] = val
-#            return val
-#        return self[key]
-
-#    def update(self, *args, **kwargs):
-#        # Reimplementing dict.update is tricky -- see e.g.
-#        # http://mail.python.org/pipermail/python-ideas/2007-May/000744.html
-#        # We just rebuild the heap from scratch after passing to super.       
-#        super(prioritydict, self).update(*args, **kwargs)
-#        self._rebuild_heap()
-
+        else:
+            for k, v in other.iteritems():
+                self[k] = v
+
+    def clear(self):
+        super(prioritydict, self).clear()
+        self._heap = []
+        self._pos = {}
+
+    def copy(self):
+        return self.__class__(self)
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+def test():
+    print 'testing prioritydict...'
+    import random, cPickle
+    rnd = random.Random(0)
+
+    def check(d):
+        heap, pos = d._heap, d._pos
+        assert len(heap) == len(pos) == len(d)
+        for i, k in enumerate(heap):
+            assert pos[k] == i
+            assert i == 0 or d[heap[(i - 1) >> 1]] <= d[k]
+
+    d = prioritydict(a=5, b=3, c=8)
+    ref = dict(d)
+    check(d)
+    for step in xrange(5000):
+        op = rnd.random()
+        k = rnd.randrange(200)
+        if op < 0.5:
+            d[k] = ref[k] = rnd.random()
+        elif op < 0.7:
+            assert d.pop(k, None) == ref.pop(k, None)
+        elif op < 0.8 and d:
+            v = min(ref.values())
+            assert ref.pop(d.pop_smallest()) == v
+        elif op < 0.9:
+            assert d.setdefault(k, 0.5) == ref.setdefault(k, 0.5)
+        else:
+            new = dict((rnd.randrange(200), rnd.random()) for _ in xrange(rnd.choice([2, 300])))
+            d.update(new)
+            ref.update(new)
+        assert dict(d) == ref
+        if step % 100 == 0:
+            check(d)
+    check(d)
+    if ref:
+        assert d[d.smallest()] == min(ref.values())
+
+    c = cPickle.loads(cPickle.dumps(d, 2))
+    check(c)
+    assert type(c) is prioritydict and dict(c) == ref
+    assert [c[k] for k in list(c.copy().sorted_iter())] == sorted(ref.values())
+    assert [v for k, v in iter(lambda: c.popitem() if c else None, None)] == sorted(ref.values())
+    d.clear()
+    try:
+        d.pop_smallest()
+    except IndexError:
+        pass
+    else:
+        assert False, 'expected IndexError'
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
@@ -181,3 +181,388 @@ class Transactionlist(list, Transaction):
         del self[:]
         self.extend(state)
 
+
+
+_MISSING = object()     # marks an attribute which did not exist before a change
+
+
+def _transactions(d, items):
+    "the IncrementalTransactions among the attributes d and list items"
+    return [val for key, val in d.items()
+            if key != '_changes' and isinstance(val, IncrementalTransaction)] + \
+        [val for val in items if isinstance(val, IncrementalTransaction)]
+
+
+def _undo(d, items, attrs, splices):
+    "restore attributes d and list items to before a level of changes"
+    for name, old in attrs.iteritems():
+        if old is _MISSING:
+            d.pop(name, None)
+        else:
+            d[name] = old
+    for start, n, old in reversed(splices):
+        list.__setitem__(items, slice(start, start + n), old)
+
+
+class _Changes(object):
+    "undo information of an IncrementalTransaction"
+    __slots__ = 'attrs', 'splices', 'history', 'size'
+    def __init__(self):
+        self.attrs = {}         # attribute -> value at the last commit
+        self.splices = []       # (start, n, old items) for list slots, in order
+        self.history = []       # (attrs, splices) of older commits, oldest first
+        self.size = 0           # values held by history
+
+
+class IncrementalTransaction(object):
+    """
+    Like Transaction, but copy-on-write: instead of deep-copying the whole
+    object on every commit, attribute assignments and deletions save the
+    value they replace, once per attribute between commits. Committing and
+    rolling back cost time and memory proportional to the number of changes.
+
+    Only rebinding is seen -- mutate nested values in place and the change
+    is not recorded; make them IncrementalTransactions (e.g.
+    IncrementalTransactionlist) instead, and they are committed and rolled
+    back along with their parent.
+
+    Nothing is recorded before the first commit. Every commit is a level of
+    history, and `rollback(steps)` goes back that many commits beyond the
+    last one. `history_budget` bounds the number of values the history
+    holds -- a count, not bytes: each saved attribute counts one, and each
+    list splice one plus the items it saved. The oldest levels are dropped
+    once it is exceeded.
+
+    >>> class Test(IncrementalTransaction):
+    ...     pass
+    >>> a = Test()
+    >>> a.x = 1
+    >>> a.commit()
+    >>> a.x = 2
+    >>> a.commit()
+    >>> a.x = 3
+    >>> a.rollback(); a.x
+    2
+    >>> a.rollback(1); a.x
+    1
+    """
+
+    history_budget = None
+
+    def __setattr__(self, name, value):
+        d = self.__dict__
+        changes = d.get('_changes')
+        if changes is not None and name not in changes.attrs:
+            changes.attrs[name] = d.get(name, _MISSING)
+        object.__setattr__(self, name, value)
+
+    def __delattr__(self, name):
+        d = self.__dict__
+        changes = d.get('_changes')
+        if changes is not None and name not in changes.attrs:
+            changes.attrs[name] = d.get(name, _MISSING)
+        object.__delattr__(self, name)
+
+    def _children(self):
+        "the IncrementalTransactions held by this one"
+        return _transactions(self.__dict__, self if isinstance(self, list) else ())
+
+    def _levels(self, steps):
+        "(attrs, splices) to undo, newest first, to roll back `steps` commits"
+        changes = self.__dict__['_changes']
+        levels = [(changes.attrs, changes.splices)]
+        levels.extend(reversed(changes.history[len(changes.history) - steps:]))
+        return levels
+
+    def _check_history(self, steps, deep, seen):
+        """
+        Raise IndexError, before anything is undone, if this object or one
+        it will hold after the rollback can not go back `steps` commits.
+        """
+        if _checksetseen(id(self), seen):
+            return
+        changes = self.__dict__.get('_changes')
+        if changes is None:
+            return
+        if steps > len(changes.history):
+            raise IndexError('can not roll back %d commits; the history holds %d'
+                             % (steps, len(changes.history)))
+        if deep:
+            # the children are those of the rolled back state, undone on copies
+            d = dict(self.__dict__)
+            items = list(self) if isinstance(self, list) else []
+            for attrs, splices in self._levels(steps):
+                _undo(d, items, attrs, splices)
+            for child in _transactions(d, items):
+                child._check_history(steps, deep, seen)
+
+    @property
+    def history_depth(self):
+        "how many commits `rollback` can go back beyond the last one"
+        changes = self.__dict__.get('_changes')
+        return len(changes.history) if changes is not None else 0
+
+    def commit(self, **kwargs):
+        """
+        Commit the object state.
+
+        If the optional argument "deep" is set to False,
+        objects of class IncrementalTransaction stored in this object will
+        not be committed.
+        """
+        seen = kwargs.get("_commit_seen", set())
+        if _checksetseen(id(self), seen):
+            return
+        d = self.__dict__
+        changes = d.get('_changes')
+        if changes is None:
+            d['_changes'] = _Changes()
+        else:
+            changes.history.append((changes.attrs, changes.splices))
+            changes.size += len(changes.attrs) + sum(1 + len(old) for _, _, old in changes.splices)
+            changes.attrs = {}
+            changes.splices = []
+            budget = self.history_budget
+            while budget is not None and changes.size > budget and changes.history:
+                attrs, splices = changes.history.pop(0)
+                changes.size -= len(attrs) + sum(1 + len(old) for _, _, old in splices)
+        if kwargs.get("deep", True):
+            for child in self._children():
+                child.commit(_commit_seen = seen)
+
+    def rollback(self, steps=0, **kwargs):
+        """
+        Rollback to the last committed object state, or `steps` commits
+        before it. Raises IndexError, leaving everything as it was, if the
+        history of this object or of any child does not go back that far.
+
+        If the optional argument "deep" is set to False,
+        objects of class IncrementalTransaction stored in this object will
+        not be rolled back.
+        """
+        deep = kwargs.get("deep", True)
+        if "_rollback_seen" not in kwargs:
+            self._check_history(steps, deep, set())
+        seen = kwargs.get("_rollback_seen", set())
+        if _checksetseen(id(self), seen):
+            return
+        changes = self.__dict__.get('_changes')
+        if changes is None:
+            return
+        for attrs, splices in self._levels(steps):
+            _undo(self.__dict__, self, attrs, splices)
+        for _ in xrange(steps):
+            attrs, splices = changes.history.pop()
+            changes.size -= len(attrs) + sum(1 + len(old) for _, _, old in splices)
+        changes.attrs = {}
+        changes.splices = []
+        if deep:
+            for child in self._children():
+                child.rollback(steps, _rollback_seen = seen)
+
+
+class IncrementalTransactionlist(list, IncrementalTransaction):
+    """
+    A list with copy-on-write transactions: every mutating method records
+    the slots it replaces as a splice (start, length now, old items), and
+    rollback undoes the splices in reverse order. Only sort, reverse and
+    extended-slice assignment record the whole list.
+    """
+
+    def _splice(self, start, n, old):
+        changes = self.__dict__.get('_changes')
+        if changes is not None:
+            changes.splices.append((start, n, old))
+
+    def _index(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('list index out of range')
+        return i
+
+    def __setitem__(self, i, val):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                self._splice(0, len(self), list(self))
+            else:
+                val = list(val)
+                self._splice(start, len(val), list.__getslice__(self, start, max(start, stop)))
+            list.__setitem__(self, i, val)
+        else:
+            i = self._index(i)
+            self._splice(i, 1, [list.__getitem__(self, i)])
+            list.__setitem__(self, i, val)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                old = list(self)
+                list.__delitem__(self, i)
+                self._splice(0, len(self), old)
+            else:
+                self._splice(start, 0, list.__getslice__(self, start, max(start, stop)))
+                list.__delitem__(self, i)
+        else:
+            i = self._index(i)
+            self._splice(i, 0, [list.__getitem__(self, i)])
+            list.__delitem__(self, i)
+
+    def __setslice__(self, i, j, seq):
+        self.__setitem__(slice(i, j), seq)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    def append(self, val):
+        self._splice(len(self), 1, [])
+        list.append(self, val)
+
+    def extend(self, vals):
+        vals = list(vals)
+        self._splice(len(self), len(vals), [])
+        list.extend(self, vals)
+
+    def __iadd__(self, vals):
+        self.extend(vals)
+        return self
+
+    def __imul__(self, k):
+        n = len(self)
+        if k <= 0:
+            self._splice(0, 0, list(self))
+        else:
+            self._splice(n, n * (k - 1), [])
+        return list.__imul__(self, k)
+
+    def insert(self, i, val):
+        n = len(self)
+        if i < 0:
+            i = max(0, i + n)
+        i = min(i, n)
+        self._splice(i, 1, [])
+        list.insert(self, i, val)
+
+    def pop(self, i=-1):
+        i = self._index(i)
+        val = list.pop(self, i)
+        self._splice(i, 0, [val])
+        return val
+
+    def remove(self, val):
+        del self[self.index(val)]
+
+    def sort(self, *args, **kwargs):
+        self._splice(0, len(self), list(self))
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._splice(0, len(self), list(self))
+        list.reverse(self)
+
+
+def test():
+    print 'testing transactions...'
+    import doctest, random
+    doctest.testmod()
+
+    class Test(IncrementalTransaction):
+        pass
+
+    a = Test()
+    a.x = 1
+    a.rollback()                    # no commit yet: nothing to roll back
+    assert a.x == 1
+    a.items = IncrementalTransactionlist([1, 2, 3])
+    a.commit()
+    a.x = 2
+    a.y = 'new'
+    a.items[0] = 10
+    a.items.append(4)
+    a.rollback()
+    assert a.x == 1 and not hasattr(a, 'y') and a.items == [1, 2, 3]
+
+    # random list edits against snapshots
+    rnd = random.Random(0)
+    l = IncrementalTransactionlist(range(10))
+    l.commit()
+    snapshots = [list(l)]
+    for level in xrange(30):
+        for _ in xrange(rnd.randint(0, 5)):
+            op = rnd.randrange(12)
+            n = len(l)
+            i, j = sorted([rnd.randint(-n - 1, n + 1), rnd.randint(-n - 1, n + 1)])
+            try:
+                if op == 0: l[i] = rnd.random()
+                elif op == 1: l[i:j] = [rnd.random()] * rnd.randint(0, 3)
+                elif op == 2: del l[i]
+                elif op == 3: del l[i:j]
+                elif op == 4: l.append(rnd.random())
+                elif op == 5: l.extend([0] * rnd.randint(0, 3))
+                elif op == 6: l.insert(i, rnd.random())
+                elif op == 7: l.pop(i)
+                elif op == 8: l.sort()
+                elif op == 9: l.reverse()
+                elif op == 10: del l[::2]
+                else: l += [1, 2]; l *= rnd.randint(0, 2)
+            except IndexError:
+                pass
+        if rnd.random() < 0.3:
+            l.rollback()
+            assert l == snapshots[-1]
+        else:
+            l.commit()
+            snapshots.append(list(l))
+    l.rollback()
+    assert l == snapshots[-1] and l.history_depth == len(snapshots) - 1
+    while l.history_depth:
+        l.rollback(1)
+        snapshots.pop()
+        assert l == snapshots[-1]
+    assert len(snapshots) == 1
+
+    # the history budget drops the oldest levels
+    class Small(IncrementalTransaction):
+        history_budget = 3
+    s = Small()
+    s.v = 0
+    s.commit()
+    for v in xrange(1, 6):
+        s.v = v
+        s.commit()
+    assert s.history_depth == 3
+    s.rollback(3)
+    assert s.v == 2
+    try:
+        s.rollback(1)
+    except IndexError:
+        pass
+    else:
+        assert False, 'expected IndexError'
+
+    # a child with a shorter history stops the rollback before anything changes
+    p = Test()
+    p.children = IncrementalTransactionlist([Small()])
+    p.commit()
+    for v in xrange(5):
+        p.x = v
+        p.children[0].v = [v] * 2
+        p.commit()
+    assert p.history_depth == 5 and p.children[0].history_depth == 3
+    try:
+        p.rollback(4)
+    except IndexError:
+        pass
+    else:
+        assert False, 'expected IndexError'
+    assert p.x == 4 and p.children[0].v == [4, 4] and p.history_depth == 5
+    p.rollback(1)
+    assert p.x == 3 and p.children[0].v == [3, 3] and p.history_depth == 4
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
@@ -3,8 +3,19 @@
 Union-find data structure. Based on Josiah Carlson's code,
 http://aspn.activestate.com/ASPN/Cookbook/Python/Recipe/215912
 with significant additional changes by D. Eppstein.
+
+IntUnionFind is a NumPy-backed version for the integers 0..n-1, with bulk
+`union_many` and `components`; KeyedUnionFind puts a key -> integer mapping
+in front of it for arbitrary hashable objects.
 """
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_MAX_RANK = 255         # IntUnionFind ranks are uint8
+
 class UnionFind(object):
     """Union-find data structure.
 
@@ -62,3 +73,226 @@ class UnionFind(object):
                 self.parents[r] = heaviest
 
 
+class IntUnionFind(object):
+    """Union-find over the integers 0..n-1, stored in NumPy arrays.
+
+    Single operations use union by rank and path halving. `union_many` takes
+    a whole (m, 2) array of edges and merges them in a few vectorized rounds:
+    each round finds the roots of all endpoints, and hooks the larger root
+    of every unmerged pair onto the smallest root it is paired with. Hooks
+    always go to a smaller id, so no cycles form; the other pairs sharing
+    that root are retried in the next round. `find_many` jumps pointers, so
+    even the long chains this can build take O(log n) passes to resolve.
+
+    Ranks only guide `union`. They stay upper bounds on tree heights, but
+    saturate at 255 instead of wrapping around.
+    """
+
+    def __init__(self, n=0):
+        self.parent = np.arange(n, dtype=np.intp)
+        self.rank = np.zeros(n, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def grow(self, n):
+        """Add singleton sets so that the structure covers 0..n-1."""
+        old = len(self.parent)
+        if n > old:
+            self.parent = np.concatenate([self.parent, np.arange(old, n, dtype=np.intp)])
+            self.rank = np.concatenate([self.rank, np.zeros(n - old, dtype=np.uint8)])
+
+    def find(self, x):
+        """Find and return the root of the set containing x."""
+        p = self.parent
+        while True:
+            px = p[x]
+            if px == x:
+                return int(x)
+            # path halving: point x at its grandparent and skip ahead
+            ppx = p[px]
+            p[x] = ppx
+            x = ppx
+
+    __getitem__ = find
+
+    def union(self, a, b):
+        """Merge the sets containing a and b; returns False if they were already one."""
+        a = self.find(a)
+        b = self.find(b)
+        if a == b:
+            return False
+        rank = self.rank
+        if rank[a] < rank[b]:
+            a, b = b, a
+        self.parent[b] = a
+        if rank[a] == rank[b] and rank[a] < _MAX_RANK:
+            rank[a] += 1
+        return True
+
+    def find_many(self, xs):
+        """Roots of an array of elements; compresses their paths to the root."""
+        xs = np.asarray(xs, dtype=np.intp)
+        p = self.parent
+        r = p[xs]
+        while True:
+            pr = p[r]
+            if np.array_equal(pr, r):
+                break
+            # pointer jumping: every node on the way skips to its grandparent,
+            # so path lengths halve with each pass
+            ppr = p[pr]
+            p[r] = ppr
+            r = ppr
+        p[xs] = r
+        return r
+
+    def union_many(self, edges):
+        """Merge the endpoints of each row of an (m, 2) integer array."""
+        edges = np.asarray(edges, dtype=np.intp).reshape(-1, 2)
+        u = edges[:, 0]
+        v = edges[:, 1]
+        p = self.parent
+        while len(u):
+            ru = self.find_many(u)
+            rv = self.find_many(v)
+            keep = ru != rv
+            u, v, ru, rv = u[keep], v[keep], ru[keep], rv[keep]
+            if not len(u):
+                break
+            hi = np.maximum(ru, rv)
+            lo = np.minimum(ru, rv)
+            # several pairs can share a root; hook it onto the smallest one
+            np.minimum.at(p, hi, lo)
+            np.maximum.at(self.rank, lo, np.minimum(self.rank[hi], _MAX_RANK - 1) + 1)
+
+    def roots(self):
+        """Root of every element, after compressing all paths."""
+        p = self.parent
+        while True:
+            pp = p[p]
+            if np.array_equal(pp, p):
+                return p.copy()
+            p[:] = pp
+
+    def components(self):
+        """Array of component labels 0..k-1, one per element."""
+        return np.unique(self.roots(), return_inverse=True)[1]
+
+
+class KeyedUnionFind(object):
+    """IntUnionFind over arbitrary hashable objects.
+
+    Same interface as UnionFind, plus `union_many` over pairs of objects and
+    `components`, which maps each object to a component label 0..k-1.
+    """
+
+    def __init__(self):
+        self.index = {}         # object -> int
+        self.keys = []          # int -> object
+        self.sets = IntUnionFind(16)
+
+    def _id(self, obj):
+        i = self.index.get(obj)
+        if i is None:
+            i = self.index[obj] = len(self.keys)
+            self.keys.append(obj)
+            if i >= len(self.sets):
+                self.sets.grow(2 * i)
+        return i
+
+    def __getitem__(self, obj):
+        """Find and return the name of the set containing the object."""
+        return self.keys[self.sets.find(self._id(obj))]
+
+    def __iter__(self):
+        """Iterate through all items ever found or unioned by this structure."""
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def union(self, *objects):
+        """Find the sets containing the objects and merge them all."""
+        ids = [self._id(x) for x in objects]
+        for i in ids[1:]:
+            self.sets.union(ids[0], i)
+
+    def union_many(self, pairs):
+        """Merge the two objects of each pair."""
+        _id = self._id
+        edges = np.array([(_id(a), _id(b)) for a, b in pairs], dtype=np.intp)
+        self.sets.union_many(edges)
+
+    def components(self):
+        """Dictionary mapping each object to a component label 0..k-1."""
+        labels = np.unique(self.sets.roots()[:len(self.keys)], return_inverse=True)[1]
+        return dict(zip(self.keys, labels.tolist()))
+
+
+def test():
+    print 'testing union-find...'
+    import random
+    rnd = random.Random(0)
+    n = 2000
+    edges = [(rnd.randrange(n), rnd.randrange(n)) for _ in xrange(1500)]
+
+    ref = UnionFind()
+    for x in xrange(n):
+        ref[x]
+    for a, b in edges:
+        ref.union(a, b)
+
+    def same_partition(labels):
+        # labels and ref agree on which elements share a set
+        seen = {}
+        for x in xrange(n):
+            assert seen.setdefault(labels[x], ref[x]) == ref[x]
+        assert len(seen) == len(set(ref[x] for x in xrange(n)))
+
+    u = IntUnionFind(n)
+    for a, b in edges:
+        u.union(a, b)
+    same_partition([u.find(x) for x in xrange(n)])
+    same_partition(u.components())
+
+    v = IntUnionFind(n)
+    v.union_many(edges[:700])
+    v.union_many(np.array(edges[700:]))
+    labels = v.components()
+    same_partition(labels)
+    assert labels.max() + 1 == len(set(labels.tolist()))
+    assert not v.union(*edges[0]) and v.find(edges[0][0]) == v.find(edges[0][1])
+
+    # long chains and high-degree roots take a few rounds, not n
+    import time
+    m = 80000
+    a = np.arange(m - 1)
+    for chain in (np.column_stack([a, a + 1]), np.column_stack([a + 1, a]),
+                  np.column_stack([np.repeat(m - 1, m - 1), a])):
+        c = IntUnionFind(m)
+        t0 = time.time()
+        c.union_many(chain)
+        assert time.time() - t0 < 2.0, time.time() - t0
+        assert (c.roots() == 0).all() and c.rank.max() <= _MAX_RANK
+    c = IntUnionFind(2)
+    c.rank[:] = _MAX_RANK
+    c.union(0, 1)
+    assert c.rank.tolist() == [_MAX_RANK] * 2
+
+    k = KeyedUnionFind()
+    k.union_many(('x%d' % a, 'x%d' % b) for a, b in edges[:1000])
+    for a, b in edges[1000:]:
+        k.union('x%d' % a, 'x%d' % b)
+    comp = k.components()
+    for a, b in edges:
+        assert comp['x%d' % a] == comp['x%d' % b]
+        assert k['x%d' % a] == k['x%d' % b]
+    for x in xrange(n):
+        k['x%d' % x]
+    same_partition([k.components()['x%d' % x] for x in xrange(n)])
+    print 'pass.'
+
+
+if __name__ == '__main__':
+    test()
@@ -7,7 +7,7 @@ Output: a sorted list of the most informative features.
 """
 
 import sys
-from numpy import zeros, fromiter, int32
+from numpy import zeros
 from arsenal.math import kl_divergence, normalize, lidstone
 from arsenal.alphabet import Alphabet
 from collections import defaultdict
@@ -45,7 +45,7 @@ def integerize(data):
 
     F = Alphabet()
     L = Alphabet()
-    I = [(L[label], fromiter(F.map(features), dtype=int32)) for label, features in data]
+    I = [(L[label], F.map_array(features)) for label, features in data]
     return (L, F, I)
 
 
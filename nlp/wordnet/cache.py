@@ -22,6 +22,13 @@
 
 from util import *
 
+try:
+    from arsenal.cache.registry import CacheInfo, register, approx_size
+except ImportError:
+    from collections import namedtuple
+    CacheInfo = namedtuple('CacheInfo', 'hits misses evictions maxsize currsize')
+    register = approx_size = None
+
 
 DEFAULT_CACHE_CAPACITY = 1000
 
@@ -62,6 +69,8 @@ class _LRUCache:
         """
         self.capacity = capacity
         self.clear()
+        if register is not None:
+            register(self, 'nlp.wordnet.cache', '_LRUCache')
     
     def clear(self):
         """
@@ -71,6 +80,7 @@ class _LRUCache:
         self.history = {}
         self.oldestTimestamp = 0
         self.nextTimestamp = 1
+        self.hits = self.misses = self.evictions = 0
     
     def removeOldestEntry(self):
         """
@@ -82,6 +92,7 @@ class _LRUCache:
                 key = self.history[self.oldestTimestamp]
                 del self.history[self.oldestTimestamp]
                 del self.values[key]
+                self.evictions += 1
                 return
 
             self.oldestTimestamp = self.oldestTimestamp + 1
@@ -125,7 +136,10 @@ class _LRUCache:
 
         # Load the value if it wasn't cached
         if value == None:
+            self.misses += 1
             value = loadfn and loadfn()
+        else:
+            self.hits += 1
 
         # Cache the value we loaded
         if self.values:
@@ -139,6 +153,18 @@ class _LRUCache:
 
         return value
 
+    # interface used by arsenal.cache.registry
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.evictions, self.capacity, len(self.values))
+
+    def cache_clear(self):
+        self.clear()
+
+    def cache_bytes(self):
+        return approx_size(self.values, value=lambda entry: entry[0])
+
+    resize = setCapacity
+
 class _NullCache:
     """
     A NullCache implements the Cache interface (the interface that